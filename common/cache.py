@@ -0,0 +1,190 @@
+"""
+Disk-backed memoization of expensive analysis computations.
+
+The results are stored under a key combining the fingerprints of the input files
+(the result is recomputed when they change), the name of the function and its
+arguments. The cache is bounded in size and evicts the least recently used
+results first.
+"""
+
+import os
+import re
+import pickle
+import hashlib
+import logging
+import inspect
+import tempfile
+import functools
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+def get_file_fingerprint(file_path: str | Path, content: bool = False) -> str:
+    """
+    Fingerprint of a file, from its path, size and modification time, or from
+    its content if `content` is True (slower but robust to touched files).
+    """
+    if not content:
+        stat = os.stat(file_path)
+        return f"{Path(file_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of function results on disk.
+
+    Each result is pickled in its own file named after the function and the key,
+    written atomically (to a temporary file which is then renamed). Reading a
+    result refreshes its modification time, so that the least recently used
+    results are evicted first when the cache gets bigger than `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | Path,
+        max_bytes: int = 2 * 1024**3,
+        content_fingerprints: bool = False,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.content_fingerprints = content_fingerprints
+
+    def get_key(
+        self, name: str, files: Iterable[str | Path] = (), args: tuple = (), kwargs=None
+    ) -> str:
+        digest = hashlib.sha256(name.encode())
+        for file_path in sorted(map(str, files)):
+            digest.update(
+                get_file_fingerprint(file_path, self.content_fingerprints).encode()
+            )
+        digest.update(pickle.dumps((args, sorted((kwargs or {}).items())), protocol=4))
+        return f"{name}-{digest.hexdigest()}"
+
+    def _get_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.pkl"
+
+    def get(self, key: str, default: Any = None) -> Any:
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as file:
+                value = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        # Mark the result as recently used, unless it was evicted in the meantime
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        file_descriptor, temp_path = tempfile.mkstemp(
+            dir=self.cache_dir, prefix=".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._get_path(key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.evict()
+
+    def __contains__(self, key: str) -> bool:
+        return self._get_path(key).exists()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used results until the cache fits in `max_bytes`.
+        """
+        entries = []
+        for path in self.cache_dir.glob("*.pkl"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+            logger.debug(f"Evicted {path.name} from the cache")
+
+    def invalidate(self, name: str | None = None) -> int:
+        """
+        Remove the results of the function `name`, or all of them if it is None.
+
+        Returns:
+            int: The number of removed results.
+        """
+        pattern = f"{name}-*.pkl" if name else "*.pkl"
+        paths = list(self.cache_dir.glob(pattern))
+        for path in paths:
+            path.unlink(missing_ok=True)
+        return len(paths)
+
+    def memoize(
+        self,
+        files: Iterable[str | Path] = (),
+        name: str | None = None,
+        files_arg: str | None = None,
+    ) -> Callable:
+        """
+        Decorator caching the results of a function computed from `files`.
+
+        The arguments of the function are part of the key, so they should be small
+        and picklable (e.g. column names rather than DataFrames), and the function
+        should only depend on them and on its input files (not on a global frame).
+        The decorated function has an `invalidate()` method to drop its cached
+        results.
+
+        Args:
+            files (Iterable): The input files of the function.
+            name (str, optional): The name of the function in the cache. Default to
+                its qualified name.
+            files_arg (str, optional): The name of the argument of the function
+                holding its input files, fingerprinted at each call in addition to
+                `files`.
+        """
+        files = list(files)
+
+        def decorator(func: Callable) -> Callable:
+            # The name is part of the files names (and of the invalidation glob)
+            func_name = re.sub(
+                r"[^\w.]", "_", name or f"{func.__module__}.{func.__qualname__}"
+            )
+
+            signature = inspect.signature(func)
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                call_files = files
+                if files_arg is not None:
+                    arguments = signature.bind(*args, **kwargs).arguments
+                    call_files = [*files, *arguments.get(files_arg, ())]
+                key = self.get_key(func_name, call_files, args, kwargs)
+                missing = object()
+                value = self.get(key, missing)
+                if value is not missing:
+                    logger.info(f"Loaded the result of {func_name} from the cache")
+                    return value
+                value = func(*args, **kwargs)
+                self.set(key, value)
+                return value
+
+            wrapper.invalidate = lambda: self.invalidate(func_name)
+            return wrapper
+
+        return decorator
@@ -8,3 +8,8 @@ BASE_REPORTS_CSV_DIR = ROOT_DIR / "reports" / "csv_misc"
 BASE_LOGS_DIR = ROOT_DIR / "reports" / "logs"
 BASE_PLOTS_DIR = ROOT_DIR / "reports" / "plots"
 BASE_PTMS_DIR = ROOT_DIR / "reports" / "ptms"
+BASE_TRANSCODED_DATA_DIR = ROOT_DIR / "data" / "transcoded"
+BASE_CACHE_DIR = ROOT_DIR / "data" / "cache"
+BASE_AGGREGATED_DATA_DIR = ROOT_DIR / "data" / "aggregated"
+BASE_PTMS_INDEX_DIR = ROOT_DIR / "data" / "ptms_index"
+BASE_QUARANTINE_DATA_DIR = ROOT_DIR / "data" / "quarantine"
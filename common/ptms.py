@@ -0,0 +1,27 @@
+"""
+Syntax of the ptms (Post Translation Modifications) in the modified peptides e.g.,
+PEPTN[2350]IDE, shared by their identification (see `scripts.identify_ptms`) and
+the validation of the data files (see `common.validation`).
+"""
+
+from enum import Enum
+
+
+class PTMSitesEnum(str, Enum):
+    """
+    Potential amino acid on which we may have a ptm.
+    """
+
+    # Glycosylation only happens on Asparagine within this sequence(Asn-{Any}-Ser/Thr).
+    # But we will just assume that it can happen on any Asparagine for simplicity reasons.
+    N_GLYCOSYLATION = "N"  # Asparagine (N)
+    O_GLYCOSYLATION = "ST"  # Threonine (T) and Serine (S)
+    GLYCOSYLATION = N_GLYCOSYLATION + O_GLYCOSYLATION
+    ANY = "ACDEFGHIKLMNPQRSTVWYacdefghiklmnpqrstvwy"  # noqa
+
+
+# The mass of a ptm, between brackets after its amino acid
+PTM_MASS_REGEX = r"\d+"
+GLYCOSYLATION_REGEX_TEMPLATE = (
+    r"(?P<aa>[{sites}])\[(?P<glycan_mass>" + PTM_MASS_REGEX + r")\]"
+)
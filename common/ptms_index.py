@@ -0,0 +1,214 @@
+"""
+On-disk inverted index from each ptm (amino_acid, glycan_mass) to the locations
+(file id, row index) of the spectra whose modified peptide carries it, so that any
+number of examples of a ptm can be read back without scanning the corpus again.
+
+The index is a directory holding:
+    - index.json: the indexed files (their position being their id) with their
+      fingerprints, and the ptms with the offset and size of their posting list.
+    - postings.bin: the posting lists. The locations of a ptm are packed into
+      sorted integers ((file id << 32) | row index), delta-encoded and written as
+      varints (7 bits per byte), so a posting usually takes one or two bytes.
+"""
+
+import json
+import logging
+import numpy as np
+import pandas as pd
+from array import array
+from pathlib import Path
+
+from common.cache import get_file_fingerprint
+from common.utils import get_or_create_folder, read_data_rows
+
+logger = logging.getLogger(__name__)
+
+ROW_INDEX_BITS = 32
+
+
+def encode_postings(locations: np.ndarray) -> bytes:
+    """
+    Encode packed locations into a delta-encoded varint posting list.
+    """
+    locations = np.unique(np.asarray(locations, dtype=np.uint64))
+    deltas = np.diff(locations, prepend=np.uint64(0))
+
+    # Number of 7-bit groups of each delta (at least one)
+    sizes = np.ones(len(deltas), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        sizes += deltas >= (np.uint64(1) << np.uint64(shift))
+
+    starts = np.cumsum(sizes) - sizes
+    groups = np.arange(sizes.sum()) - np.repeat(starts, sizes)
+    shifts = (7 * groups).astype(np.uint64)
+    encoded = (np.repeat(deltas, sizes) >> shifts) & np.uint64(0x7F)
+    # The high bit flags that the next byte belongs to the same delta
+    encoded |= np.where(groups < np.repeat(sizes, sizes) - 1, 0x80, 0).astype(np.uint64)
+    return encoded.astype(np.uint8).tobytes()
+
+
+def decode_postings(data: bytes) -> np.ndarray:
+    """
+    Decode a posting list into its sorted packed locations.
+    """
+    encoded = np.frombuffer(data, dtype=np.uint8)
+    if not len(encoded):
+        return np.empty(0, dtype=np.uint64)
+
+    ends = np.flatnonzero(encoded < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    groups = np.arange(len(encoded)) - np.repeat(starts, ends - starts + 1)
+    parts = (encoded & 0x7F).astype(np.uint64) << (7 * groups).astype(np.uint64)
+    return np.cumsum(np.add.reduceat(parts, starts), dtype=np.uint64)
+
+
+class PTMIndexBuilder:
+    """
+    Collect the locations of the ptms while scanning the files, then write the index.
+    """
+
+    def __init__(self, file_paths: list):
+        self.file_paths = [str(file_path) for file_path in file_paths]
+        # (amino_acid, glycan_mass) -> packed locations
+        self.locations: dict[tuple[str, str], array] = {}
+
+    def add(self, ptm: tuple[str, str], file_id: int, row_index: int) -> None:
+        locations = self.locations.get(ptm)
+        if locations is None:
+            locations = self.locations[ptm] = array("Q")
+        locations.append((file_id << ROW_INDEX_BITS) | row_index)
+
+    def write(self, index_dir: str | Path) -> Path:
+        """
+        Write the index into `index_dir` (an existing index is replaced).
+        """
+        index_dir = Path(get_or_create_folder(index_dir))
+        ptms = []
+        offset = 0
+        with open(index_dir / "postings.bin", "wb") as file:
+            for (amino_acid, glycan_mass), locations in sorted(self.locations.items()):
+                data = encode_postings(np.frombuffer(locations, dtype=np.uint64))
+                file.write(data)
+                ptms.append(
+                    {
+                        "amino_acid": amino_acid,
+                        "glycan_mass": glycan_mass,
+                        "rows_count": len(np.unique(locations)),
+                        "offset": offset,
+                        "size": len(data),
+                    }
+                )
+                offset += len(data)
+
+        metadata = {
+            "files": [
+                {"path": path, "fingerprint": get_file_fingerprint(path)}
+                for path in self.file_paths
+            ],
+            "ptms": ptms,
+        }
+        (index_dir / "index.json").write_text(json.dumps(metadata))
+        logger.info(
+            f"Wrote the index of {len(ptms)} ptms over {len(self.file_paths)} files into {index_dir} ({offset} bytes of postings)"
+        )
+        return index_dir
+
+
+class PTMIndex:
+    """
+    Read only access to an index written by `PTMIndexBuilder`.
+    """
+
+    def __init__(self, index_dir: str | Path):
+        self.index_dir = Path(index_dir)
+        metadata = json.loads((self.index_dir / "index.json").read_text())
+        self.files = metadata["files"]
+        self._ptms = {
+            (ptm["amino_acid"], ptm["glycan_mass"]): ptm for ptm in metadata["ptms"]
+        }
+
+    def __contains__(self, ptm: tuple[str, str]) -> bool:
+        return ptm in self._ptms
+
+    def ptms_df(self) -> pd.DataFrame:
+        """
+        Returns the indexed ptms with the number of rows carrying them, most
+        frequent first.
+        """
+        return (
+            pd.DataFrame(
+                list(self._ptms.values()),
+                columns=["amino_acid", "glycan_mass", "rows_count"],
+            )
+            .sort_values("rows_count", ascending=False, kind="stable")
+            .reset_index(drop=True)
+        )
+
+    def get_locations(self, amino_acid: str, glycan_mass: str | int) -> pd.DataFrame:
+        """
+        Returns the locations of the rows carrying a ptm, with the columns
+        (file_path, row_index), sorted by file and row.
+        """
+        ptm = self._ptms.get((amino_acid, str(glycan_mass)))
+        if ptm is None:
+            raise KeyError(f"The ptm {amino_acid}[{glycan_mass}] is not indexed")
+
+        with open(self.index_dir / "postings.bin", "rb") as file:
+            file.seek(ptm["offset"])
+            locations = decode_postings(file.read(ptm["size"]))
+
+        file_ids = (locations >> np.uint64(ROW_INDEX_BITS)).astype(np.int64)
+        row_indices = (locations & np.uint64((1 << ROW_INDEX_BITS) - 1)).astype(
+            np.int64
+        )
+        return pd.DataFrame(
+            {
+                "file_path": (
+                    np.array([f["path"] for f in self.files])[file_ids]
+                    if len(file_ids)
+                    else np.array([], dtype=object)
+                ),
+                "row_index": row_indices,
+            }
+        )
+
+    def get_rows(
+        self,
+        amino_acid: str,
+        glycan_mass: str | int,
+        limit: int | None = None,
+        columns: list[str] | None = None,
+    ) -> pd.DataFrame:
+        """
+        Read the rows carrying a ptm from the memory-mapped files (see
+        `common.utils.read_data_rows`).
+
+        Args:
+            amino_acid (str): The amino acid of the ptm.
+            glycan_mass (str | int): The glycan mass of the ptm.
+            limit (int, optional): The maximum number of rows to read, the first ones
+                in the files order. Default to all of them.
+            columns (list, optional): The columns to read. Default to all of them.
+
+        Returns:
+            pd.DataFrame: The rows, with their file_path and row_index.
+        """
+        locations_df = self.get_locations(amino_acid, glycan_mass).iloc[:limit]
+        fingerprints = {f["path"]: f["fingerprint"] for f in self.files}
+
+        rows_dfs = []
+        for file_path, file_locations_df in locations_df.groupby(
+            "file_path", sort=False
+        ):
+            if get_file_fingerprint(file_path) != fingerprints[file_path]:
+                logger.warning(f"{file_path} changed since it has been indexed")
+            rows_df = read_data_rows(
+                file_path, file_locations_df["row_index"], columns=columns
+            ).to_pandas()
+            rows_df.insert(0, "file_path", file_path)
+            rows_df.insert(1, "row_index", file_locations_df["row_index"].to_numpy())
+            rows_dfs.append(rows_df)
+
+        if not rows_dfs:
+            return pd.DataFrame(columns=["file_path", "row_index", *(columns or [])])
+        return pd.concat(rows_dfs, ignore_index=True)
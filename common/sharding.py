@@ -0,0 +1,371 @@
+"""
+File-based work queue to shard a computation over any number of worker processes,
+on one node or on several nodes sharing a filesystem.
+
+The queue is a directory holding:
+    - queue.json: the stage to run, its options and its task ids. A queue directory
+      holds a single submission.
+    - tasks/<task_id>.json: one task per input file, identified by the stage, its
+      options, the file and its fingerprint.
+    - leases/<task_id>.lease: the lease of the worker processing a task. It is
+      created atomically (O_CREAT | O_EXCL), renewed while the task runs, and taken
+      over by another worker once expired (e.g. if its worker died). Only the worker
+      holding a lease renews or releases it.
+    - attempts/<task_id>.<uuid>: one file per failed attempt of a task (its task
+      raised or its lease expired), so that the attempts are counted atomically.
+    - results/<task_id>.pkl: the partial result of a done task, written atomically.
+    - failed/<task_id>.json: the tasks given up after `max_attempts` failed attempts.
+"""
+
+import os
+import json
+import time
+import uuid
+import pickle
+import random
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomically(path: Path, data: bytes) -> None:
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class WorkQueue:
+    """
+    File-based work queue with expiring leases (see the module docstring).
+    """
+
+    def __init__(
+        self, queue_dir: str | Path, lease_seconds: float = 600, max_attempts: int = 3
+    ):
+        self.queue_dir = Path(queue_dir)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for name in ("tasks", "leases", "attempts", "results", "failed"):
+            (self.queue_dir / name).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def get_task_id(
+        payload: str, stage: str, options: dict | None = None, fingerprint: str = ""
+    ) -> str:
+        key = json.dumps([stage, options or {}, payload, fingerprint], sort_keys=True)
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def submit(
+        self,
+        payloads: Iterable[str],
+        stage: str,
+        options: dict | None = None,
+        get_fingerprint: Callable[[str], str] | None = None,
+    ):
+        """
+        Add tasks to the queue. Submitting the same tasks again is a no-op (e.g. to
+        resume a queue), but a queue directory holds a single submission, so that
+        the results of different stages, options or input files are never mixed.
+
+        Args:
+            payloads (Iterable): The payload (e.g. an input file path) of each task.
+            stage (str): The name of the stage the workers run on the tasks.
+            options (dict, optional): The options of the stage.
+            get_fingerprint (Callable, optional): Returns the fingerprint of a
+                payload (e.g. of the input file), part of the task id so that a
+                changed input is a new task.
+
+        Raises:
+            ValueError: If the queue directory holds another submission.
+        """
+        options = options or {}
+        tasks = {
+            self.get_task_id(
+                payload,
+                stage,
+                options,
+                get_fingerprint(payload) if get_fingerprint is not None else "",
+            ): payload
+            for payload in payloads
+        }
+        # Round trip through JSON to compare with the stored metadata
+        metadata = json.loads(
+            json.dumps({"stage": stage, "options": options, "task_ids": sorted(tasks)})
+        )
+        metadata_path = self.queue_dir / "queue.json"
+        if metadata_path.exists() and self.get_metadata() != metadata:
+            raise ValueError(
+                f"The queue {self.queue_dir} holds another submission (another stage, other options or other input files), use another queue directory"
+            )
+        write_atomically(metadata_path, json.dumps(metadata).encode())
+        for task_id, payload in tasks.items():
+            path = self.queue_dir / "tasks" / f"{task_id}.json"
+            if not path.exists():
+                write_atomically(path, json.dumps({"payload": payload}).encode())
+
+    def get_metadata(self) -> dict:
+        return json.loads((self.queue_dir / "queue.json").read_text())
+
+    def get_task_ids(self) -> list[str]:
+        return sorted(path.stem for path in (self.queue_dir / "tasks").glob("*.json"))
+
+    def get_payload(self, task_id: str) -> str:
+        path = self.queue_dir / "tasks" / f"{task_id}.json"
+        return json.loads(path.read_text())["payload"]
+
+    def _get_lease_path(self, task_id: str) -> Path:
+        return self.queue_dir / "leases" / f"{task_id}.lease"
+
+    def is_done(self, task_id: str) -> bool:
+        return (self.queue_dir / "results" / f"{task_id}.pkl").exists()
+
+    def is_failed(self, task_id: str) -> bool:
+        return (self.queue_dir / "failed" / f"{task_id}.json").exists()
+
+    def get_attempts_count(self, task_id: str) -> int:
+        """
+        Returns the number of failed attempts of a task.
+        """
+        return sum(1 for _ in (self.queue_dir / "attempts").glob(f"{task_id}.*"))
+
+    def _record_attempt(self, task_id: str, error: str) -> int:
+        """
+        Record a failed attempt of a task, giving the task up once it has failed
+        `max_attempts` times.
+
+        Returns:
+            int: The number of failed attempts of the task.
+        """
+        (self.queue_dir / "attempts" / f"{task_id}.{uuid.uuid4().hex}").write_text(
+            error
+        )
+        attempts_count = self.get_attempts_count(task_id)
+        if attempts_count >= self.max_attempts and not self.is_failed(task_id):
+            write_atomically(
+                self.queue_dir / "failed" / f"{task_id}.json",
+                json.dumps({"attempts": attempts_count, "error": error}).encode(),
+            )
+            logger.error(
+                f"Giving up the task {task_id} after {attempts_count} attempts: {error}"
+            )
+        return attempts_count
+
+    def _create_lease(self, task_id: str, worker_id: str) -> bool:
+        try:
+            file_descriptor = os.open(
+                self._get_lease_path(task_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY
+            )
+        except FileExistsError:
+            return False
+        with os.fdopen(file_descriptor, "w") as file:
+            json.dump({"worker_id": worker_id}, file)
+        return True
+
+    def _holds_lease(self, task_id: str, worker_id: str) -> bool:
+        try:
+            lease = json.loads(self._get_lease_path(task_id).read_text())
+        except (FileNotFoundError, ValueError):
+            # A lease being written is held by the worker creating it
+            return False
+        return lease.get("worker_id") == worker_id
+
+    def _take_over_expired_lease(self, task_id: str) -> bool:
+        """
+        Remove the lease of a task if it has expired, recording the expired attempt.
+
+        Returns:
+            bool: Whether the lease expired and was removed by this call (False if
+            another worker took it over first).
+        """
+        lease_path = self._get_lease_path(task_id)
+        try:
+            if time.time() - lease_path.stat().st_mtime < self.lease_seconds:
+                return False
+            # Only one worker can rename the lease, the others get a FileNotFoundError
+            tombstone_path = lease_path.with_suffix(f".expired-{uuid.uuid4().hex}")
+            os.rename(lease_path, tombstone_path)
+        except FileNotFoundError:
+            return False
+
+        # Another worker may have taken the lease over and recreated it between the
+        # expiry check and the rename, in which case it is put back
+        if time.time() - tombstone_path.stat().st_mtime < self.lease_seconds:
+            try:
+                os.link(tombstone_path, lease_path)
+            except FileExistsError:
+                pass
+            tombstone_path.unlink()
+            return False
+
+        tombstone_path.unlink()
+        attempts_count = self._record_attempt(task_id, "lease expired")
+        logger.warning(
+            f"The lease of the task {task_id} expired ({attempts_count} failed attempt(s))"
+        )
+        return True
+
+    def claim(self, worker_id: str) -> str | None:
+        """
+        Claim a pending task, or an expired one.
+
+        Returns:
+            str | None: The claimed task id, None if there is no task left to claim.
+        """
+        task_ids = self.get_task_ids()
+        # Random order to limit the contention between the workers
+        random.shuffle(task_ids)
+
+        for task_id in task_ids:
+            if self.is_done(task_id) or self.is_failed(task_id):
+                continue
+            if not self._create_lease(task_id, worker_id):
+                # The failed attempts are counted apart from the leases, so a lease
+                # created by another worker in the meantime does not reset them
+                if not self._take_over_expired_lease(task_id) or self.is_failed(
+                    task_id
+                ):
+                    continue
+                if not self._create_lease(task_id, worker_id):
+                    continue
+            if self.is_done(task_id) or self.is_failed(task_id):
+                # Completed (or given up) between the check and the lease creation
+                self.release(task_id, worker_id)
+                continue
+            return task_id
+
+        return None
+
+    def renew(self, task_id: str, worker_id: str) -> bool:
+        """
+        Renew the lease of a task held by a worker.
+
+        Returns:
+            bool: Whether the worker still holds the lease.
+        """
+        if not self._holds_lease(task_id, worker_id):
+            return False
+        os.utime(self._get_lease_path(task_id))
+        return True
+
+    def release(self, task_id: str, worker_id: str) -> None:
+        if self._holds_lease(task_id, worker_id):
+            self._get_lease_path(task_id).unlink(missing_ok=True)
+
+    def complete(self, task_id: str, worker_id: str, result: Any) -> None:
+        write_atomically(
+            self.queue_dir / "results" / f"{task_id}.pkl",
+            pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+        self.release(task_id, worker_id)
+
+    def fail(self, task_id: str, worker_id: str, error: str) -> None:
+        """
+        Record a failed attempt of a task (its task raised) and release its lease,
+        so that it is retried by any worker until it failed `max_attempts` times.
+        """
+        if self._holds_lease(task_id, worker_id):
+            self._record_attempt(task_id, error)
+            self.release(task_id, worker_id)
+
+    def get_results(self) -> dict[str, Any]:
+        """
+        Returns the partial results of the done tasks mapped to their task ids.
+        """
+        results = {}
+        for path in sorted((self.queue_dir / "results").glob("*.pkl")):
+            with open(path, "rb") as file:
+                results[path.stem] = pickle.load(file)
+        return results
+
+    def get_status(self) -> dict[str, int]:
+        task_ids = self.get_task_ids()
+        done = sum(map(self.is_done, task_ids))
+        failed = sum(map(self.is_failed, task_ids))
+        return {
+            "tasks": len(task_ids),
+            "done": done,
+            "failed": failed,
+            "pending": len(task_ids) - done - failed,
+        }
+
+
+def run_worker(
+    queue: WorkQueue,
+    task_func: Callable[[str], Any],
+    worker_id: str | None = None,
+    poll_seconds: float = 5,
+) -> int:
+    """
+    Process the tasks of a queue until none is left (done or failed).
+
+    The lease of the running task is renewed in the background, and the worker
+    waits for the tasks leased by other workers, which may expire. A task raising
+    an exception is released to be retried, and given up after `max_attempts`.
+
+    Args:
+        queue (WorkQueue): The queue.
+        task_func (Callable): Returns the partial result of a task from its payload.
+        worker_id (str, optional): The id of the worker. Default to a unique id.
+        poll_seconds (float): The waiting time before claiming again a task leased
+            by another worker. Default to 5.
+
+    Returns:
+        int: The number of tasks processed by the worker.
+    """
+    worker_id = worker_id or get_worker_id()
+    processed_count = 0
+
+    while True:
+        task_id = queue.claim(worker_id)
+        if task_id is None:
+            if queue.get_status()["pending"] == 0:
+                break
+            # Other workers hold the remaining tasks
+            time.sleep(poll_seconds)
+            continue
+
+        payload = queue.get_payload(task_id)
+        logger.info(f"Worker {worker_id} processing the task {task_id} ({payload})")
+
+        stop_renewing = threading.Event()
+
+        def renew_lease():
+            while not stop_renewing.wait(queue.lease_seconds / 3):
+                if not queue.renew(task_id, worker_id):
+                    logger.warning(f"Worker {worker_id} lost the lease of {task_id}")
+                    break
+
+        renewer = threading.Thread(target=renew_lease, daemon=True)
+        renewer.start()
+        try:
+            result = task_func(payload)
+        except Exception as error:
+            logger.exception(f"Worker {worker_id} failed the task {task_id}")
+            queue.fail(task_id, worker_id, repr(error))
+            continue
+        finally:
+            stop_renewing.set()
+            renewer.join()
+
+        queue.complete(task_id, worker_id, result)
+        processed_count += 1
+
+    logger.info(f"Worker {worker_id} stops after processing {processed_count} tasks")
+    return processed_count
@@ -0,0 +1,175 @@
+"""
+Vectorized helpers to work on spectra stored as list columns (e.g. mz and intensity).
+
+A list column of n spectra is handled as a flat buffer of all the peaks and an
+offsets array of n + 1 items, so that the peaks of the spectrum i are
+values[offsets[i]:offsets[i + 1]]. Working on these buffers with numpy segment
+operations avoids any python loop over the rows.
+"""
+
+import numpy as np
+import pyarrow as pa
+
+
+def flatten_list_column(
+    column: pa.Array | pa.ChunkedArray, dtype=np.float64
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Flatten a list column into its values and offsets (null lists are empty).
+
+    Args:
+        column (pa.Array | pa.ChunkedArray): The list column.
+        dtype: The dtype of the returned values. Default to np.float64.
+
+    Returns:
+        tuple: The values and the offsets (of length len(column) + 1) arrays.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if column.null_count:
+        column = column.fill_null(pa.scalar([], type=column.type))
+
+    # The offsets of a sliced array do not start at 0
+    offsets = column.offsets.to_numpy().astype(np.int64)
+    offsets -= offsets[0]
+    values = column.flatten().to_numpy(zero_copy_only=False).astype(dtype, copy=False)
+    return values, offsets
+
+
+def flatten_peaks(
+    mz_column: pa.Array | pa.ChunkedArray,
+    intensity_column: pa.Array | pa.ChunkedArray,
+    dtype=np.float64,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Flatten the mz and intensity list columns of the same spectra. The peaks of a
+    spectrum whose mz and intensity lists have different lengths can not be paired,
+    so the spectrum is emptied (and flagged).
+
+    Returns:
+        tuple: The mz values, the intensity values, their offsets and the mask of
+        the spectra whose mz and intensity lists have different lengths.
+    """
+    mz, offsets = flatten_list_column(mz_column, dtype)
+    intensity, intensity_offsets = flatten_list_column(intensity_column, dtype)
+    lengths, intensity_lengths = np.diff(offsets), np.diff(intensity_offsets)
+    mismatched = lengths != intensity_lengths
+    if mismatched.any():
+        mz = mz[np.repeat(~mismatched, lengths)]
+        intensity = intensity[np.repeat(~mismatched, intensity_lengths)]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(np.where(mismatched, 0, lengths), out=offsets[1:])
+    return mz, intensity, offsets, mismatched
+
+
+def get_segment_ids(offsets: np.ndarray) -> np.ndarray:
+    """
+    Returns the index of the spectrum (segment) of each peak.
+    """
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def get_offsets(segment_ids: np.ndarray, segments_count: int) -> np.ndarray:
+    """
+    Returns the offsets of sorted segment ids (the inverse of `get_segment_ids`).
+    """
+    offsets = np.zeros(segments_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(segment_ids, minlength=segments_count), out=offsets[1:])
+    return offsets
+
+
+def segment_sum(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Sum the values of each segment (empty segments sum to 0).
+    """
+    return np.bincount(
+        get_segment_ids(offsets), weights=values, minlength=len(offsets) - 1
+    )
+
+
+def segment_max(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Returns the maximum value of each segment (0 for the empty segments).
+    """
+    lengths = np.diff(offsets)
+    result = np.zeros(len(lengths), dtype=values.dtype)
+    non_empty = lengths > 0
+    if non_empty.any():
+        # reduceat does not handle empty segments, so only their starts are used
+        result[non_empty] = np.maximum.reduceat(values, offsets[:-1][non_empty])
+    return result
+
+
+def top_k_mask(values: np.ndarray, offsets: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns the mask of the k highest values of each segment.
+    """
+    segment_ids = get_segment_ids(offsets)
+    # Sorted by segment, then by decreasing value (the sort is stable)
+    order = np.lexsort((-values, segment_ids))
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[order] = np.arange(len(values)) - offsets[segment_ids[order]]
+    return ranks < k
+
+
+def preprocess_spectra(
+    mz: np.ndarray,
+    intensity: np.ndarray,
+    offsets: np.ndarray,
+    precursor_mz: np.ndarray,
+    scale_factor: np.ndarray | None = None,
+    min_mz: float = 50.0,
+    max_mz: float = 2500.0,
+    precursor_tolerance: float = 2.0,
+    top_k: int = 200,
+    min_relative_intensity: float = 0.0,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Clean flattened spectra for the model input, all the spectra at once:
+
+    1. Keep the peaks within [min_mz, max_mz] having a positive intensity.
+    2. Remove the peaks within `precursor_tolerance` (Da) of the precursor m/z (no
+       peak is removed for the spectra whose precursor m/z is missing i.e. NaN).
+    3. Keep the `top_k` most intense peaks (their m/z order is kept).
+    4. Normalize the intensities by the base (most intense) peak, drop the peaks
+       below `min_relative_intensity` and apply the `scale_factor` of each spectrum
+       (applying it before the normalization would cancel it out).
+
+    Args:
+        mz (np.ndarray): The flattened m/z of the peaks.
+        intensity (np.ndarray): The flattened intensities of the peaks.
+        offsets (np.ndarray): The offsets of the spectra in the flattened arrays.
+        precursor_mz (np.ndarray): The precursor m/z of each spectrum, NaN if missing.
+        scale_factor (np.ndarray, optional): The intensity scale factor of each spectrum.
+
+    Returns:
+        tuple: The m/z, intensities and offsets of the preprocessed spectra.
+    """
+    spectra_count = len(offsets) - 1
+    segment_ids = get_segment_ids(offsets)
+
+    keep = (
+        (mz >= min_mz)
+        & (mz <= max_mz)
+        & (intensity > 0)
+        # Comparisons with a NaN precursor are False, hence the negated condition
+        & ~(np.abs(mz - precursor_mz[segment_ids]) <= precursor_tolerance)
+    )
+    mz, intensity, segment_ids = mz[keep], intensity[keep], segment_ids[keep]
+    offsets = get_offsets(segment_ids, spectra_count)
+
+    keep = top_k_mask(intensity, offsets, top_k)
+    mz, intensity, segment_ids = mz[keep], intensity[keep], segment_ids[keep]
+    offsets = get_offsets(segment_ids, spectra_count)
+
+    intensity = intensity / segment_max(intensity, offsets)[segment_ids]
+
+    if min_relative_intensity > 0:
+        keep = intensity >= min_relative_intensity
+        mz, intensity, segment_ids = mz[keep], intensity[keep], segment_ids[keep]
+        offsets = get_offsets(segment_ids, spectra_count)
+
+    if scale_factor is not None:
+        intensity = intensity * scale_factor[segment_ids]
+
+    return mz, intensity, offsets
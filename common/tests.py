@@ -0,0 +1,385 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from common.cache import ResultCache
+from common.ptms_index import decode_postings, encode_postings
+from common.validation import validate_record_batch, validate_schema
+from common.spectra import (
+    flatten_list_column,
+    flatten_peaks,
+    segment_max,
+    segment_sum,
+    top_k_mask,
+)
+from common.utils import (
+    collect_files,
+    get_data_file_format,
+    get_memory_size,
+    iter_data_batches,
+    load_ipc_files,
+    prefetch_ipc_files,
+    read_data_file,
+    read_data_rows,
+)
+
+
+class TestPrefetchIPCFiles(unittest.TestCase):
+    def setUp(self):
+        """
+        Set up the test environment before each test.
+        """
+
+        # Create a temporary directory with some IPC files
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.files = []
+        for i in range(6):
+            path = self.temp_dir / f"file{i}.ipc"
+            pd.DataFrame({"index": range(i * 10, (i + 1) * 10)}).to_feather(path)
+            self.files.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _get_tracking_reader(self):
+        """
+        Returns a reader recording the maximum number of files read ahead.
+        """
+        state = {"in_flight": 0, "max_in_flight": 0}
+        lock = threading.Lock()
+
+        def reader(file_path):
+            with lock:
+                state["in_flight"] += 1
+                state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            return pd.read_feather(file_path)
+
+        def consumed():
+            with lock:
+                state["in_flight"] -= 1
+
+        return reader, consumed, state
+
+    def test_prefetch_ipc_files_keeps_order(self):
+        """
+        Test that the files are yielded in order and loaded as without prefetching.
+        """
+        prefetched = list(prefetch_ipc_files(self.files, depth=3))
+
+        self.assertEqual([file_path for file_path, _ in prefetched], self.files)
+        pd.testing.assert_frame_equal(
+            load_ipc_files(self.files),
+            pd.concat([pd.read_feather(f) for f in self.files], ignore_index=True),
+        )
+
+    def test_prefetch_ipc_files_respects_depth_and_memory(self):
+        """
+        Test that no more than `depth` files are read ahead, and that the file being
+        processed and the files read ahead fit in `max_memory_bytes`.
+        """
+        memory_size = get_memory_size(pd.read_feather(self.files[0]))
+        # The reads in progress are counted with their size on disk
+        disk_size = self.files[0].stat().st_size
+        for depth, max_memory_bytes, expected in (
+            (3, None, 3),
+            (4, memory_size + min(memory_size, disk_size), 2),
+            (4, 1, 1),
+        ):
+            reader, consumed, state = self._get_tracking_reader()
+            for _ in prefetch_ipc_files(
+                self.files,
+                depth=depth,
+                max_memory_bytes=max_memory_bytes,
+                reader=reader,
+            ):
+                consumed()
+            self.assertLessEqual(state["max_in_flight"], expected)
+
+    def test_prefetch_ipc_files_propagates_errors(self):
+        """
+        Test that a reading error is raised when the faulty file is reached.
+        """
+        files = [*self.files[:2], self.temp_dir / "corrupted.ipc"]
+        files[-1].write_bytes(b"not an ipc file")
+
+        prefetched = prefetch_ipc_files(files)
+        self.assertEqual(next(prefetched)[0], files[0])
+        self.assertEqual(next(prefetched)[0], files[1])
+        with self.assertRaises(Exception):
+            next(prefetched)
+
+
+class TestDataFiles(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.df = pd.DataFrame(
+            {
+                "modified_peptide": ["PEPTN[123]IDE", "ANOTHER"],
+                "mz": [[100.0, 200.0], [300.0]],
+            }
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_collect_files(self):
+        """
+        Test that collect_files handles empty directories and several extensions.
+        """
+        self.assertEqual(collect_files(self.temp_dir), [])
+
+        (self.temp_dir / "PROJECT1").mkdir()
+        ipc_path = self.temp_dir / "PROJECT1" / "file1.ipc"
+        parquet_path = self.temp_dir / "PROJECT1" / "file2.parquet"
+        self.df.to_feather(ipc_path)
+        self.df.to_parquet(parquet_path)
+
+        (self.temp_dir / "PROJECT1" / "notes.csv").write_text("not a data file")
+
+        # Every data file format is collected by default
+        self.assertEqual(
+            collect_files(self.temp_dir), [str(ipc_path), str(parquet_path)]
+        )
+        self.assertEqual(collect_files(self.temp_dir, ext="ipc"), [str(ipc_path)])
+        self.assertEqual(collect_files(str(parquet_path)), [str(parquet_path)])
+        with self.assertRaises(ValueError):
+            collect_files(str(parquet_path), ext="ipc")
+
+    def test_read_data_file_detects_the_format(self):
+        """
+        Test that read_data_file loads every supported format to the same DataFrame.
+        """
+        paths = {
+            "arrow_file": self.temp_dir / "file.ipc",
+            "parquet": self.temp_dir / "file.parquet",
+            # A misleading extension should not matter
+            "arrow_stream": self.temp_dir / "stream.ipc",
+        }
+        self.df.to_feather(paths["arrow_file"], compression="zstd")
+        self.df.to_parquet(paths["parquet"])
+        table = pa.Table.from_pandas(self.df)
+        with ipc.new_stream(str(paths["arrow_stream"]), table.schema) as writer:
+            writer.write_table(table)
+
+        for file_format, path in paths.items():
+            self.assertEqual(get_data_file_format(path), file_format)
+            result = read_data_file(path)
+            self.assertEqual(
+                result.modified_peptide.tolist(), self.df.modified_peptide.tolist()
+            )
+            self.assertEqual([list(mz) for mz in result.mz], self.df.mz.tolist())
+
+    def test_read_data_rows(self):
+        """
+        Test that read_data_rows reads the rows in the given order whatever the format.
+        """
+        df = pd.DataFrame({"index": range(10), "mz": [[float(i)] for i in range(10)]})
+        ipc_path, parquet_path = (
+            self.temp_dir / "file.ipc",
+            self.temp_dir / "file.parquet",
+        )
+        # Several record batches
+        df.to_feather(ipc_path, chunksize=3)
+        df.to_parquet(parquet_path)
+
+        for path in (ipc_path, parquet_path):
+            result = read_data_rows(path, [7, 1, 8], columns=["index"]).to_pandas()
+            self.assertEqual(result["index"].tolist(), [7, 1, 8])
+            self.assertEqual(list(result.columns), ["index"])
+            self.assertEqual(read_data_rows(path, []).num_rows, 0)
+
+    def test_iter_data_batches(self):
+        """
+        Test that the batches of a file hold its rows, whatever the format.
+        """
+        df = pd.DataFrame({"index": range(10), "mz": [[float(i)] for i in range(10)]})
+        ipc_path, parquet_path = (
+            self.temp_dir / "file.ipc",
+            self.temp_dir / "file.parquet",
+        )
+        df.to_feather(ipc_path, chunksize=6)
+        df.to_parquet(parquet_path)
+
+        for path in (ipc_path, parquet_path):
+            batches = list(iter_data_batches(path, batch_size=4, columns=["index"]))
+            self.assertTrue(all(batch.num_rows <= 4 for batch in batches))
+            self.assertEqual(
+                pa.Table.from_batches(batches)["index"].to_pylist(), list(range(10))
+            )
+
+
+class TestSpectra(unittest.TestCase):
+    def test_segment_operations(self):
+        """
+        Test the segment operations on a sliced list column having empty and null lists.
+        """
+        column = pa.array([[9.0], [1.0, 3.0, 2.0], [], None, [5.0, 4.0]]).slice(1)
+        values, offsets = flatten_list_column(column)
+
+        self.assertEqual(values.tolist(), [1.0, 3.0, 2.0, 5.0, 4.0])
+        self.assertEqual(offsets.tolist(), [0, 3, 3, 3, 5])
+        self.assertEqual(segment_sum(values, offsets).tolist(), [6.0, 0.0, 0.0, 9.0])
+        self.assertEqual(segment_max(values, offsets).tolist(), [3.0, 0.0, 0.0, 5.0])
+        self.assertEqual(
+            values[top_k_mask(values, offsets, 2)].tolist(), [3.0, 2.0, 5.0, 4.0]
+        )
+
+    def test_flatten_peaks(self):
+        """
+        Test that the spectra whose mz and intensity lengths differ are emptied,
+        without shifting the peaks of the next spectra.
+        """
+        mz, intensity, offsets, mismatched = flatten_peaks(
+            pa.array([[100.0, 200.0], [300.0], [400.0]]),
+            pa.array([[1.0], [1.0, 2.0], [3.0]]),
+        )
+        self.assertEqual(mismatched.tolist(), [True, True, False])
+        self.assertEqual(mz.tolist(), [400.0])
+        self.assertEqual(intensity.tolist(), [3.0])
+        self.assertEqual(offsets.tolist(), [0, 0, 0, 1])
+
+
+class TestPTMIndex(unittest.TestCase):
+    def test_postings_round_trip(self):
+        """
+        Test that the posting lists decode to the sorted distinct locations.
+        """
+        locations = np.array(
+            [(3 << 32) | 5, 1, 2, 2, (1 << 32) - 1, 1 << 63], dtype=np.uint64
+        )
+        encoded = encode_postings(locations)
+        np.testing.assert_array_equal(decode_postings(encoded), np.unique(locations))
+        # Small gaps take a byte each
+        self.assertEqual(len(encode_postings(np.arange(100))), 100)
+        self.assertEqual(len(decode_postings(encode_postings([]))), 0)
+
+
+class TestValidation(unittest.TestCase):
+    def test_validate_record_batch(self):
+        """
+        Test that every row gets the names of its failed checks.
+        """
+        batch = pa.RecordBatch.from_pandas(
+            pd.DataFrame(
+                {
+                    "precursor_charge": [2.0, 3.5, 0.0, 2.0, 2.0],
+                    "precursor_mz": [500.0, 500.0, 500.0, 500.0, np.inf],
+                    "mz": [[1.0, 2.0], [2.0, 1.0], [], [1.0, np.nan], [1.0, 2.0]],
+                    "intensity": [[1.0, 1.0], [1.0, 1.0], [], [1.0, 1.0], [1.0]],
+                    "modified_peptide": [
+                        "[42]PEPn[123]K",
+                        "PEP[]K",
+                        None,
+                        "M[+15.9]K",
+                        "AK",
+                    ],
+                }
+            ),
+            preserve_index=False,
+        )
+
+        self.assertEqual(
+            validate_record_batch(batch).to_pylist(),
+            [
+                [],
+                ["unsorted_mz", "invalid_charge", "malformed_modified_peptide"],
+                ["empty_peaks", "invalid_charge", "missing_modified_peptide"],
+                ["non_finite_mz", "malformed_modified_peptide"],
+                ["peaks_length_mismatch", "non_finite_precursor_mz"],
+            ],
+        )
+        schema_problems = validate_schema(batch.schema)
+        self.assertIn("precursor_charge is double, expected integer", schema_problems)
+        self.assertIn("missing column protein", schema_problems)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.cache = ResultCache(self.temp_dir / "cache")
+        self.file_path = self.temp_dir / "file1.ipc"
+        self.file_path.write_bytes(b"data")
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _get_cached_function(self):
+        @self.cache.memoize(files=[self.file_path])
+        def compute(column, factor=1):
+            self.calls.append((column, factor))
+            return pd.Series([1, 2, 3], name=column) * factor
+
+        return compute
+
+    def test_memoize(self):
+        """
+        Test that results are cached per arguments and input files fingerprints.
+        """
+        compute = self._get_cached_function()
+
+        pd.testing.assert_series_equal(compute("mz"), pd.Series([1, 2, 3], name="mz"))
+        compute("mz")
+        compute("mz", factor=2)
+        self.assertEqual(self.calls, [("mz", 1), ("mz", 2)])
+
+        # Changing the input file invalidates the results
+        self.file_path.write_bytes(b"other data")
+        compute("mz")
+        self.assertEqual(len(self.calls), 3)
+
+        # The results of the previous fingerprint are dropped too
+        self.assertEqual(compute.invalidate(), 3)
+        compute("mz")
+        self.assertEqual(len(self.calls), 4)
+
+    def test_memoize_files_argument(self):
+        """
+        Test that the input files passed as an argument are fingerprinted.
+        """
+
+        @self.cache.memoize(files_arg="file_paths")
+        def count_bytes(file_paths):
+            self.calls.append(file_paths)
+            return sum(Path(file_path).stat().st_size for file_path in file_paths)
+
+        self.assertEqual(count_bytes([self.file_path]), 4)
+        self.assertEqual(count_bytes([self.file_path]), 4)
+        self.file_path.write_bytes(b"other data")
+        self.assertEqual(count_bytes([self.file_path]), 10)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_eviction(self):
+        """
+        Test that the least recently used results are evicted first.
+        """
+        for key in ("a", "b", "c"):
+            self.cache.set(key, b"x" * 1000)
+        # "a" becomes the most recently used one
+        os.utime(self.cache._get_path("a"), ns=(2**62, 2**62))
+        self.cache.max_bytes = 2500
+        self.cache.set("d", b"x" * 1000)
+
+        self.assertEqual(
+            [key in self.cache for key in "abcd"], [True, False, False, True]
+        )
+        self.assertEqual(self.cache.get("b", "missing"), "missing")
+
+    def test_get_evicted_while_loading(self):
+        """
+        Test that a result evicted between its loading and its use mark is a hit.
+        """
+        self.cache.set("a", 1)
+        with mock.patch("common.cache.os.utime", side_effect=FileNotFoundError):
+            self.assertEqual(self.cache.get("a", "missing"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,43 +1,328 @@
 import os
 import glob
+import itertools
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 from pathlib import Path
 from datetime import datetime
+from collections import deque
+from typing import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 
+# Extensions of the data files we know how to load (see `read_data_file`)
+DATA_FILES_EXTENSIONS = ("ipc", "arrow", "feather", "parquet")
 
-def collect_files(location, ext="ipc") -> list[str]:
+
+def collect_files(
+    location, ext: str | tuple[str, ...] = DATA_FILES_EXTENSIONS
+) -> list[str]:
     """
     Get files having from a directory or a single ext file.
 
     Args:
-    location (str): The directory containing IPC files or a single IPC file.
+    location (str): The directory containing data files or a single data file.
+    ext (str | tuple): The extension(s) of the files to collect. Default to the
+        extensions of the data files `read_data_file` loads (e.g. the IPC files and
+        the transcoded Parquet ones).
 
     Returns:
-    list: List of file paths having the specified extension.
+    list: List of file paths having the specified extension, empty if the directory has none.
     """
+    location = str(location)
+    extensions = (ext,) if isinstance(ext, str) else tuple(ext)
+
     if not os.path.exists(location):
         raise FileNotFoundError(f"Location {location} not found")
 
     if os.path.isdir(location):
-        pattern = f"**/*.{ext}"
-        file_paths = glob.glob(os.path.join(location, pattern), recursive=True)
-        assert file_paths, file_paths
-    elif os.path.isfile(location) and location.endswith(".ipc"):
+        file_paths = sorted(
+            itertools.chain.from_iterable(
+                glob.glob(os.path.join(location, f"**/*.{extension}"), recursive=True)
+                for extension in extensions
+            )
+        )
+    elif os.path.isfile(location) and location.endswith(
+        tuple(f".{extension}" for extension in extensions)
+    ):
         file_paths = [location]
     else:
-        raise ValueError(f"Location {location} is neither a directory nor an {ext.upper()} file")
+        raise ValueError(
+            f"Location {location} is neither a directory nor a {'/'.join(extensions).upper()} file"
+        )
 
     return file_paths
 
 
+def get_project_name(file_path: str | Path) -> str:
+    """
+    Default project of a file i.e., the name of its folder.
+    """
+    return Path(file_path).parent.name
+
+
+def get_data_file_format(file_path: str | Path) -> str:
+    """
+    Detect the format of a data file from its magic bytes (its extension may lie).
+
+    Returns:
+        str: One of "arrow_file" (Arrow IPC file format i.e. feather v2),
+        "arrow_stream" (Arrow IPC stream format), "feather_v1" or "parquet".
+    """
+    with open(file_path, "rb") as file:
+        magic = file.read(8)
+
+    if magic.startswith(b"ARROW1"):
+        return "arrow_file"
+    if magic.startswith(b"PAR1"):
+        return "parquet"
+    if magic.startswith(b"FEA1"):
+        return "feather_v1"
+    if magic.startswith(b"\xff\xff\xff\xff"):
+        # Stream messages start with a continuation marker
+        return "arrow_stream"
+    raise ValueError(f"Unknown data file format for {file_path}")
+
+
+def read_data_table(
+    file_path: str | Path, columns: list[str] | None = None
+) -> pa.Table:
+    """
+    Read a data file (Arrow IPC file/stream, feather or parquet) into an Arrow table.
+    """
+    file_format = get_data_file_format(file_path)
+    if file_format == "parquet":
+        return pq.read_table(file_path, columns=columns)
+    if file_format == "arrow_stream":
+        with pa.OSFile(str(file_path), "rb") as source:
+            table = ipc.open_stream(source).read_all()
+        return table.select(columns) if columns is not None else table
+    return feather.read_table(file_path, columns=columns)
+
+
+def read_data_schema(file_path: str | Path) -> pa.Schema:
+    """
+    Read the schema of a data file without reading its data.
+    """
+    file_format = get_data_file_format(file_path)
+    if file_format == "parquet":
+        return pq.read_schema(file_path)
+    if file_format == "arrow_stream":
+        with pa.OSFile(str(file_path), "rb") as source:
+            return ipc.open_stream(source).schema
+    if file_format == "arrow_file":
+        with pa.memory_map(str(file_path), "rb") as source:
+            return ipc.open_file(source).schema
+    return feather.read_table(file_path).schema
+
+
+def iter_data_batches(
+    file_path: str | Path, batch_size: int, columns: list[str] | None = None
+) -> Iterator[pa.RecordBatch]:
+    """
+    Read a data file record batch by record batch, of at most `batch_size` rows,
+    without reading the whole file first (an Arrow IPC file is memory-mapped).
+    """
+    file_format = get_data_file_format(file_path)
+    if file_format == "parquet":
+        yield from pq.ParquetFile(file_path).iter_batches(
+            batch_size=batch_size, columns=columns
+        )
+        return
+    if file_format == "feather_v1":
+        table = read_data_table(file_path, columns=columns)
+        yield from table.to_batches(max_chunksize=batch_size)
+        return
+
+    with pa.memory_map(str(file_path), "rb") as source:
+        if file_format == "arrow_stream":
+            batches = ipc.open_stream(source)
+        else:
+            reader = ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        for batch in batches:
+            if columns is not None:
+                batch = batch.select(columns)
+            for start in range(0, batch.num_rows, batch_size):
+                yield batch.slice(start, batch_size)
+
+
+def read_data_rows(
+    file_path: str | Path, rows, columns: list[str] | None = None
+) -> pa.Table:
+    """
+    Read some rows of a data file, in the given order.
+
+    An Arrow IPC file is memory-mapped, and only the requested columns of the record
+    batches holding the rows are decoded. The other formats are fully read.
+
+    Args:
+        file_path (str | Path): The data file.
+        rows (array-like): The indices of the rows to read.
+        columns (list, optional): The columns to read. Default to all of them.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if get_data_file_format(file_path) != "arrow_file":
+        return read_data_table(file_path, columns=columns).take(rows)
+
+    with pa.memory_map(str(file_path), "rb") as source:
+        schema = ipc.open_file(source).schema
+        columns = schema.names if columns is None else columns
+
+        def open_fields(fields: list[int]) -> ipc.RecordBatchFileReader:
+            return ipc.open_file(
+                source, options=ipc.IpcReadOptions(included_fields=fields)
+            )
+
+        # The rows of each batch are only known by decoding a column of it, the
+        # narrowest one (an empty `included_fields` means all of them)
+        fixed_width_fields = [
+            i
+            for i, field in enumerate(schema)
+            if pa.types.is_integer(field.type) or pa.types.is_floating(field.type)
+        ]
+        counts_reader = open_fields(fixed_width_fields[:1] or [0])
+        batch_starts = np.cumsum(
+            [0]
+            + [
+                counts_reader.get_batch(i).num_rows
+                for i in range(counts_reader.num_record_batches)
+            ]
+        )
+
+        reader = open_fields([schema.get_field_index(column) for column in columns])
+        batch_ids = np.searchsorted(batch_starts, rows, side="right") - 1
+        needed_batch_ids = np.unique(batch_ids)
+        batches = [reader.get_batch(int(i)) for i in needed_batch_ids]
+        table = pa.Table.from_batches(batches, schema=reader.schema)
+        # The positions of the rows in the concatenation of the needed batches
+        needed_starts = np.cumsum([0] + [batch.num_rows for batch in batches])
+        positions = (
+            rows
+            - batch_starts[batch_ids]
+            + needed_starts[np.searchsorted(needed_batch_ids, batch_ids)]
+        )
+        # The taken rows are copied, so they outlive the memory map
+        return table.select(columns).take(positions)
+
+
+def read_data_file(
+    file_path: str | Path, columns: list[str] | None = None
+) -> pd.DataFrame:
+    """
+    Read a data file into a DataFrame whatever its format and compression
+    (see `get_data_file_format`).
+    """
+    file_format = get_data_file_format(file_path)
+    if file_format == "parquet":
+        return pd.read_parquet(file_path, columns=columns)
+    if file_format == "arrow_stream":
+        return read_data_table(file_path, columns=columns).to_pandas()
+    return pd.read_feather(file_path, columns=columns)
+
+
 def get_or_create_folder(path: str | Path) -> str:
     assert path is not None, path
     Path(path).mkdir(parents=True, exist_ok=True)
     return path
 
 
-def load_ipc_files(file_paths):
-    dataframes = [pd.read_feather(file_path) for file_path in file_paths]
+def get_memory_size(data) -> int:
+    """
+    Returns the size in memory of the content of a file (a DataFrame or a table).
+    """
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(deep=True).sum())
+    return int(getattr(data, "nbytes", 0))
+
+
+def prefetch_ipc_files(
+    file_paths: Iterable[str | Path],
+    depth: int = 2,
+    max_memory_bytes: int | None = None,
+    reader: Callable[[str | Path], pd.DataFrame] = read_data_file,
+) -> Iterator[tuple[str | Path, pd.DataFrame]]:
+    """
+    Read IPC files ahead of their processing, so that disk (or network) reads
+    overlap with the processing of the previously read file.
+
+    Up to `depth` files are read in background threads while the caller works
+    on the current one. The files are yielded in the given order, so the results
+    are the same as reading them one after the other.
+
+    Args:
+        file_paths (Iterable): The IPC files to read.
+        depth (int): The maximum number of files read ahead. Default to 2.
+        max_memory_bytes (int, optional): The maximum size in memory of the file
+            being processed and of the files read ahead, their decoded size (see
+            `get_memory_size`) which is usually several times their compressed size
+            on disk. No file is read ahead once it is reached, the reads in progress
+            being counted with their size on disk until they are done, so it can be
+            exceeded by the size of one file. Default to None (no limit).
+        reader (Callable): The function used to read a file. Default to read_data_file.
+
+    Yields:
+        tuple: The file path and its content.
+    """
+    assert depth >= 1, depth
+
+    file_paths = iter(file_paths)
+    # [file_path, size (on disk until read, then in memory), future, read] of the
+    # files being read ahead, in order
+    pending = deque()
+    next_file_path = next(file_paths, None)
+
+    def get_pending_bytes() -> int:
+        for item in pending:
+            _, _, future, read = item
+            if not read and future.done() and future.exception() is None:
+                item[1], item[3] = get_memory_size(future.result()), True
+        return sum(item[1] for item in pending)
+
+    def read_ahead(current_bytes: int) -> None:
+        nonlocal next_file_path
+        while next_file_path is not None and len(pending) < depth:
+            if (
+                max_memory_bytes is not None
+                and (pending or current_bytes)
+                and current_bytes + get_pending_bytes() >= max_memory_bytes
+            ):
+                break
+            pending.append(
+                [
+                    next_file_path,
+                    os.path.getsize(next_file_path),
+                    executor.submit(reader, next_file_path),
+                    False,
+                ]
+            )
+            next_file_path = next(file_paths, None)
+
+    executor = ThreadPoolExecutor(max_workers=depth, thread_name_prefix="prefetch")
+    try:
+        while pending or next_file_path is not None:
+            # The previous file has been processed by the caller
+            read_ahead(current_bytes=0)
+            file_path, _, future, _ = pending.popleft()
+            data = future.result()
+            if max_memory_bytes is not None:
+                read_ahead(current_bytes=get_memory_size(data))
+            yield file_path, data
+    finally:
+        # The caller may stop iterating before the end
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def load_ipc_files(file_paths, depth: int = 2, max_memory_bytes: int | None = None):
+    dataframes = [
+        df
+        for _, df in prefetch_ipc_files(
+            file_paths, depth=depth, max_memory_bytes=max_memory_bytes
+        )
+    ]
     return pd.concat(dataframes, ignore_index=True)
 
 
@@ -0,0 +1,216 @@
+"""
+Vectorized validation of the data files, one record batch at a time.
+
+The schema of a file is checked against the documented columns, then every row of
+a batch is checked at once with Arrow compute (and numpy on the flattened peaks,
+see `common.spectra`), without any python loop over the rows:
+    - empty_peaks: the mz (or intensity) list is null or empty.
+    - peaks_length_mismatch: the mz and intensity lists have different lengths.
+    - unsorted_mz: the m/z of the spectrum are not in increasing order.
+    - invalid_charge: the precursor charge is null, not an integer or out of range.
+    - non_finite_<column>: a numeric value (or a peak) is NaN or infinite.
+    - missing_modified_peptide: the modified peptide is null.
+    - malformed_modified_peptide: the modified peptide is not made of amino acids
+      (see `common.ptms.PTMSitesEnum.ANY`), each optionally followed by a bracketed
+      mass as parsed by the ptms identification e.g., PEPTN[2350]IDE, with an
+      optional N-terminal one e.g., [42]PEPTIDE.
+"""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from common.ptms import PTM_MASS_REGEX, PTMSitesEnum
+from common.spectra import flatten_list_column, get_offsets, get_segment_ids
+
+# The documented columns (see the notebooks/analysis columns description) mapped to
+# their expected kind of type, None for any type.
+DOCUMENTED_COLUMNS = {
+    "index": None,
+    "scan": None,
+    "header": "string",
+    "rt": "numeric",
+    "frag_type": "string",
+    "collision_energy": "numeric",
+    "precursor_mz": "numeric",
+    "precursor_charge": "integer",
+    "precursor_intensity": "numeric",
+    "lower_offset": "numeric",
+    "upper_offset": "numeric",
+    "isolation_target": "numeric",
+    "mz": "numeric_list",
+    "intensity": "numeric_list",
+    "scale_factor": "numeric",
+    "peptide": "string",
+    "modified_peptide": "string",
+    "peptide_observed_mz": "numeric",
+    "peptide_calc_mz": "numeric",
+    "delta_mass": "numeric",
+    "retention": "numeric",
+    "expectation": "numeric",
+    "hyperscore": "numeric",
+    "nextscore": "numeric",
+    "probability": "numeric",
+    "auc_intensity": "numeric",
+    "protein": "string",
+}
+
+DEFAULT_CHARGE_RANGE = (1, 10)
+
+# Amino acids, each optionally followed by a bracketed mass e.g., PEPTN[2350]IDE,
+# with an optional N-terminal mass e.g., [42]PEPTIDE
+MODIFIED_PEPTIDE_REGEX = (
+    rf"^(?:\[{PTM_MASS_REGEX}\])?"
+    rf"(?:[{PTMSitesEnum.ANY.value}](?:\[{PTM_MASS_REGEX}\])?)+$"
+)
+
+
+def _is_kind(data_type: pa.DataType, kind: str | None) -> bool:
+    if pa.types.is_dictionary(data_type):
+        data_type = data_type.value_type
+    if kind is None:
+        return True
+    if kind == "integer":
+        return pa.types.is_integer(data_type)
+    if kind == "numeric":
+        return pa.types.is_integer(data_type) or pa.types.is_floating(data_type)
+    if kind == "string":
+        return pa.types.is_string(data_type) or pa.types.is_large_string(data_type)
+    if kind == "numeric_list":
+        return (
+            pa.types.is_list(data_type) or pa.types.is_large_list(data_type)
+        ) and _is_kind(data_type.value_type, "numeric")
+    raise ValueError(f"Unknown kind of type {kind}")
+
+
+def validate_schema(
+    schema: pa.Schema, expected_columns: dict = DOCUMENTED_COLUMNS
+) -> list[str]:
+    """
+    Check a schema against the expected columns and their kinds of type.
+
+    Returns:
+        list: The problems found e.g., "missing column rt" or "precursor_charge is
+        double, expected integer", empty if the schema is valid.
+    """
+    problems = []
+    for column, kind in expected_columns.items():
+        if column not in schema.names:
+            problems.append(f"missing column {column}")
+        elif not _is_kind(schema.field(column).type, kind):
+            problems.append(f"{column} is {schema.field(column).type}, expected {kind}")
+    return problems
+
+
+def _get_non_finite_mask(column: pa.Array) -> np.ndarray:
+    # The nulls (missing values) are not reported, only the NaN and infinite values
+    if pa.types.is_integer(column.type):
+        return np.zeros(len(column), dtype=bool)
+    return pc.fill_null(pc.invert(pc.is_finite(column)), False).to_numpy(
+        zero_copy_only=False
+    )
+
+
+def validate_record_batch(
+    batch: pa.RecordBatch,
+    expected_columns: dict = DOCUMENTED_COLUMNS,
+    charge_range: tuple[int, int] = DEFAULT_CHARGE_RANGE,
+) -> pa.ListArray:
+    """
+    Check every row of a batch (see the module docstring). The checks of the columns
+    missing from the batch, or not having their expected kind of type, are skipped.
+
+    Args:
+        batch (pa.RecordBatch): The batch.
+        expected_columns (dict): The columns mapped to their kind of type.
+        charge_range (tuple): The valid precursor charges (inclusive).
+
+    Returns:
+        pa.ListArray: The names of the failed checks of each row, empty for the
+        valid rows.
+    """
+    names = set(batch.schema.names)
+
+    def has(column: str) -> bool:
+        return (
+            column in names
+            and column in expected_columns
+            and _is_kind(batch.schema.field(column).type, expected_columns[column])
+        )
+
+    checks = {}
+
+    if has("mz") and has("intensity"):
+        mz, offsets = flatten_list_column(batch.column("mz"))
+        intensity, intensity_offsets = flatten_list_column(batch.column("intensity"))
+        lengths = np.diff(offsets)
+        checks["empty_peaks"] = (lengths == 0) | (np.diff(intensity_offsets) == 0)
+        checks["peaks_length_mismatch"] = lengths != np.diff(intensity_offsets)
+
+        # A decrease between two consecutive peaks of the same spectrum
+        decreasing = np.flatnonzero(np.diff(mz) < 0) + 1
+        decreasing = decreasing[np.isin(decreasing, offsets, invert=True)]
+        checks["unsorted_mz"] = (
+            np.bincount(get_segment_ids(offsets)[decreasing], minlength=batch.num_rows)
+            > 0
+        )
+        for column, values, column_offsets in (
+            ("mz", mz, offsets),
+            ("intensity", intensity, intensity_offsets),
+        ):
+            checks[f"non_finite_{column}"] = (
+                np.bincount(
+                    get_segment_ids(column_offsets)[~np.isfinite(values)],
+                    minlength=batch.num_rows,
+                )
+                > 0
+            )
+
+    if "precursor_charge" in names and _is_kind(
+        batch.schema.field("precursor_charge").type, "numeric"
+    ):
+        charge = batch.column("precursor_charge")
+        if not pa.types.is_integer(charge.type):
+            # e.g., float charges, only the integral ones are valid
+            charge = pc.cast(charge, pa.float64())
+            integral = pc.equal(charge, pc.floor(charge))
+        else:
+            integral = pa.scalar(True)
+        in_range = pc.and_(
+            pc.greater_equal(charge, charge_range[0]),
+            pc.less_equal(charge, charge_range[1]),
+        )
+        checks["invalid_charge"] = pc.invert(
+            pc.fill_null(pc.and_(integral, in_range), False)
+        ).to_numpy(zero_copy_only=False)
+
+    for column, kind in expected_columns.items():
+        if kind in ("numeric", "integer") and has(column):
+            checks[f"non_finite_{column}"] = _get_non_finite_mask(batch.column(column))
+
+    if has("modified_peptide"):
+        modified_peptide = batch.column("modified_peptide")
+        if pa.types.is_dictionary(modified_peptide.type):
+            modified_peptide = modified_peptide.dictionary_decode()
+        checks["missing_modified_peptide"] = modified_peptide.is_null().to_numpy(
+            zero_copy_only=False
+        )
+        checks["malformed_modified_peptide"] = pc.invert(
+            pc.fill_null(
+                pc.match_substring_regex(modified_peptide, MODIFIED_PEPTIDE_REGEX),
+                True,
+            )
+        ).to_numpy(zero_copy_only=False)
+
+    # The failed checks of the rows, grouped by row
+    check_names = np.array(list(checks), dtype=object)
+    masks = (
+        np.stack([np.asarray(mask, dtype=bool) for mask in checks.values()], axis=1)
+        if checks
+        else np.zeros((batch.num_rows, 0), dtype=bool)
+    )
+    row_ids, check_ids = np.nonzero(masks)
+    return pa.ListArray.from_arrays(
+        pa.array(get_offsets(row_ids, batch.num_rows), pa.int32()),
+        pa.array(check_names[check_ids], pa.string()),
+    )
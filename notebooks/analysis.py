@@ -5,6 +5,7 @@ import os
 import sys
 import logging
 import itertools
+from functools import partial
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -14,9 +15,19 @@ import matplotlib.pyplot as plt
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
 
 
-from common.utils import collect_files, get_or_create_folder
+from common.utils import (
+    collect_files,
+    get_or_create_folder,
+    load_ipc_files,
+    prefetch_ipc_files,
+    read_data_file,
+)
+from common.cache import ResultCache
+from scripts.aggregate_peptides import aggregate_peptides, get_value_counts
+from scripts.plot_peak_density import accumulate_peak_density, plot_peak_density
 from common.logger import get_logger_config
 from common.constants import (
+    BASE_CACHE_DIR,
     BASE_RAW_DATA_DIR,
     BASE_LOGS_DIR,
     BASE_PLOTS_DIR,
@@ -126,7 +137,7 @@ def plot_quantitative(
 
 
 def plot_qualitative(
-    df, column, xlabel="Count", ylabel=None, title=None, top_n=20, filename=None, save=True
+    df, column, xlabel="Count", ylabel=None, title=None, top_n=20, filename=None, save=True, value_counts=None
 ):
     """
     Plot bar plot for a qualitative (categorical) column.
@@ -136,6 +147,7 @@ def plot_qualitative(
     column (str): The column to plot.
     label (str): The label to display on the plot. If None, the column name is used.
     top_n (int): The number of top values to display.
+    value_counts (pd.Series): The precomputed value counts of the column. If None, they are computed from df.
     """
     ylabel = ylabel if ylabel else column
     title = (
@@ -147,7 +159,8 @@ def plot_qualitative(
             else ylabel.capitalize()
         )
     )
-    top_values = df[column].value_counts().nlargest(top_n)
+    value_counts = value_counts if value_counts is not None else df[column].value_counts()
+    top_values = value_counts.nlargest(top_n)
     plt.figure(figsize=(10, 6))
     sns.barplot(y=top_values.index, x=top_values.values)
     plt.title(title)
@@ -205,8 +218,42 @@ def plot_x_y_bar(
 # Grab all ipc files of interest but ATTENTION;
 # loading all many ipc files will increase the computation time
 ipc_files = collect_files(BASE_RAW_DATA_DIR / target_data)
-df = pd.concat([pd.read_feather(file) for file in ipc_files], ignore_index=True)
-df.head(20)
+
+# The results computed from the ipc files are cached on disk under their fingerprints,
+# so a rerun (e.g. after changing a plot style) neither recomputes them nor loads the
+# files. The cached functions read the columns they need from the files they are
+# given, rather than from `df`, so that their key covers all their inputs.
+# Use `<cached function>.invalidate()` to drop the cached results of a function.
+cache = ResultCache(BASE_CACHE_DIR / artifacts_sub_dir)
+
+
+def load_columns(ipc_files, columns):
+    # The next files are read in the background while the current one is appended
+    reader = partial(read_data_file, columns=list(columns))
+    return pd.concat(
+        [df for _, df in prefetch_ipc_files(ipc_files, reader=reader)],
+        ignore_index=True,
+    )
+
+
+@cache.memoize(files_arg="ipc_files")
+def describe_columns(ipc_files, columns):
+    return load_columns(ipc_files, columns).describe()
+
+
+@cache.memoize(files_arg="ipc_files")
+def count_values(ipc_files, column):
+    return load_columns(ipc_files, [column])[column].value_counts()
+
+
+# One row per (peptide, modified_peptide) with its spectra count, charges, projects,
+# glycan masses and delta_mass statistics, for the peptide level questions
+@cache.memoize(files_arg="ipc_files")
+def build_peptides_table(ipc_files):
+    return aggregate_peptides(ipc_files).to_table()
+
+
+peptides_table = build_peptides_table(ipc_files)
 #%% md
 # ## Columns description
 # 
@@ -240,10 +287,6 @@ df.head(20)
 # | `auc_intensity`         | The area under the curve (AUC) of the signal intensity, used for quantification.                  |
 # | `protein`               | The protein to which the peptide belongs, identified from a database.                             |
 #%%
-df.info()
-#%%
-df[["mz"]].iloc[0].mz
-#%%
 highly_relevant_columns = [
     "peptide",
     "modified_peptide",
@@ -280,51 +323,30 @@ less_relevant_columns = [
 #%% md
 # ### Recap statistics for relevant and less relevant columns
 #%%
-df_described = df[highly_relevant_columns].describe()
+df_described = describe_columns(ipc_files, highly_relevant_columns)
 df_described.to_csv(csv_dir / "highly_relevant_columns_described_df.csv", index=False)
 df_described
 #%%
-df_described = df[moderatly_relevant_columns].describe()
+df_described = describe_columns(ipc_files, moderatly_relevant_columns)
 df_described.to_csv(
     csv_dir / "moderatly_relevant_columns_described_df.csv", index=False
 )
 df_described
 #%%
-df_described = df[less_relevant_columns].describe()
+df_described = describe_columns(ipc_files, less_relevant_columns)
 df_described.to_csv(csv_dir / "less_relevant_columns_described_df.csv", index=False)
 df_described
 #%% md
 # ### Duplicate investigation
 #%%
 # Save unique peptides as a single-column CSV
-pd.DataFrame({"Unique Peptides": df["peptide"].unique()}).to_csv(csv_dir / "unique_peptides.csv", index=False)
+pd.DataFrame({"Unique Peptides": get_value_counts(peptides_table, "peptide").index}).to_csv(csv_dir / "unique_peptides.csv", index=False)
 
 # Save unique modified peptides as a single-column CSV
-pd.DataFrame({"Unique Modified Peptides": df["modified_peptide"].unique()}).to_csv(csv_dir / "unique_modified_peptides.csv", index=False)
+pd.DataFrame({"Unique Modified Peptides": get_value_counts(peptides_table, "modified_peptide").index}).to_csv(csv_dir / "unique_modified_peptides.csv", index=False)
 #%%
 # Investigate duplicates
 # assert False, "This code block may take minutes to complete; Do you really want to run this code?, If yes, then disable this assertion."
-logger.info("Start replacing list or np.ndarray with tuples for internal comparison purposes")
-
-def list_to_tuple_func(value):
-    logger.info(f"Transforming {value[:3]} to tuple")
-    if isinstance(value, (np.ndarray, list)):
-        return tuple(value)
-    return value
-
-
-for column in ("mz", "intensity"):
-
-    # Convert array-like values in the specified columns to tuples. Using
-    # another new column will make use of a lot of memory. So, let's just
-    # overwrite the values in the specified column.
-    logger.info(
-        f"Start list replacement for column {column}"
-    )
-    df[column] = df[column].apply(
-        list_to_tuple_func
-    )
-logger.info("Finish replacing list or np.ndarray with tuples")
 # List of columns to consider
 columns_to_check = [
     "peptide",
@@ -338,6 +360,13 @@ columns_to_check = [
 ]
 
 
+def list_to_tuple_func(value):
+    logger.info(f"Transforming {value[:3]} to tuple")
+    if isinstance(value, (np.ndarray, list)):
+        return tuple(value)
+    return value
+
+
 # Function to generate aligned labels
 def format_label(columns_in_combination):
     formatted = []
@@ -349,23 +378,44 @@ def format_label(columns_in_combination):
     return ", ".join(formatted)  # Use separator for clarity
 
 
-# Initialize a list to store results
-results = []
+@cache.memoize(files_arg="ipc_files")
+def count_duplicates(ipc_files, columns_to_check):
+    # The columns are loaded apart from `df`, which is left untouched
+    duplicates_df = load_columns(ipc_files, columns_to_check)
+    logger.info("Start replacing list or np.ndarray with tuples for internal comparison purposes")
+    for column in ("mz", "intensity"):
 
-# Iterate through each combination of column sizes (1-combinaison, 2-combinaison, etc.)
-for size in range(1, len(columns_to_check) + 1):
-    for comb in itertools.combinations(columns_to_check, size):
-        # Count duplicates for the current combination of columns
-        duplicate_count = df[list(comb)].duplicated().sum()
-        # FIXME: Here .debug should be used
-        logger.info(f"Combination size: {size}, duplicate count: {duplicate_count}, combinations: {comb}")
-        # Store the result as a tuple of (combination, duplicate_count)
-        results.append(
-            {"columns": format_label(comb), "duplicate_count": duplicate_count}
+        # Convert array-like values in the specified columns to tuples. Using
+        # another new column will make use of a lot of memory. So, let's just
+        # overwrite the values in the specified column.
+        logger.info(
+            f"Start list replacement for column {column}"
+        )
+        duplicates_df[column] = duplicates_df[column].apply(
+            list_to_tuple_func
         )
+    logger.info("Finish replacing list or np.ndarray with tuples")
+
+    # Initialize a list to store results
+    results = []
 
-# Convert results into a DataFrame
-results_df = pd.DataFrame(results)
+    # Iterate through each combination of column sizes (1-combinaison, 2-combinaison, etc.)
+    for size in range(1, len(columns_to_check) + 1):
+        for comb in itertools.combinations(columns_to_check, size):
+            # Count duplicates for the current combination of columns
+            duplicate_count = duplicates_df[list(comb)].duplicated().sum()
+            # FIXME: Here .debug should be used
+            logger.info(f"Combination size: {size}, duplicate count: {duplicate_count}, combinations: {comb}")
+            # Store the result as a tuple of (combination, duplicate_count)
+            results.append(
+                {"columns": format_label(comb), "duplicate_count": duplicate_count}
+            )
+
+    # Convert results into a DataFrame
+    return pd.DataFrame(results)
+
+
+results_df = count_duplicates(ipc_files, columns_to_check)
 
 # Print the DataFrame with duplicate counts
 print(results_df)
@@ -382,18 +432,28 @@ plot_x_y_bar(
 )
 #%%
 # Access the mz and intensity of the most abundant peptide and modification
-pd.DataFrame({"Unique Peptides": df["peptide"].unique()}).to_csv(csv_dir / "unique_peptides.csv", index=False)
+pd.DataFrame({"Unique Peptides": get_value_counts(peptides_table, "peptide").index}).to_csv(csv_dir / "unique_peptides.csv", index=False)
 
 # Save unique modified peptides as a single-column CSV
-pd.DataFrame({"Unique Modified Peptides": df["modified_peptide"].unique()}).to_csv(csv_dir / "unique_modified_peptides.csv", index=False)
+pd.DataFrame({"Unique Modified Peptides": get_value_counts(peptides_table, "modified_peptide").index}).to_csv(csv_dir / "unique_modified_peptides.csv", index=False)
 # most_abundant_rows.head()
 
 #%%
 
+#%% md
+# ### Rows exploration
+#%%
+# The rows are only loaded here, for the cells exploring or plotting them
+df = load_ipc_files(ipc_files)
+df.head(20)
 #%%
-plot_qualitative(df, "modified_peptide", "Modified peptides")
-plot_qualitative(df, "peptide", "Peptide")
-plot_qualitative(df, "protein", "Proteins")
+df.info()
+#%%
+df[["mz"]].iloc[0].mz
+#%%
+plot_qualitative(df, "modified_peptide", "Modified peptides", value_counts=get_value_counts(peptides_table, "modified_peptide"))
+plot_qualitative(df, "peptide", "Peptide", value_counts=get_value_counts(peptides_table, "peptide"))
+plot_qualitative(df, "protein", "Proteins", value_counts=count_values(ipc_files, "protein"))
 #%%
 plot_quantitative(df, "precursor_mz", xlabel="Precursor m/z")
 plot_quantitative(df, "precursor_charge", xlabel="Precursor charge")
@@ -410,6 +470,16 @@ plot_x_y(
     title=f'm/z vs. Intensity for peptide {df.iloc[peptide_index]["peptide"]}',
 )
 #%%
+# Density of all the peaks of the files, rasterized into a fixed grid (plot_x_y can only draw one spectrum)
+peak_density = accumulate_peak_density(ipc_files, group_by="precursor_charge")
+plot_peak_density(peak_density, title="m/z vs. Intensity density of all the peaks")
+save_figure("mz_vs_intensity_density")
+plt.show()
+for charge in sorted(peak_density.counts):
+    plot_peak_density(peak_density, charge, title=f"m/z vs. Intensity density of the peaks of charge {charge}")
+    save_figure(f"mz_vs_intensity_density_charge_{charge}")
+    plt.show()
+#%%
 
 #%% md
 # ## PTMs identification
@@ -0,0 +1,370 @@
+"""
+Script to aggregate the spectra of the corpus into a compact peptide table, in a
+single pass over the files. The table has one row per (peptide, modified_peptide)
+holding its number of spectra, its charges, projects and glycan masses and the
+statistics of its delta_mass, so that the peptide level questions (e.g. the most
+frequent peptides, the unique peptides or the peptides shared by projects) are
+answered from a few tens of thousands of rows instead of the millions of spectra.
+
+The aggregate is mergeable (e.g. across workers) and the table is written as a
+compressed Arrow IPC file with its string columns dictionary-encoded.
+"""
+
+import logging
+import logging.config  # noqa
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from pathlib import Path
+from functools import partial
+from typing import Callable
+from tqdm import tqdm
+
+from common.utils import (
+    collect_files,
+    get_or_create_folder,
+    get_project_name,
+    prefetch_ipc_files,
+    read_data_file,
+)
+from common.spectra import get_offsets
+from common.constants import BASE_AGGREGATED_DATA_DIR, BASE_RAW_DATA_DIR
+from common.logger import get_logger_config
+from scripts.identify_ptms import ANY_PTM_REGEX
+
+logger = logging.getLogger(__name__)
+
+PEPTIDE_KEY_COLUMNS = ["peptide", "modified_peptide"]
+AGGREGATED_COLUMNS = [*PEPTIDE_KEY_COLUMNS, "precursor_charge", "delta_mass"]
+STATS_COLUMNS = [
+    "spectra_count",
+    "delta_mass_count",
+    "delta_mass_mean",
+    "delta_mass_min",
+    "delta_mass_max",
+    "delta_mass_m2",
+]
+
+# Number of partial aggregates kept before merging them (merging them after each
+# file would regroup the whole aggregate for every file)
+COMPACTION_THRESHOLD = 64
+
+
+def merge_grouped_moments(stats_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Merge the delta_mass moments of the rows having the same peptide key, with the
+    pairwise algorithm of Chan et al. generalized to any number of rows.
+    """
+    grouped = stats_df.groupby(PEPTIDE_KEY_COLUMNS, dropna=False, sort=False)
+    # The groups are numbered in the order of the aggregated rows
+    group_ids = grouped.ngroup().to_numpy()
+    counts = stats_df["delta_mass_count"].to_numpy(np.float64)
+    means = stats_df["delta_mass_mean"].to_numpy(np.float64)
+
+    count = np.bincount(group_ids, counts, grouped.ngroups)
+    # The peptides without any delta_mass have a NaN mean
+    with np.errstate(invalid="ignore"):
+        mean = np.bincount(
+            group_ids, np.nan_to_num(counts * means), grouped.ngroups
+        ) / np.where(count > 0, count, np.nan)
+    m2 = np.bincount(
+        group_ids,
+        stats_df["delta_mass_m2"].to_numpy(np.float64)
+        + np.nan_to_num(counts * (means - mean[group_ids]) ** 2),
+        grouped.ngroups,
+    )
+
+    merged_df = grouped.agg(
+        spectra_count=("spectra_count", "sum"),
+        delta_mass_count=("delta_mass_count", "sum"),
+        delta_mass_mean=("delta_mass_mean", "first"),
+        delta_mass_min=("delta_mass_min", "min"),
+        delta_mass_max=("delta_mass_max", "max"),
+        delta_mass_m2=("delta_mass_m2", "first"),
+    ).reset_index()
+    merged_df["delta_mass_mean"] = mean
+    merged_df["delta_mass_m2"] = m2
+    return merged_df
+
+
+class PeptideAggregate:
+    """
+    Mergeable aggregate of spectra by (peptide, modified_peptide).
+
+    It holds three partial tables: the spectra count and the delta_mass moments
+    (count, mean, M2, min, max) of each peptide, and its spectra count by charge and
+    by project. Adding a file or merging another aggregate only appends partial
+    tables, which are regrouped from time to time.
+    """
+
+    def __init__(self):
+        self.stats: list[pd.DataFrame] = []
+        self.charges: list[pd.DataFrame] = []
+        self.projects: list[pd.DataFrame] = []
+
+    def add(self, df: pd.DataFrame, project_name: str) -> None:
+        """
+        Add the spectra of a file.
+
+        Args:
+            df (pd.DataFrame): The spectra, with the `AGGREGATED_COLUMNS` columns.
+            project_name (str): The project of the spectra.
+        """
+        grouped = df.groupby(PEPTIDE_KEY_COLUMNS, dropna=False, sort=False)
+        delta_mass = df["delta_mass"].astype(np.float64)
+        deviations = delta_mass - grouped["delta_mass"].transform("mean")
+        stats_df = grouped.agg(
+            spectra_count=("delta_mass", "size"),
+            delta_mass_count=("delta_mass", "count"),
+            delta_mass_mean=("delta_mass", "mean"),
+            delta_mass_min=("delta_mass", "min"),
+            delta_mass_max=("delta_mass", "max"),
+        )
+        stats_df["delta_mass_m2"] = (
+            (deviations**2).groupby(grouped.ngroup()).sum().to_numpy()
+        )
+        stats_df = stats_df.reset_index()
+        self.stats.append(stats_df)
+
+        charges_df = (
+            df.dropna(subset=["precursor_charge"])
+            .groupby([*PEPTIDE_KEY_COLUMNS, "precursor_charge"], dropna=False)
+            .size()
+            .rename("spectra_count")
+            .reset_index()
+        )
+        charges_df["precursor_charge"] = charges_df["precursor_charge"].astype(np.int16)
+        self.charges.append(charges_df)
+
+        projects_df = stats_df[[*PEPTIDE_KEY_COLUMNS, "spectra_count"]].assign(
+            project_name=project_name
+        )
+        self.projects.append(projects_df)
+
+        if len(self.stats) > COMPACTION_THRESHOLD:
+            self.compact()
+
+    def merge(self, other: "PeptideAggregate") -> "PeptideAggregate":
+        self.stats.extend(other.stats)
+        self.charges.extend(other.charges)
+        self.projects.extend(other.projects)
+        if len(self.stats) > COMPACTION_THRESHOLD:
+            self.compact()
+        return self
+
+    def compact(self) -> None:
+        """
+        Regroup the partial tables into one table each.
+        """
+        if len(self.stats) > 1:
+            self.stats = [
+                merge_grouped_moments(pd.concat(self.stats, ignore_index=True))
+            ]
+        for name, column in (
+            ("charges", "precursor_charge"),
+            ("projects", "project_name"),
+        ):
+            partial_dfs = getattr(self, name)
+            if len(partial_dfs) > 1:
+                merged_df = (
+                    pd.concat(partial_dfs, ignore_index=True)
+                    .groupby([*PEPTIDE_KEY_COLUMNS, column], dropna=False, sort=False)[
+                        "spectra_count"
+                    ]
+                    .sum()
+                    .reset_index()
+                )
+                setattr(self, name, [merged_df])
+
+    def to_table(self) -> pa.Table:
+        """
+        Build the peptide table, sorted by decreasing spectra count, with the columns:
+            - peptide, modified_peptide: dictionary-encoded strings.
+            - spectra_count: the number of spectra of the peptide.
+            - charges: the sorted precursor charges of its spectra.
+            - projects: the sorted projects of its spectra (dictionary-encoded).
+            - glycan_masses: the glycan masses in the modified peptide, in order.
+            - delta_mass_count, delta_mass_mean, delta_mass_m2, delta_mass_std,
+              delta_mass_min, delta_mass_max: the (mergeable) delta_mass statistics,
+              M2 being the sum of the squared deviations to the mean.
+        """
+        self.compact()
+        stats_df = (
+            self.stats[0]
+            if self.stats
+            else pd.DataFrame(columns=[*PEPTIDE_KEY_COLUMNS, *STATS_COLUMNS])
+        )
+        stats_df = stats_df.sort_values(
+            ["spectra_count", *PEPTIDE_KEY_COLUMNS],
+            ascending=[False, True, True],
+            kind="stable",
+        ).reset_index(drop=True)
+        row_ids_df = stats_df[PEPTIDE_KEY_COLUMNS].assign(
+            row_id=np.arange(len(stats_df))
+        )
+
+        def to_list_array(partial_dfs: list, column: str, dtype) -> pa.ListArray:
+            if not partial_dfs:
+                return pa.ListArray.from_arrays(
+                    pa.array(np.zeros(len(stats_df) + 1), pa.int32()),
+                    pa.array([], dtype),
+                )
+            partial_df = partial_dfs[0]
+            # The rows of a peptide are contiguous once sorted by row id (pandas
+            # merges the null keys together)
+            segment_ids = (
+                partial_df[PEPTIDE_KEY_COLUMNS]
+                .merge(row_ids_df, on=PEPTIDE_KEY_COLUMNS, how="left")["row_id"]
+                .to_numpy()
+            )
+            order = np.lexsort((partial_df[column].to_numpy(), segment_ids))
+            offsets = get_offsets(segment_ids[order], len(stats_df))
+            values = pa.array(partial_df[column].to_numpy()[order], dtype)
+            return pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), values)
+
+        charges = to_list_array(self.charges, "precursor_charge", pa.int16())
+        projects = to_list_array(self.projects, "project_name", pa.string())
+        projects = pa.ListArray.from_arrays(
+            projects.offsets, projects.values.dictionary_encode()
+        )
+
+        ptms_df = (
+            stats_df["modified_peptide"].astype("string").str.extractall(ANY_PTM_REGEX)
+        )
+        glycan_masses = pa.ListArray.from_arrays(
+            pa.array(
+                get_offsets(
+                    ptms_df.index.get_level_values(0).to_numpy(np.int64), len(stats_df)
+                ),
+                pa.int32(),
+            ),
+            pa.array(ptms_df["glycan_mass"].astype(np.int32).to_numpy()),
+        )
+
+        count = stats_df["delta_mass_count"]
+        return pa.table(
+            {
+                "peptide": pa.array(
+                    stats_df["peptide"], pa.string()
+                ).dictionary_encode(),
+                "modified_peptide": pa.array(
+                    stats_df["modified_peptide"], pa.string()
+                ).dictionary_encode(),
+                "spectra_count": pa.array(stats_df["spectra_count"], pa.int64()),
+                "charges": charges,
+                "projects": projects,
+                "glycan_masses": glycan_masses,
+                "delta_mass_count": pa.array(count, pa.int64()),
+                "delta_mass_mean": pa.array(stats_df["delta_mass_mean"], pa.float64()),
+                "delta_mass_m2": pa.array(stats_df["delta_mass_m2"], pa.float64()),
+                "delta_mass_std": pa.array(
+                    np.sqrt(stats_df["delta_mass_m2"] / (count - 1).where(count > 1)),
+                    pa.float64(),
+                ),
+                "delta_mass_min": pa.array(stats_df["delta_mass_min"], pa.float64()),
+                "delta_mass_max": pa.array(stats_df["delta_mass_max"], pa.float64()),
+            }
+        )
+
+
+def aggregate_peptides(
+    ipc_files: list,
+    get_project_name: Callable[[str | Path], str] = get_project_name,
+    prefetch_depth: int = 2,
+) -> PeptideAggregate:
+    """
+    Aggregate the spectra of the files by peptide, reading only the needed columns.
+
+    Returns:
+        PeptideAggregate: The aggregate, see `PeptideAggregate.to_table` for the table.
+    """
+    aggregate = PeptideAggregate()
+    reader = partial(read_data_file, columns=AGGREGATED_COLUMNS)
+    for ipc_file, df in tqdm(
+        prefetch_ipc_files(ipc_files, depth=prefetch_depth, reader=reader),
+        total=len(ipc_files),
+        desc="Aggregating peptides",
+        unit="file",
+    ):
+        aggregate.add(df, get_project_name(ipc_file))
+    return aggregate
+
+
+def write_peptides_table(table: pa.Table, path: str | Path) -> Path:
+    """
+    Write the peptide table into a zstd compressed Arrow IPC file (which can be read
+    back with `common.utils.read_data_table`).
+    """
+    get_or_create_folder(Path(path).parent)
+    with ipc.new_file(
+        str(path), table.schema, options=ipc.IpcWriteOptions(compression="zstd")
+    ) as writer:
+        writer.write_table(table)
+    return Path(path)
+
+
+def get_value_counts(table: pa.Table, column: str = "modified_peptide") -> pd.Series:
+    """
+    Spectra count of each peptide (or modified peptide), like `df[column].value_counts()`
+    on the spectra.
+    """
+    return (
+        table.select([column, "spectra_count"])
+        .to_pandas()
+        .astype({column: "object"})
+        .groupby(column)["spectra_count"]
+        .sum()
+        .sort_values(ascending=False)
+        .rename("count")
+    )
+
+
+def count_shared_peptides(
+    table: pa.Table, column: str = "modified_peptide"
+) -> pd.DataFrame:
+    """
+    Count the peptides (or modified peptides) seen in each pair of projects.
+
+    Returns:
+        pd.DataFrame: The columns (project_a, project_b, shared_count), project_a
+        being before project_b in alphabetical order.
+    """
+    values = table[column].combine_chunks()
+    projects = table["projects"].combine_chunks()
+    projects_df = (
+        pd.DataFrame(
+            {
+                column: np.repeat(
+                    values.dictionary_decode().to_numpy(zero_copy_only=False),
+                    np.diff(projects.offsets.to_numpy()),
+                ),
+                "project_name": projects.flatten()
+                .dictionary_decode()
+                .to_numpy(zero_copy_only=False),
+            }
+        )
+        .dropna()
+        .drop_duplicates()
+    )
+    pairs_df = projects_df.merge(projects_df, on=column, suffixes=("_a", "_b"))
+    pairs_df = pairs_df[pairs_df["project_name_a"] < pairs_df["project_name_b"]]
+    return (
+        pairs_df.groupby(["project_name_a", "project_name_b"])
+        .size()
+        .rename("shared_count")
+        .reset_index()
+        .rename(columns={"project_name_a": "project_a", "project_name_b": "project_b"})
+    )
+
+
+if __name__ == "__main__":
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+
+    raw_files = collect_files(BASE_RAW_DATA_DIR)
+    logger.info(f"Found {len(raw_files)} IPC files to aggregate in {BASE_RAW_DATA_DIR}")
+    peptides_table = aggregate_peptides(raw_files).to_table()
+    path = write_peptides_table(
+        peptides_table, BASE_AGGREGATED_DATA_DIR / "peptides.arrow"
+    )
+    logger.info(f"Saved the table of {peptides_table.num_rows} peptides into {path}")
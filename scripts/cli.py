@@ -0,0 +1,146 @@
+"""
+Command line interface of the project, installed as the `instanovoglyco` command.
+
+Usage:
+    instanovoglyco identify [--data-dir DIR]  # The ptms examples and occurrences
+    instanovoglyco stats [--data-dir DIR]  # The columns statistics and value counts
+    instanovoglyco dedup [--data-dir DIR]  # The duplicated rows counts
+    instanovoglyco overlap [--data-dir DIR]  # The spectra shared by the projects
+
+Only the standard library is imported to build the parser. The modules of a command
+(and pandas, pyarrow...) are imported when it runs, and the data files are only
+collected then, so that e.g. `--help` does not pay for them.
+"""
+
+import argparse
+import logging
+import logging.config  # noqa
+from pathlib import Path
+
+from common.constants import (
+    BASE_PTMS_DIR,
+    BASE_PTMS_INDEX_DIR,
+    BASE_RAW_DATA_DIR,
+    BASE_REPORTS_CSV_DIR,
+)
+from common.logger import get_logger_config
+
+logger = logging.getLogger(__name__)
+
+
+def collect_data_files(data_dir) -> list[str]:
+    from common.utils import collect_files
+
+    file_paths = collect_files(data_dir)
+    logger.info(f"Found {len(file_paths)} data files in {data_dir}")
+    return file_paths
+
+
+def save_reports(reports: dict, output_dir) -> None:
+    from common.utils import get_or_create_folder
+
+    get_or_create_folder(output_dir)
+    for name, report_df in reports.items():
+        report_df.to_csv(Path(output_dir) / f"{name}.csv", index=False)
+    logger.info(f"Saved the reports {list(reports)} into {output_dir}")
+
+
+def identify(args) -> None:
+    from scripts.identify_ptms import (
+        DEFAULT_PTM_CLASSES,
+        identify_ptms,
+        save_ptms_reports,
+    )
+
+    ptms_results = identify_ptms(
+        collect_data_files(args.data_dir),
+        ptm_examples_limit=args.examples_limit,
+        return_df=False,
+        seed=args.seed,
+        ptm_classes=DEFAULT_PTM_CLASSES,
+        index_dir=args.index_dir,
+    )
+    save_ptms_reports(ptms_results, args.output_dir)
+
+
+def stats(args) -> None:
+    from scripts.run_sharded import map_statistics, reduce_statistics
+
+    partial_results = [map_statistics(p) for p in collect_data_files(args.data_dir)]
+    save_reports(reduce_statistics(partial_results, top_n=args.top_n), args.output_dir)
+
+
+def dedup(args) -> None:
+    from scripts.run_sharded import map_dedup, reduce_dedup
+
+    partial_results = [map_dedup(p) for p in collect_data_files(args.data_dir)]
+    save_reports(reduce_dedup(partial_results), args.output_dir)
+
+
+def overlap(args) -> None:
+    from common.utils import get_or_create_folder
+    from scripts.match_cross_project_spectra import match_cross_project_spectra
+
+    get_or_create_folder(args.output_dir)
+    overlaps_df = match_cross_project_spectra(
+        collect_data_files(args.data_dir),
+        Path(args.output_dir) / "cross_project_matches.csv",
+        args.ppm_tolerance,
+        args.rt_tolerance,
+    )
+    save_reports({"cross_project_overlaps": overlaps_df}, args.output_dir)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="instanovoglyco", description=__doc__.split("\n\n")[0]
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Command -> (function, help, default output directory)
+    commands = {
+        "identify": (identify, "Identify the ptms", BASE_PTMS_DIR),
+        "stats": (
+            stats,
+            "Compute the columns statistics",
+            BASE_REPORTS_CSV_DIR / "statistics",
+        ),
+        "dedup": (dedup, "Count the duplicated rows", BASE_REPORTS_CSV_DIR / "dedup"),
+        "overlap": (
+            overlap,
+            "Match the spectra across projects",
+            BASE_REPORTS_CSV_DIR / "cross_project_matching",
+        ),
+    }
+    for command, (func, help, output_dir) in commands.items():
+        subparser = subparsers.add_parser(command, help=help, description=help)
+        subparser.set_defaults(func=func)
+        subparser.add_argument("--data-dir", type=Path, default=BASE_RAW_DATA_DIR)
+        subparser.add_argument("--output-dir", type=Path, default=output_dir)
+        if command == "identify":
+            subparser.add_argument("--examples-limit", type=int, default=5)
+            subparser.add_argument("--seed", type=int, default=0)
+            subparser.add_argument(
+                "--index-dir",
+                type=Path,
+                nargs="?",
+                default=None,
+                const=BASE_PTMS_INDEX_DIR,
+                help=f"Also build the ptms index into this directory (default to {BASE_PTMS_INDEX_DIR} if given without a value)",
+            )
+        elif command == "stats":
+            subparser.add_argument("--top-n", type=int, default=100)
+        elif command == "overlap":
+            subparser.add_argument("--ppm-tolerance", type=float, default=10.0)
+            subparser.add_argument("--rt-tolerance", type=float, default=None)
+    return parser
+
+
+def main(args=None):
+    args = get_parser().parse_args(args)
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
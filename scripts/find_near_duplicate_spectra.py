@@ -0,0 +1,327 @@
+"""
+Script to find near-duplicate spectra i.e., spectra of the same peptide and charge
+whose peaks are almost the same, which the exact duplicates checks of the analysis
+miss. Each spectrum is binned into a sparse vector, hashed with a random hyperplanes
+LSH (cosine similarity) and only the spectra sharing a LSH band within the same
+(modified_peptide, precursor_charge) bucket are compared, so that no all-pairs
+comparison ever happens. The result is a list of duplicate clusters which can be
+used to clean the training set.
+"""
+
+import logging
+import logging.config  # noqa
+import numpy as np
+import pandas as pd
+from functools import partial
+from tqdm import tqdm
+
+from common.utils import (
+    collect_files,
+    get_or_create_folder,
+    prefetch_ipc_files,
+    read_data_table,
+)
+from common.spectra import (
+    flatten_peaks,
+    get_offsets,
+    get_segment_ids,
+    segment_sum,
+    top_k_mask,
+)
+from common.constants import BASE_RAW_DATA_DIR, BASE_REPORTS_CSV_DIR
+from common.logger import get_logger_config
+
+logger = logging.getLogger(__name__)
+
+NEAR_DUPLICATES_COLUMNS = ["modified_peptide", "precursor_charge", "mz", "intensity"]
+NEAR_DUPLICATES_CLUSTERS_COLUMNS = [
+    "cluster_id",
+    "cluster_size",
+    "is_representative",
+    "project_name",
+    "file_name",
+    "ipc_index",
+    "modified_peptide",
+    "precursor_charge",
+]
+
+
+class SpectraLSH:
+    """
+    Random hyperplanes LSH of binned spectra.
+
+    A spectrum is turned into a sparse vector of `bin_width` wide m/z bins weighted
+    by the square root of the intensities (only its `max_peaks` most intense peaks
+    are kept) and normalized. Its signature has one bit per hyperplane, i.e. the
+    sign of the projection of the vector on the hyperplane normal, and two vectors
+    with a cosine similarity s agree on a bit with probability 1 - acos(s) / pi.
+    The signature is split into `bands` bands of `rows` bits, and two spectra are
+    candidates when at least one of their bands is equal.
+    """
+
+    def __init__(
+        self,
+        bin_width: float = 0.1,
+        max_mz: float = 5000.0,
+        max_peaks: int = 50,
+        bands: int = 8,
+        rows: int = 8,
+        seed: int = 0,
+    ):
+        assert bands * rows <= 64, "The signature must fit in 64 bits"
+        self.bin_width = bin_width
+        self.bins_count = int(np.ceil(max_mz / bin_width)) + 1
+        self.max_peaks = max_peaks
+        self.bands = bands
+        self.rows = rows
+        # Normal vectors of the hyperplanes, one column per hyperplane
+        self.hyperplanes = (
+            np.random.default_rng(seed)
+            .standard_normal((self.bins_count, bands * rows))
+            .astype(np.float32)
+        )
+
+    def vectorize(
+        self, mz: np.ndarray, intensity: np.ndarray, offsets: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Bin flattened spectra into normalized sparse vectors.
+
+        Returns:
+            tuple: The sorted bins, their weights and the offsets of each spectrum.
+        """
+        keep = top_k_mask(intensity, offsets, self.max_peaks) & (intensity > 0)
+        segment_ids = get_segment_ids(offsets)[keep]
+        bins = np.minimum(
+            (mz[keep] / self.bin_width).astype(np.int64), self.bins_count - 1
+        )
+        weights = np.sqrt(intensity[keep])
+
+        # Merge the peaks falling in the same bin of a spectrum
+        order = np.lexsort((bins, segment_ids))
+        segment_ids, bins, weights = segment_ids[order], bins[order], weights[order]
+        starts = np.flatnonzero(
+            np.r_[True, (np.diff(segment_ids) != 0) | (np.diff(bins) != 0)]
+        )
+        segment_ids, bins = segment_ids[starts], bins[starts]
+        weights = np.add.reduceat(weights, starts) if len(weights) else weights
+
+        vector_offsets = get_offsets(segment_ids, len(offsets) - 1)
+        norms = np.sqrt(segment_sum(weights**2, vector_offsets))
+        weights = weights / norms[segment_ids]
+        return bins, weights.astype(np.float32), vector_offsets
+
+    def signatures(
+        self, bins: np.ndarray, weights: np.ndarray, offsets: np.ndarray
+    ) -> np.ndarray:
+        """
+        Returns the signature (as uint64) of each vector.
+        """
+        segment_ids = get_segment_ids(offsets)
+        signatures = np.zeros(len(offsets) - 1, dtype=np.uint64)
+        for plane in range(self.bands * self.rows):
+            projections = np.bincount(
+                segment_ids,
+                weights=weights * self.hyperplanes[bins, plane],
+                minlength=len(offsets) - 1,
+            )
+            signatures |= (projections > 0).astype(np.uint64) << np.uint64(plane)
+        return signatures
+
+    def band_values(self, signatures: np.ndarray) -> np.ndarray:
+        """
+        Returns the (len(signatures), bands) values of the signatures bands.
+        """
+        mask = np.uint64((1 << self.rows) - 1)
+        return np.stack(
+            [
+                (signatures >> np.uint64(band * self.rows)) & mask
+                for band in range(self.bands)
+            ],
+            axis=1,
+        )
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parents = np.arange(size)
+
+    def find(self, item: int) -> int:
+        root = item
+        while self.parents[root] != root:
+            root = self.parents[root]
+        # Path compression
+        while self.parents[item] != root:
+            self.parents[item], item = root, self.parents[item]
+        return root
+
+    def union(self, a: int, b: int) -> None:
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parents[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def cosine_similarity(
+    bins_a: np.ndarray, weights_a: np.ndarray, bins_b: np.ndarray, weights_b: np.ndarray
+) -> float:
+    """
+    Cosine similarity of two normalized sparse vectors with sorted unique bins.
+    """
+    _, indices_a, indices_b = np.intersect1d(
+        bins_a, bins_b, assume_unique=True, return_indices=True
+    )
+    return float(np.dot(weights_a[indices_a], weights_b[indices_b]))
+
+
+def find_near_duplicate_spectra(
+    ipc_files: list,
+    similarity_threshold: float = 0.95,
+    max_bucket_size: int = 100,
+    lsh: SpectraLSH | None = None,
+) -> pd.DataFrame:
+    """
+    Find the clusters of near-duplicate spectra within the same
+    (modified_peptide, precursor_charge) bucket.
+
+    Args:
+        ipc_files (list): A list of file paths to IPC files.
+        similarity_threshold (float): The minimum cosine similarity of two
+            near-duplicates spectra. Default to 0.95.
+        max_bucket_size (int): LSH buckets bigger than that only have their spectra
+            compared to the first one (to stay linear on heavily duplicated data).
+            Default to 100.
+        lsh (SpectraLSH, optional): The LSH to use. Default to SpectraLSH().
+
+    Returns:
+        pd.DataFrame: The spectra belonging to a cluster of at least two spectra
+        with the columns (cluster_id, cluster_size, is_representative, project_name,
+        file_name, ipc_index, modified_peptide, precursor_charge).
+    """
+    lsh = lsh or SpectraLSH()
+
+    metadata, band_values = [], []
+    # Global vectors buffers (see `SpectraLSH.vectorize`)
+    bins, weights, vector_offsets = [], [], [np.zeros(1, dtype=np.int64)]
+    peaks_count = 0
+    # Whether each spectrum can be compared (its peaks can be paired)
+    comparable = []
+    reader = partial(read_data_table, columns=NEAR_DUPLICATES_COLUMNS)
+
+    for ipc_file, table in tqdm(
+        prefetch_ipc_files(ipc_files, reader=reader),
+        total=len(ipc_files),
+        desc="Hashing spectra",
+        unit="file",
+    ):
+        *_, project_name, file_name = str(ipc_file).split("/")
+        mz, intensity, offsets, mismatched = flatten_peaks(
+            table["mz"], table["intensity"]
+        )
+        if mismatched.any():
+            logger.warning(
+                f"Not comparing {mismatched.sum()} spectra of {project_name}/{file_name} whose mz and intensity lists have different lengths"
+            )
+        comparable.append(~mismatched)
+
+        file_bins, file_weights, file_offsets = lsh.vectorize(mz, intensity, offsets)
+        band_values.append(
+            lsh.band_values(lsh.signatures(file_bins, file_weights, file_offsets))
+        )
+        bins.append(file_bins)
+        weights.append(file_weights)
+        vector_offsets.append(file_offsets[1:] + peaks_count)
+        peaks_count += len(file_bins)
+        metadata.append(
+            pd.DataFrame(
+                {
+                    "project_name": project_name,
+                    "file_name": file_name,
+                    "ipc_index": np.arange(table.num_rows),
+                    "modified_peptide": table["modified_peptide"].to_pandas(),
+                    "precursor_charge": table["precursor_charge"].to_pandas(),
+                }
+            )
+        )
+        logger.info(f"Hashed {table.num_rows} spectra of {project_name}/{file_name}")
+
+    if not metadata:
+        return pd.DataFrame(columns=NEAR_DUPLICATES_CLUSTERS_COLUMNS)
+
+    metadata_df = pd.concat(metadata, ignore_index=True)
+    band_values = np.concatenate(band_values)
+    bins, weights = np.concatenate(bins), np.concatenate(weights)
+    vector_offsets = np.concatenate(vector_offsets)
+
+    # Spectra can only be near-duplicates of spectra of the same bucket, the
+    # spectra without a peptide or a charge (NaN bucket) are not compared
+    bucket_ids = metadata_df.groupby(
+        ["modified_peptide", "precursor_charge"], sort=False
+    ).ngroup()
+    rows = np.flatnonzero(bucket_ids.notna().to_numpy() & np.concatenate(comparable))
+
+    union_find = UnionFind(len(metadata_df))
+    compared_pairs_count = 0
+
+    def get_vector(i):
+        start, end = vector_offsets[i], vector_offsets[i + 1]
+        return bins[start:end], weights[start:end]
+
+    for band in range(lsh.bands):
+        candidates_df = pd.DataFrame(
+            {
+                "bucket_id": bucket_ids.to_numpy()[rows],
+                "band_value": band_values[rows, band],
+            }
+        )
+        groups = candidates_df.groupby(["bucket_id", "band_value"], sort=False).indices
+        for positions in groups.values():
+            members = rows[positions]
+            if len(members) < 2:
+                continue
+            if len(members) > max_bucket_size:
+                pairs = ((members[0], member) for member in members[1:])
+            else:
+                pairs = (
+                    (a, b) for i, a in enumerate(members) for b in members[i + 1 :]
+                )
+            for a, b in pairs:
+                if union_find.find(a) == union_find.find(b):
+                    continue
+                compared_pairs_count += 1
+                if (
+                    cosine_similarity(*get_vector(a), *get_vector(b))
+                    >= similarity_threshold
+                ):
+                    union_find.union(a, b)
+
+    metadata_df["cluster_id"] = [union_find.find(i) for i in range(len(metadata_df))]
+    metadata_df["cluster_size"] = metadata_df.groupby(
+        "cluster_id"
+    ).cluster_id.transform("size")
+    clusters_df = metadata_df[metadata_df.cluster_size > 1].copy()
+    # The cluster id is the index of its first spectrum, the one to keep
+    clusters_df["is_representative"] = clusters_df.cluster_id == clusters_df.index
+    clusters_df["cluster_id"] = clusters_df.groupby("cluster_id", sort=True).ngroup()
+
+    logger.info(
+        f"Found {clusters_df.cluster_id.nunique()} near-duplicate clusters gathering {len(clusters_df)} spectra out of {len(metadata_df)} after {compared_pairs_count} comparisons"
+    )
+
+    return clusters_df.sort_values("cluster_id", kind="stable")[
+        NEAR_DUPLICATES_CLUSTERS_COLUMNS
+    ].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+
+    target_data = "PXD044641_PXD035158"
+    ipc_files = collect_files(BASE_RAW_DATA_DIR / target_data)
+    logger.info(
+        f"Found {len(ipc_files)} IPC files in {BASE_RAW_DATA_DIR / target_data}"
+    )
+
+    csv_dir = get_or_create_folder(BASE_REPORTS_CSV_DIR / target_data)
+    clusters_df = find_near_duplicate_spectra(ipc_files)
+    clusters_df.to_csv(csv_dir / "near_duplicate_spectra_clusters.csv", index=False)
+    logger.info(f"Saved {len(clusters_df)} near-duplicate spectra into {csv_dir}")
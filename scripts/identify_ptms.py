@@ -9,23 +9,28 @@ Script to identify PTMs (Post Translation Modifications) in a AA (Amino Acid) se
 i.e., proteins. The PTMs distribution is pretty much like a gaussian distribution.
 """
 
-import os
 import re
-import sys
+import heapq
+import hashlib
 import itertools
 import logging
 from typing import Iterable
+from collections import Counter
 
 # https://stackoverflow.com/questions/17935130/which-module-should-contain-logging-config-dictconfigmy-dictionary-what-about
 import logging.config  # noqa
 import pandas as pd
 from tqdm import tqdm
-from enum import Enum
-from ordered_set import OrderedSet
 
-# Temporary fix for imports, investigate later
-sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
-from common.utils import collect_files, get_timestamp
+from pathlib import Path
+from common.utils import (
+    collect_files,
+    get_or_create_folder,
+    get_timestamp,
+    prefetch_ipc_files,
+)
+from common.ptms import GLYCOSYLATION_REGEX_TEMPLATE, PTMSitesEnum
+from common.ptms_index import PTMIndexBuilder
 from common.constants import BASE_RAW_DATA_DIR, BASE_PTMS_DIR
 from common.logger import get_logger_config
 
@@ -33,75 +38,307 @@ from common.logger import get_logger_config
 # In[4]:
 
 
-logger_config = get_logger_config(subdir="scripts")
-logging.config.dictConfig(logger_config)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+N_GLYCOSYLATION_REGEX = GLYCOSYLATION_REGEX_TEMPLATE.format(
+    sites=PTMSitesEnum.N_GLYCOSYLATION
+)
+# Regex to capture any ptm of the nature ABC..[n]...
+ANY_PTM_REGEX = GLYCOSYLATION_REGEX_TEMPLATE.format(sites=PTMSitesEnum.ANY)
+ANY_PTM_PATTERN = re.compile(ANY_PTM_REGEX)
 
-class PTMSitesEnum(str, Enum):
+# The ptm classes, mapped to their sites, reported by default by the script.
+# Custom classes can be any string of amino acids e.g. {"phosphorylation": "STY"}.
+DEFAULT_PTM_CLASSES = {
+    "n_glycosylation": PTMSitesEnum.N_GLYCOSYLATION,
+    "o_glycosylation": PTMSitesEnum.O_GLYCOSYLATION,
+    "any": PTMSitesEnum.ANY,
+}
+
+
+class PTMExamplesReservoir:
     """
-    Potential amino acid on which we may have a ptm.
+    Seeded reservoir of distinct example peptides for a single ptm.
+
+    Each distinct modified peptide gets a pseudo-random priority derived from the
+    seed and the peptide itself, and only the `limit` peptides with the smallest
+    priorities are kept (bottom-k sampling). So the sample is uniform over the
+    distinct peptides, it does not depend on the order in which the files are
+    read, and two reservoirs filled by different workers can be merged exactly.
     """
 
-    # Glycosylation only happens on Asparagine within this sequence(Asn-{Any}-Ser/Thr).
-    # But we will just assume that it can happen on any Asparagine for simplicity reasons.
-    N_GLYCOSYLATION = "N"  # Asparagine (N)
-    O_GLYCOSYLATION = "ST"  # Threonine (T) and Serine (S)
-    GLYCOSYLATION = N_GLYCOSYLATION + O_GLYCOSYLATION
-    ANY = "ACDEFGHIKLMNPQRSTVWYacdefghiklmnpqrstvwy"  # noqa
+    def __init__(self, limit: int = 5, seed: int = 0):
+        self.limit = limit
+        self.seed = seed
+        self._key = seed.to_bytes(8, "little", signed=True)
+        # modified_peptide -> (priority, example), gives O(1) membership checks
+        self._examples: dict[str, tuple[int, tuple]] = {}
+        # Max-heap (priorities are negated) of the kept peptides, the root is
+        # the next peptide to evict when a lower priority one comes in.
+        self._heap: list[tuple[int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._examples)
+
+    def __contains__(self, modified_peptide: str) -> bool:
+        return modified_peptide in self._examples
+
+    def priority(self, modified_peptide: str) -> int:
+        digest = hashlib.blake2b(
+            modified_peptide.encode(), digest_size=8, key=self._key
+        ).digest()
+        return int.from_bytes(digest, "little")
+
+    def offer(self, modified_peptide: str, example: tuple) -> bool:
+        """
+        Offer an example for `modified_peptide` to the reservoir. For a given peptide,
+        the lexicographically smallest example tuple (compared on its project and file
+        names, then on its row) is kept, so that the kept examples do not depend on
+        the scanning or merging order.
+
+        Returns:
+            bool: True if the example has been added to the reservoir.
+        """
+        kept = self._examples.get(modified_peptide)
+        if kept is not None:
+            if example < kept[1]:
+                self._examples[modified_peptide] = (kept[0], example)
+            return False
+        return self._push(self.priority(modified_peptide), modified_peptide, example)
+
+    def _push(self, priority: int, modified_peptide: str, example: tuple) -> bool:
+        if len(self._heap) < self.limit:
+            heapq.heappush(self._heap, (-priority, modified_peptide))
+        elif self._heap and priority < -self._heap[0][0]:
+            _, evicted = heapq.heapreplace(self._heap, (-priority, modified_peptide))
+            del self._examples[evicted]
+        else:
+            return False
+
+        self._examples[modified_peptide] = (priority, example)
+        return True
+
+    def merge(self, other: "PTMExamplesReservoir") -> "PTMExamplesReservoir":
+        """
+        Merge `other` into this reservoir (in place). For a peptide present in
+        both reservoirs, the smallest example is kept.
+        """
+        assert (self.limit, self.seed) == (
+            other.limit,
+            other.seed,
+        ), "Cannot merge reservoirs built with different limits or seeds"
+        for modified_peptide, (priority, example) in other._examples.items():
+            kept = self._examples.get(modified_peptide)
+            if kept is None:
+                self._push(priority, modified_peptide, example)
+            elif example < kept[1]:
+                self._examples[modified_peptide] = (priority, example)
+        return self
+
+    def examples(self) -> list[tuple]:
+        """
+        Returns the kept examples sorted by priority.
+        """
+        return [example for _, example in sorted(self._examples.values())]
+
+
+class PTMScanResult:
+    """
+    Mergeable outcome of a ptms scan: the exact occurrence counts of each ptm
+    per project and a reservoir of examples per ptm.
+    """
 
+    def __init__(self, ptm_examples_limit: int = 5, seed: int = 0):
+        self.ptm_examples_limit = ptm_examples_limit
+        self.seed = seed
+        # (amino_acid, glycan_mass) -> Counter({project_name: occurrences})
+        self.occurrences: dict[tuple[str, str], Counter] = {}
+        # (amino_acid, glycan_mass) -> PTMExamplesReservoir
+        self.reservoirs: dict[tuple[str, str], PTMExamplesReservoir] = {}
+        self.modified_peptides_count = 0
+        self.unmodified_peptides_count = 0
+
+    def __len__(self) -> int:
+        return len(self.occurrences)
+
+    def add(self, ptm: tuple[str, str], project_name: str, example: tuple) -> bool:
+        """
+        Count an occurrence of `ptm` in `project_name` and offer `example` (whose
+        last item must be the modified peptide) to the ptm's reservoir.
+
+        Returns:
+            bool: True if the example has been added to the ptm's reservoir.
+        """
+        counter = self.occurrences.get(ptm)
+        if counter is None:
+            counter = self.occurrences[ptm] = Counter()
+            self.reservoirs[ptm] = PTMExamplesReservoir(
+                limit=self.ptm_examples_limit, seed=self.seed
+            )
+        counter[project_name] += 1
+        return self.reservoirs[ptm].offer(example[-1], example)
+
+    def merge(self, other: "PTMScanResult") -> "PTMScanResult":
+        """
+        Merge the result of another scan (e.g. made by another worker) into this
+        one (in place).
+        """
+        for ptm, counter in other.occurrences.items():
+            if ptm in self.occurrences:
+                self.occurrences[ptm].update(counter)
+                self.reservoirs[ptm].merge(other.reservoirs[ptm])
+            else:
+                self.occurrences[ptm] = Counter(counter)
+                self.reservoirs[ptm] = PTMExamplesReservoir(
+                    limit=self.ptm_examples_limit, seed=self.seed
+                ).merge(other.reservoirs[ptm])
+
+        self.modified_peptides_count += other.modified_peptides_count
+        self.unmodified_peptides_count += other.unmodified_peptides_count
+        return self
+
+    def most_common(self) -> list[tuple[tuple[str, str], int]]:
+        """
+        Returns the ptms and their total occurrences, most frequent first.
+        """
+        return sorted(
+            ((ptm, counter.total()) for ptm, counter in self.occurrences.items()),
+            key=lambda item: (-item[1], item[0]),
+        )
+
+    def to_examples_df(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            itertools.chain.from_iterable(
+                self.reservoirs[ptm].examples() for ptm, _ in self.most_common()
+            ),
+            columns=(
+                "amino_acid",
+                "glycan_mass",
+                "project_name",
+                "file_name",
+                "spectrum_id",
+                "ipc_index",
+                "modified_peptide",
+            ),
+        )
+
+    def to_occurrences_df(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            (
+                (*ptm, project_name, occurrences)
+                for ptm, _ in self.most_common()
+                for project_name, occurrences in sorted(self.occurrences[ptm].items())
+            ),
+            columns=("amino_acid", "glycan_mass", "project_name", "occurrences"),
+        )
 
-GLYCOSYLATION_REGEX_TEMPLATE = r"(?P<aa>[{sites}])\[(?P<glycan_mass>\d+)\]"
-N_GLYCOSYLATION_REGEX = GLYCOSYLATION_REGEX_TEMPLATE.format(
-    sites=PTMSitesEnum.N_GLYCOSYLATION
-)
-# Regex to capture any ptm of the nature ABC..[n]...
-ANY_PTM_REGEX = GLYCOSYLATION_REGEX_TEMPLATE.format(sites=PTMSitesEnum.ANY)
 
-ipc_files = collect_files(BASE_RAW_DATA_DIR)
+def get_ptm_classes_routing(ptm_classes: dict[str, str]) -> dict[str, list[str]]:
+    """
+    Map each amino acid to the names of the ptm classes having it as a site.
+
+    Args:
+        ptm_classes (dict): The ptm classes names mapped to their sites.
 
-logger.info(f"Found {len(ipc_files)} IPC files in {BASE_RAW_DATA_DIR}: {ipc_files}")
+    Returns:
+        dict: The amino acids mapped to the ptm classes names.
+    """
+    routing = {}
+    for name, sites in ptm_classes.items():
+        sites = str(getattr(sites, "value", sites))
+        if not sites or not set(sites) <= set(PTMSitesEnum.ANY.value):
+            raise ValueError(
+                f"Invalid sites {sites!r} for the ptm class {name}, expected amino acids among {PTMSitesEnum.ANY.value}"
+            )
+        for amino_acid in set(sites):
+            routing.setdefault(amino_acid, []).append(name)
+    return routing
 
 
 def identify_ptms(
-    ipc_files: list, ptm_examples_limit: int = 5, return_df=True  # noqa
-) -> dict[str : OrderedSet[tuple]] | pd.DataFrame:
+    ipc_files: list,
+    ptm_examples_limit: int = 5,
+    return_df=True,  # noqa
+    seed: int = 0,
+    ptm_classes: dict[str, str] | None = None,
+    prefetch_depth: int = 2,
+    prefetch_max_memory_bytes: int | None = None,
+    index_dir: str | Path | None = None,
+) -> PTMScanResult | pd.DataFrame | dict[str, PTMScanResult | pd.DataFrame]:
     """
     Identify post-translational modifications (PTMs) from a list of IPC files.
 
     This function processes a list of IPC files containing peptide sequences
-    and extracts PTMs. If a PTM is found, its occurrence is tracked efficiently
-    using an OrderedSet just to keep the insertion the processing order. The function
-    limits the number of stored examples per PTM to avoid excessive memory consumption.
+    and extracts PTMs. Every occurrence of a PTM is counted per project, and a
+    seeded reservoir (see `PTMExamplesReservoir`) keeps at most
+    `ptm_examples_limit` distinct example peptides per PTM, so the memory usage
+    only depends on the number of distinct PTMs.
+
+    All the bracketed modifications of a peptide are extracted once and routed
+    to every PTM class (see `DEFAULT_PTM_CLASSES`) having their amino acid as a
+    site, so several reports are built from a single read of the data.
 
     Note: After analyzing the data, we can see that the number of ptm is not huge.
-    So if the number of examples is not huge, this algo will be efficient in
-    terms of memory usage. The data is like few ptms occurs a very huge number
-    of times.
+    The data is like few ptms occurs a very huge number of times.
 
 
     Args:
         ipc_files (list): A list of file paths to IPC files in Feather format.
         ptm_examples_limit (int, optional): The maximum number of examples to store for each PTM.
             Default to 5.
+        return_df (bool, optional): Whether to return the examples as a DataFrame. Default to True.
+        seed (int, optional): The seed of the examples sampling. Default to 0.
+        ptm_classes (dict, optional): The PTM classes names mapped to their sites
+            (a PTMSitesEnum or any string of amino acids). If None, only the N-glycosylation
+            PTMs are identified and a single result is returned.
+        prefetch_depth (int, optional): The number of files read ahead of their processing.
+            Default to 2.
+        prefetch_max_memory_bytes (int, optional): The maximum size in memory of the
+            file being processed and of the files read ahead (see
+            `common.utils.prefetch_ipc_files`). Default to None (no limit).
+        index_dir (str | Path, optional): If given, the inverted index from every ptm
+            to the rows carrying it is written into this directory (see
+            `common.ptms_index`) so that more examples can be read later without
+            scanning the files again. Default to None (no index).
 
     Returns:
-        dict: A dictionary where keys are glycan mass values and values are OrderedSets
-        containing tuples of (glycan_mass, project_name, file_name, spectrum_id, ipc_index).
+        pd.DataFrame | PTMScanResult: A DataFrame of examples with the columns
+        (amino_acid, glycan_mass, project_name, file_name, spectrum_id, ipc_index,
+        modified_peptide) or the whole mergeable scan result if `return_df` is False.
+        When `ptm_classes` is given, a dictionary mapping each class name to its result.
     """
 
-    # Seen ptms
-    seen_ptms = {}
+    single_class = ptm_classes is None
+    if single_class:
+        ptm_classes = {"n_glycosylation": PTMSitesEnum.N_GLYCOSYLATION}
+
+    routing = get_ptm_classes_routing(ptm_classes)
+    results = {
+        name: PTMScanResult(ptm_examples_limit=ptm_examples_limit, seed=seed)
+        for name in ptm_classes
+    }
+
+    index = PTMIndexBuilder(ipc_files) if index_dir is not None else None
 
     # As glob lists files folder by folder, keeping track of the
     # previous project helps us to know when we change a project.
     current_project_name = None
-    modified_peptides_count = 0
-    unmodified_peptides_count = 0
     global_added_examples_count = 0
 
-    for ipc_file in tqdm(ipc_files, desc="Processing IPC files", unit="file"):
+    # The next files are read while the current one is processed
+    prefetched_ipc_files = prefetch_ipc_files(
+        ipc_files, depth=prefetch_depth, max_memory_bytes=prefetch_max_memory_bytes
+    )
+
+    for file_id, (ipc_file, df) in enumerate(
+        tqdm(
+            prefetched_ipc_files,
+            total=len(ipc_files),
+            desc="Processing IPC files",
+            unit="file",
+        )
+    ):
 
         # Grouping the files per project will help to avoid doing this at each iteration
         *_, project_name, file_name = str(ipc_file).split("/")
@@ -110,40 +347,28 @@ def identify_ptms(
             logger.info(f"Start processing the ipc files of the project {project_name}")
             current_project_name = project_name
 
-        df = pd.read_feather(ipc_file)
         # File level added count
         added_examples_count = 0
 
         for sequence_object in df.itertuples(name="SequenceObject"):
-            if sequence_object.modified_peptide is None:
+            if pd.isna(sequence_object.modified_peptide):
                 continue
 
-            # ptms will contain a list of (amino_acid, glycan_mass)
-            ptms: list[tuple[str, str]] = re.findall(  # noqa
-                # Any ptm with square bracket notation
-                N_GLYCOSYLATION_REGEX,  # ANY_PTM_REGEX
-                sequence_object.modified_peptide,
+            # ptms will contain a list of (amino_acid, glycan_mass) for any ptm
+            # with square bracket notation
+            ptms: list[tuple[str, str]] = ANY_PTM_PATTERN.findall(  # noqa
+                sequence_object.modified_peptide
             )
 
-            if not ptms:
-                # Do nothing if there is no ptm
-                logger.debug(
-                    f"No ptm found in {sequence_object.modified_peptide}, skipping..."
-                )
-                unmodified_peptides_count += 1
-                continue
-
-            modified_peptides_count += 1
+            # Names of the ptm classes in which this peptide is modified
+            modified_in = set()
 
             for ptm in ptms:
-                ptm_examples = seen_ptms.get(ptm, OrderedSet())
-                if len(ptm_examples) == ptm_examples_limit:
-                    # ptm examples count reached so, do nothing
-                    continue
+                if index is not None:
+                    index.add(ptm, file_id, sequence_object.Index)
 
-                # A hashable datastructures (here tuple) is necessary for OrderSet to work.
                 # Index and index of peptide respectively represent df index and spectrum index
-                # (amino_acid, glycan_mass, project_name, file_name, spectrum_id, ipc_index)
+                # (amino_acid, glycan_mass, project_name, file_name, spectrum_id, ipc_index, modified_peptide)
                 ptm_example = (
                     *ptm,
                     project_name,
@@ -153,21 +378,24 @@ def identify_ptms(
                     sequence_object.modified_peptide,
                 )
 
-                if ptm_example[-1] in {example[-1] for example in ptm_examples}:
-                    # This is a known/seen example, so continue
-                    logger.debug(f"Skipping already seen ptm example {ptm_example}")
-                    continue
+                for name in routing.get(ptm[0], ()):
+                    modified_in.add(name)
+                    if results[name].add(ptm, project_name, ptm_example):
+                        logger.debug(
+                            f"Adding example {ptm_example} to {name} ptm reservoir"
+                        )
+                        added_examples_count += 1
 
-                elif len(ptm_examples) == 0:
-                    # This is a first-seen ptm
-                    seen_ptms[ptm] = OrderedSet([ptm_example])
-                    logger.debug(f"Adding first seen ptm's example {ptm_example}")
+            if not modified_in:
+                logger.debug(
+                    f"No ptm found in {sequence_object.modified_peptide}, skipping..."
+                )
 
+            for name, result in results.items():
+                if name in modified_in:
+                    result.modified_peptides_count += 1
                 else:
-                    seen_ptms[ptm].add(ptm_example)
-                    logger.debug(f"Adding example {ptm_example} to seen ptm")
-
-                added_examples_count += 1
+                    result.unmodified_peptides_count += 1
 
         global_added_examples_count += added_examples_count
 
@@ -175,33 +403,67 @@ def identify_ptms(
             f"Successfully parsed {project_name}/{file_name} ipc file and added {added_examples_count} new example from it."
         )
 
+    for name, result in results.items():
+        logger.info(
+            f"Process finish for the {name} ptms with {result.unmodified_peptides_count} unmodified peptides found, {result.modified_peptides_count} modified peptides found and {len(result)} ptms found."
+        )
     logger.info(
-        f"Process finish with {unmodified_peptides_count} unmodified peptides found, {modified_peptides_count} modified peptides found, {len(seen_ptms)} ptms added, and {global_added_examples_count} examples added globally."
+        f"Process finish with {global_added_examples_count} examples added globally."
     )
 
-    return (
-        pd.DataFrame(
-            itertools.chain.from_iterable(seen_ptms.values()),
-            columns=(
-                "amino_acid",
-                "glycan_mass",
-                "project_name",
-                "file_name",
-                "spectrum_id",
-                "ipc_index",
-                "modified_peptide",
-            ),
+    if index is not None:
+        index.write(index_dir)
+
+    if return_df:
+        results = {name: result.to_examples_df() for name, result in results.items()}
+
+    return next(iter(results.values())) if single_class else results
+
+
+# In[ ]:
+
+
+def save_ptms_reports(
+    ptms_results: dict[str, PTMScanResult],
+    output_dir: str | Path = BASE_PTMS_DIR,
+    timestamp: str | None = None,
+) -> None:
+    """
+    Save the examples and the occurrences of each ptm class into CSV files.
+    """
+    timestamp = timestamp if timestamp is not None else get_timestamp()
+    get_or_create_folder(output_dir)
+    for ptm_class, ptms_result in ptms_results.items():
+        csv_name = f"{output_dir}/identified_{ptm_class}_ptms_with_{ptms_result.ptm_examples_limit}_examples{timestamp}.csv"
+        counts_csv_name = (
+            f"{output_dir}/identified_{ptm_class}_ptms_occurrences{timestamp}.csv"
+        )
+        ptms_df = ptms_result.to_examples_df()
+        ptms_df.to_csv(csv_name, index=False)
+        logger.info(
+            f"Saved {len(ptms_df)} found {ptm_class} ptm examples into {csv_name} successfully"
+        )
+        ptms_counts_df = ptms_result.to_occurrences_df()
+        ptms_counts_df.to_csv(counts_csv_name, index=False)
+        logger.info(
+            f"Saved the occurrences of {len(ptms_result)} {ptm_class} ptms into {counts_csv_name} successfully"
         )
-        if return_df
-        else seen_ptms
-    )
 
 
 # In[ ]:
 
 
 if __name__ == "__main__":
-    csv_name = f"{BASE_PTMS_DIR}/identified_n_glycosylation_ptms_with_5_examples{get_timestamp()}.csv"
-    ptms_df = identify_ptms(ipc_files)
-    ptms_df.to_csv(csv_name, index=False)
-    logger.info(f"Saved {len(ptms_df)} found ptm examples into {csv_name} successfully")
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+
+    ipc_files = collect_files(BASE_RAW_DATA_DIR)
+    logger.info(f"Found {len(ipc_files)} IPC files in {BASE_RAW_DATA_DIR}: {ipc_files}")
+
+    # All the reports are built from a single read of the data. The ptms index is
+    # optional, see `make build-ptms-index`
+    ptms_results = identify_ptms(
+        ipc_files,
+        return_df=False,
+        ptm_classes=DEFAULT_PTM_CLASSES,
+    )
+    save_ptms_reports(ptms_results)
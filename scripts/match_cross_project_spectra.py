@@ -0,0 +1,354 @@
+"""
+Script to match the spectra of different projects e.g., to check whether PXD044641
+re-measures PXD035158. Two spectra match when they have the same modified peptide
+and precursor charge and their precursor m/z are within a ppm window (and optionally
+their retention times within a tolerance). Exact equality of precursor_mz is useless
+because of the floating point noise.
+
+Only the key columns are read from the files, and they are streamed into partitions
+by a hash of (modified_peptide, precursor_charge) so that only one partition of the
+corpus is in memory at a time. The partitions are joined one after the other with a
+sort-merge join: the keys of each project are sorted by
+(modified_peptide, precursor_charge, precursor_mz) and the window of each spectrum
+in the other project is found by binary search, so no cartesian product is built.
+The match pairs of each partition are written out as soon as it is joined.
+"""
+
+import itertools
+import logging
+import logging.config  # noqa
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pathlib import Path
+from functools import partial
+from typing import Callable
+from tqdm import tqdm
+
+from common.utils import (
+    collect_files,
+    get_or_create_folder,
+    get_project_name,
+    prefetch_ipc_files,
+    read_data_file,
+)
+from common.constants import BASE_RAW_DATA_DIR, BASE_REPORTS_CSV_DIR
+from common.logger import get_logger_config
+
+logger = logging.getLogger(__name__)
+
+MATCHING_COLUMNS = ["modified_peptide", "precursor_charge", "precursor_mz", "rt"]
+MATCHING_KEYS_SCHEMA = pa.schema(
+    [
+        ("project_name", pa.string()),
+        ("file_name", pa.string()),
+        ("ipc_index", pa.int64()),
+        ("modified_peptide", pa.string()),
+        ("precursor_charge", pa.int64()),
+        ("precursor_mz", pa.float64()),
+        ("rt", pa.float64()),
+    ]
+)
+PAIRS_COLUMNS = [
+    "modified_peptide",
+    "precursor_charge",
+    "left_project_name",
+    "left_file_name",
+    "left_ipc_index",
+    "right_project_name",
+    "right_file_name",
+    "right_ipc_index",
+    "ppm_error",
+    "rt_delta",
+]
+PAIRS_ORDER = [
+    "left_project_name",
+    "right_project_name",
+    "left_file_name",
+    "left_ipc_index",
+    "right_file_name",
+    "right_ipc_index",
+]
+OVERLAPS_COLUMNS = [
+    "left_project_name",
+    "right_project_name",
+    "left_spectra_count",
+    "right_spectra_count",
+    "matches_count",
+    "left_matched_spectra_count",
+    "right_matched_spectra_count",
+]
+
+
+def partition_matching_keys(
+    ipc_files: list,
+    partitions_dir: str | Path,
+    partitions_count: int,
+    get_project_name: Callable[[str | Path], str] = get_project_name,
+) -> dict:
+    """
+    Stream the matching keys of the spectra, one file after the other, into
+    `partitions_count` IPC files of `partitions_dir` by a hash of
+    (modified_peptide, precursor_charge), so that the spectra which can match are
+    always in the same partition. The spectra without a peptide or an integral
+    charge can not match and are dropped.
+
+    Returns:
+        dict: The paths of the written partitions and the spectra count of each
+        project.
+    """
+    reader = partial(read_data_file, columns=MATCHING_COLUMNS)
+    writers, projects_counts = {}, {}
+    try:
+        for ipc_file, df in tqdm(
+            prefetch_ipc_files(ipc_files, reader=reader),
+            total=len(ipc_files),
+            desc="Partitioning matching keys",
+            unit="file",
+        ):
+            project_name = get_project_name(ipc_file)
+            df.insert(0, "project_name", project_name)
+            df.insert(1, "file_name", Path(ipc_file).name)
+            df.insert(2, "ipc_index", np.arange(len(df)))
+            df = df.dropna(subset=["modified_peptide", "precursor_charge"])
+            df = df[df.precursor_charge % 1 == 0]
+            # The same key must hash the same whatever the dtypes of the file
+            df = df.astype({"modified_peptide": object, "precursor_charge": "int64"})
+            projects_counts[project_name] = projects_counts.get(project_name, 0)
+            projects_counts[project_name] += len(df)
+            partitions = pd.util.hash_pandas_object(
+                df[["modified_peptide", "precursor_charge"]], index=False
+            ).to_numpy() % np.uint64(partitions_count)
+            for partition, partition_df in df.groupby(partitions, sort=False):
+                if partition not in writers:
+                    writers[partition] = pa.ipc.new_file(
+                        Path(partitions_dir) / f"partition_{partition}.ipc",
+                        MATCHING_KEYS_SCHEMA,
+                    )
+                writers[partition].write_table(
+                    pa.Table.from_pandas(
+                        partition_df, schema=MATCHING_KEYS_SCHEMA, preserve_index=False
+                    )
+                )
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return {
+        "partition_files": sorted(
+            Path(partitions_dir) / f"partition_{partition}.ipc" for partition in writers
+        ),
+        "projects_counts": projects_counts,
+    }
+
+
+def search_windows(
+    sorted_groups: np.ndarray,
+    sorted_values: np.ndarray,
+    groups: np.ndarray,
+    lower_bounds: np.ndarray,
+    upper_bounds: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find, for every query, the range [start, end) of the sorted (by group then by value)
+    items having the query group and a value within [lower_bound, upper_bound].
+
+    All the queries are bisected at once, within their group.
+    """
+
+    def bisect(bounds: np.ndarray, right: bool) -> np.ndarray:
+        low = np.searchsorted(sorted_groups, groups, side="left")
+        high = np.searchsorted(sorted_groups, groups, side="right")
+        while True:
+            active = low < high
+            if not active.any():
+                return low
+            middle = (low + high) // 2
+            middle_values = sorted_values[np.minimum(middle, len(sorted_values) - 1)]
+            go_right = (
+                middle_values <= bounds if right else middle_values < bounds
+            ) & active
+            low = np.where(go_right, middle + 1, low)
+            high = np.where(active & ~go_right, middle, high)
+
+    return bisect(lower_bounds, right=False), bisect(upper_bounds, right=True)
+
+
+def match_projects(
+    left_df: pd.DataFrame,
+    right_df: pd.DataFrame,
+    ppm_tolerance: float = 10.0,
+    rt_tolerance: float | None = None,
+) -> pd.DataFrame:
+    """
+    Match the spectra of two projects (see the module docstring). Both DataFrames
+    must have a `group` column encoding (modified_peptide, precursor_charge).
+
+    Returns:
+        pd.DataFrame: The (left, right) positional indices of the matching spectra
+        with their ppm error and retention time delta.
+    """
+    order = np.lexsort((right_df.precursor_mz.to_numpy(), right_df.group.to_numpy()))
+    right_groups = right_df.group.to_numpy()[order]
+    right_mz = right_df.precursor_mz.to_numpy(dtype=np.float64)[order]
+
+    left_mz = left_df.precursor_mz.to_numpy(dtype=np.float64)
+    tolerance = left_mz * ppm_tolerance * 1e-6
+    starts, ends = search_windows(
+        right_groups,
+        right_mz,
+        left_df.group.to_numpy(),
+        left_mz - tolerance,
+        left_mz + tolerance,
+    )
+
+    # Expand the windows into pairs
+    counts = ends - starts
+    left_indices = np.repeat(np.arange(len(left_df)), counts)
+    right_positions = np.repeat(
+        starts - np.cumsum(counts) + counts, counts
+    ) + np.arange(counts.sum())
+    right_indices = order[right_positions]
+
+    pairs_df = pd.DataFrame(
+        {
+            "left_index": left_indices,
+            "right_index": right_indices,
+            "ppm_error": (right_mz[right_positions] - left_mz[left_indices])
+            / left_mz[left_indices]
+            * 1e6,
+            "rt_delta": right_df.rt.to_numpy(dtype=np.float64)[right_indices]
+            - left_df.rt.to_numpy(dtype=np.float64)[left_indices],
+        }
+    )
+    if rt_tolerance is not None:
+        pairs_df = pairs_df[pairs_df.rt_delta.abs() <= rt_tolerance]
+    return pairs_df.reset_index(drop=True)
+
+
+def match_cross_project_spectra(
+    ipc_files: list,
+    pairs_path: str | Path,
+    ppm_tolerance: float = 10.0,
+    rt_tolerance: float | None = None,
+    get_project_name: Callable[[str | Path], str] = get_project_name,
+    partitions_count: int = 64,
+) -> pd.DataFrame:
+    """
+    Match the spectra of every pair of projects. The match pairs are written into a
+    CSV file as the partitions are joined, so that only the overlap counts are kept
+    in memory.
+
+    Args:
+        ipc_files (list): A list of file paths to IPC files.
+        pairs_path (str | Path): The CSV file the match pairs are written into,
+            sorted within each partition.
+        ppm_tolerance (float): The precursor m/z tolerance in ppm. Default to 10.
+        rt_tolerance (float, optional): The retention time tolerance. Default to None
+            (retention times are not compared).
+        get_project_name (Callable): Returns the project of a file. Default to the
+            name of the folder of the file.
+        partitions_count (int): The number of partitions of the keys, only one of
+            them is in memory at a time. Default to 64.
+
+    Returns:
+        pd.DataFrame: The overlap counts of each pair of projects.
+    """
+    pd.DataFrame(columns=PAIRS_COLUMNS).to_csv(pairs_path, index=False)
+
+    with tempfile.TemporaryDirectory() as partitions_dir:
+        partitioned = partition_matching_keys(
+            ipc_files, partitions_dir, partitions_count, get_project_name
+        )
+        projects_counts = partitioned["projects_counts"]
+        projects_pairs = list(itertools.combinations(sorted(projects_counts), 2))
+        # (left project, right project) -> [matches, left matched, right matched]
+        counts = {projects_pair: [0, 0, 0] for projects_pair in projects_pairs}
+
+        for partition_file in tqdm(
+            partitioned["partition_files"], desc="Joining partitions", unit="partition"
+        ):
+            keys_df = pa.ipc.open_file(partition_file).read_all().to_pandas()
+            keys_df["group"] = keys_df.groupby(
+                ["modified_peptide", "precursor_charge"], sort=False
+            ).ngroup()
+            projects = dict(list(keys_df.groupby("project_name", sort=True)))
+
+            pairs = []
+            for left_project, right_project in projects_pairs:
+                if left_project not in projects or right_project not in projects:
+                    continue
+                left_df, right_df = projects[left_project], projects[right_project]
+                pairs_df = match_projects(
+                    left_df, right_df, ppm_tolerance, rt_tolerance
+                )
+
+                left_matches = left_df.iloc[pairs_df.left_index].reset_index(drop=True)
+                right_matches = right_df.iloc[pairs_df.right_index].reset_index(
+                    drop=True
+                )
+                pairs.append(
+                    pd.DataFrame(
+                        {
+                            "modified_peptide": left_matches.modified_peptide,
+                            "precursor_charge": left_matches.precursor_charge,
+                            "left_project_name": left_project,
+                            "left_file_name": left_matches.file_name,
+                            "left_ipc_index": left_matches.ipc_index,
+                            "right_project_name": right_project,
+                            "right_file_name": right_matches.file_name,
+                            "right_ipc_index": right_matches.ipc_index,
+                            "ppm_error": pairs_df.ppm_error,
+                            "rt_delta": pairs_df.rt_delta,
+                        }
+                    )
+                )
+                # A spectrum is in a single partition, so the counts add up
+                pair_counts = counts[(left_project, right_project)]
+                pair_counts[0] += len(pairs_df)
+                pair_counts[1] += pairs_df.left_index.nunique()
+                pair_counts[2] += pairs_df.right_index.nunique()
+
+            if pairs:
+                pd.concat(pairs, ignore_index=True).sort_values(
+                    PAIRS_ORDER, kind="stable"
+                ).to_csv(pairs_path, mode="a", header=False, index=False)
+
+    overlaps = []
+    for (left_project, right_project), (
+        matches_count,
+        left_matched_count,
+        right_matched_count,
+    ) in counts.items():
+        overlaps.append(
+            {
+                "left_project_name": left_project,
+                "right_project_name": right_project,
+                "left_spectra_count": projects_counts[left_project],
+                "right_spectra_count": projects_counts[right_project],
+                "matches_count": matches_count,
+                "left_matched_spectra_count": left_matched_count,
+                "right_matched_spectra_count": right_matched_count,
+            }
+        )
+        logger.info(
+            f"Matched {left_matched_count}/{projects_counts[left_project]} spectra of {left_project} with {right_matched_count}/{projects_counts[right_project]} spectra of {right_project}"
+        )
+    return pd.DataFrame(overlaps, columns=OVERLAPS_COLUMNS)
+
+
+if __name__ == "__main__":
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+
+    ipc_files = collect_files(BASE_RAW_DATA_DIR)
+    logger.info(f"Found {len(ipc_files)} IPC files in {BASE_RAW_DATA_DIR}")
+
+    csv_dir = get_or_create_folder(BASE_REPORTS_CSV_DIR / "cross_project_matching")
+    overlaps_df = match_cross_project_spectra(
+        ipc_files, csv_dir / "cross_project_matches.csv"
+    )
+    overlaps_df.to_csv(csv_dir / "cross_project_overlaps.csv", index=False)
+    logger.info(
+        f"Saved {overlaps_df.matches_count.sum()} cross project matches into {csv_dir}"
+    )
@@ -0,0 +1,293 @@
+"""
+Script to plot the m/z vs intensity density of all the peaks of the corpus. Drawing
+every peak of millions of spectra is not possible, so the peaks are rasterized into
+a fixed 2D histogram (m/z bins x intensity bins) while the files are streamed, then
+the histogram is rendered once. The memory usage only depends on the grid size, and
+grids accumulated separately (e.g. by different workers) are merged by summing them.
+
+The peaks can be grouped e.g. by precursor charge or by project, one grid per group.
+"""
+
+import logging
+import logging.config  # noqa
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from functools import partial
+from typing import Callable
+from tqdm import tqdm
+
+from common.utils import (
+    collect_files,
+    get_or_create_folder,
+    get_project_name,
+    prefetch_ipc_files,
+    read_data_table,
+)
+from common.spectra import flatten_peaks, get_segment_ids
+from common.constants import BASE_PLOTS_DIR, BASE_RAW_DATA_DIR
+from common.logger import get_logger_config
+
+logger = logging.getLogger(__name__)
+
+# Group of the peaks when they are not grouped
+ALL_PEAKS_GROUP = "all"
+
+
+class PeakDensityGrid:
+    """
+    Mergeable 2D histogram of the peaks (m/z x intensity), one per group of peaks.
+
+    The bins are fixed at construction so that any two grids with the same settings
+    can be merged. With `log_intensity`, the intensities are binned on a log10 scale
+    (and `intensity_range` is in log10 units), which suits the raw intensities
+    spanning several orders of magnitude.
+    """
+
+    def __init__(
+        self,
+        mz_range: tuple[float, float] = (0.0, 2500.0),
+        intensity_range: tuple[float, float] = (0.0, 10.0),
+        bins: tuple[int, int] = (1000, 500),
+        log_intensity: bool = True,
+    ):
+        self.mz_range = tuple(mz_range)
+        self.intensity_range = tuple(intensity_range)
+        self.bins = tuple(bins)
+        self.log_intensity = log_intensity
+        # group -> counts of shape bins
+        self.counts: dict = {}
+        # Peaks out of the ranges (or with a non positive intensity in log scale)
+        self.dropped_peaks_count = 0
+
+    @property
+    def settings(self) -> tuple:
+        return self.mz_range, self.intensity_range, self.bins, self.log_intensity
+
+    def _get_bins(self, values: np.ndarray, value_range: tuple, bins: int):
+        low, high = value_range
+        valid = (values >= low) & (values < high)
+        indices = np.zeros(len(values), dtype=np.int64)
+        indices[valid] = ((values[valid] - low) * (bins / (high - low))).astype(
+            np.int64
+        )
+        # Rounding may give `bins` for the values just below `high`
+        return np.minimum(indices, bins - 1), valid
+
+    def add(
+        self,
+        mz: np.ndarray,
+        intensity: np.ndarray,
+        offsets: np.ndarray | None = None,
+        groups: np.ndarray | None = None,
+    ) -> None:
+        """
+        Add flattened peaks to the grid.
+
+        Args:
+            mz (np.ndarray): The m/z of the peaks.
+            intensity (np.ndarray): The intensities of the peaks.
+            offsets (np.ndarray, optional): The offsets of the spectra in the flattened
+                arrays, needed to group the peaks.
+            groups (np.ndarray, optional): The group of each spectrum (the spectra
+                with a null group are dropped). Default to a single group.
+        """
+        if self.log_intensity:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                intensity = np.log10(intensity)
+
+        mz_bins, mz_valid = self._get_bins(mz, self.mz_range, self.bins[0])
+        intensity_bins, intensity_valid = self._get_bins(
+            intensity, self.intensity_range, self.bins[1]
+        )
+        flat_bins = mz_bins * self.bins[1] + intensity_bins
+        valid = mz_valid & intensity_valid
+
+        if groups is None:
+            group_codes = np.zeros(len(mz), dtype=np.int64)
+            group_names = [ALL_PEAKS_GROUP]
+        else:
+            codes, group_names = pd.factorize(np.asarray(groups))
+            group_codes = codes[get_segment_ids(offsets)]
+            valid &= group_codes >= 0
+
+        self.dropped_peaks_count += int(len(mz) - valid.sum())
+        bins_count = self.bins[0] * self.bins[1]
+        counts = np.bincount(
+            group_codes[valid] * bins_count + flat_bins[valid],
+            minlength=len(group_names) * bins_count,
+        ).reshape(len(group_names), *self.bins)
+        for group, group_counts in zip(group_names, counts):
+            group = group.item() if isinstance(group, np.generic) else group
+            if group in self.counts:
+                self.counts[group] += group_counts
+            else:
+                self.counts[group] = group_counts
+
+    def merge(self, other: "PeakDensityGrid") -> "PeakDensityGrid":
+        assert (
+            self.settings == other.settings
+        ), "Cannot merge grids with different ranges, bins or scales"
+        for group, counts in other.counts.items():
+            if group in self.counts:
+                self.counts[group] = self.counts[group] + counts
+            else:
+                self.counts[group] = counts.copy()
+        self.dropped_peaks_count += other.dropped_peaks_count
+        return self
+
+    def get_counts(self, group=None) -> np.ndarray:
+        """
+        Returns the counts of a group, or of all the peaks if `group` is None.
+        """
+        if group is not None:
+            return self.counts[group]
+        return sum(self.counts.values(), np.zeros(self.bins, dtype=np.int64))
+
+    def get_edges(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the m/z and intensity (log10 if `log_intensity`) bins edges.
+        """
+        return (
+            np.linspace(*self.mz_range, self.bins[0] + 1),
+            np.linspace(*self.intensity_range, self.bins[1] + 1),
+        )
+
+    def to_df(self) -> pd.DataFrame:
+        """
+        Returns the non empty bins with the columns (group, mz_start, intensity_start,
+        count), the intensity starts being log10 values if `log_intensity`.
+        """
+        mz_edges, intensity_edges = self.get_edges()
+        rows = []
+        for group, counts in self.counts.items():
+            mz_bins, intensity_bins = np.nonzero(counts)
+            rows.append(
+                pd.DataFrame(
+                    {
+                        "group": group,
+                        "mz_start": mz_edges[mz_bins],
+                        "intensity_start": intensity_edges[intensity_bins],
+                        "count": counts[mz_bins, intensity_bins],
+                    }
+                )
+            )
+        if not rows:
+            return pd.DataFrame(
+                columns=["group", "mz_start", "intensity_start", "count"]
+            )
+        return pd.concat(rows, ignore_index=True)
+
+
+def accumulate_peak_density(
+    ipc_files: list,
+    group_by: str | None = None,
+    get_project_name: Callable[[str | Path], str] = get_project_name,
+    prefetch_depth: int = 2,
+    **kwargs,
+) -> PeakDensityGrid:
+    """
+    Rasterize the peaks of the files into a density grid, one file after the other.
+
+    Args:
+        ipc_files (list): The data files.
+        group_by (str, optional): "project" or the name of a column (e.g.
+            "precursor_charge") to group the peaks by. Default to None (no groups).
+        get_project_name (Callable): The project of a file, when grouping by project.
+        kwargs: The settings of the `PeakDensityGrid`.
+
+    Returns:
+        PeakDensityGrid: The grid.
+    """
+    grid = PeakDensityGrid(**kwargs)
+    columns = ["mz", "intensity"]
+    if group_by not in (None, "project"):
+        columns.append(group_by)
+
+    reader = partial(read_data_table, columns=columns)
+    for ipc_file, table in tqdm(
+        prefetch_ipc_files(ipc_files, depth=prefetch_depth, reader=reader),
+        total=len(ipc_files),
+        desc="Rasterizing peaks",
+        unit="file",
+    ):
+        mz, intensity, offsets, mismatched = flatten_peaks(
+            table["mz"], table["intensity"]
+        )
+        if mismatched.any():
+            logger.warning(
+                f"Skipping {mismatched.sum()} spectra of {ipc_file} whose mz and intensity lists have different lengths"
+            )
+        if group_by is None:
+            groups = None
+        elif group_by == "project":
+            groups = np.full(table.num_rows, get_project_name(ipc_file), dtype=object)
+        else:
+            groups = table[group_by].to_numpy()
+        grid.add(mz, intensity, offsets, groups)
+    return grid
+
+
+def plot_peak_density(
+    grid: PeakDensityGrid,
+    group=None,
+    log_counts: bool = True,
+    ax=None,
+    title: str | None = None,
+):
+    """
+    Render the grid of a group (or of all the peaks) as an image.
+
+    Args:
+        grid (PeakDensityGrid): The grid.
+        group (optional): The group to render. Default to all the peaks.
+        log_counts (bool): Whether to use a log color scale. Default to True.
+        ax (matplotlib.axes.Axes, optional): The axes to draw on.
+        title (str, optional): The title of the plot.
+
+    Returns:
+        matplotlib.axes.Axes: The axes.
+    """
+    # Imported here as only the rendering needs matplotlib
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+
+    counts = np.ma.masked_equal(grid.get_counts(group), 0)
+    if ax is None:
+        _, ax = plt.subplots(figsize=(10, 6))
+    image = ax.imshow(
+        counts.T,
+        origin="lower",
+        aspect="auto",
+        interpolation="nearest",
+        extent=(*grid.mz_range, *grid.intensity_range),
+        norm=LogNorm() if log_counts else None,
+        cmap="viridis",
+    )
+    ax.figure.colorbar(image, ax=ax, label="Peaks count")
+    ax.set_xlabel("m/z")
+    ax.set_ylabel("log10(Intensity)" if grid.log_intensity else "Intensity")
+    ax.set_title(
+        title
+        or f"m/z vs. Intensity density of the {'' if group is None else f'{group} '}peaks"
+    )
+    return ax
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+
+    raw_files = collect_files(BASE_RAW_DATA_DIR)
+    logger.info(f"Found {len(raw_files)} IPC files to rasterize in {BASE_RAW_DATA_DIR}")
+    plots_dir = get_or_create_folder(BASE_PLOTS_DIR / "peak_density")
+
+    peak_density = accumulate_peak_density(raw_files, group_by="project")
+    for group in [None, *peak_density.counts]:
+        plot_peak_density(peak_density, group)
+        name = "all" if group is None else group
+        save_path = Path(plots_dir) / f"mz_vs_intensity_density_{name}.png"
+        plt.savefig(save_path, bbox_inches="tight")
+        plt.close()
+        logger.info(f"Saved the peak density plot into {save_path}")
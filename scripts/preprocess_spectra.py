@@ -0,0 +1,139 @@
+"""
+Script to preprocess the spectra of the raw data for the model input and write them
+into the processed data directory. The mz and intensity list columns of whole record
+batches are preprocessed at once on their flattened buffers (see
+`common.spectra.preprocess_spectra`), the other columns are kept as they are.
+"""
+
+import logging
+import logging.config  # noqa
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from pathlib import Path
+from tqdm import tqdm
+
+from common.utils import collect_files, get_or_create_folder, read_data_table
+from common.spectra import flatten_peaks, preprocess_spectra
+from common.constants import BASE_PROCESSED_DATA_DIR, BASE_RAW_DATA_DIR
+from common.logger import get_logger_config
+
+logger = logging.getLogger(__name__)
+
+# Rows per record batch, the peak buffers of a batch are processed at once
+DEFAULT_BATCH_SIZE = 16_384
+
+
+def preprocess_record_batch(batch: pa.RecordBatch, **kwargs) -> pa.RecordBatch:
+    """
+    Preprocess the mz and intensity columns of a record batch.
+
+    Args:
+        batch (pa.RecordBatch): The batch, with mz, intensity and precursor_mz columns
+            (and optionally scale_factor).
+        kwargs: The parameters of `preprocess_spectra`.
+
+    Returns:
+        pa.RecordBatch: The batch with its mz and intensity columns preprocessed,
+        without the spectra whose mz and intensity lists have different lengths.
+    """
+    mz, intensity, offsets, mismatched = flatten_peaks(
+        batch.column("mz"), batch.column("intensity")
+    )
+    precursor_mz = batch.column("precursor_mz").to_numpy(zero_copy_only=False)
+    scale_factor = (
+        batch.column("scale_factor").to_numpy(zero_copy_only=False)
+        if "scale_factor" in batch.schema.names
+        else None
+    )
+
+    mz, intensity, offsets = preprocess_spectra(
+        mz, intensity, offsets, precursor_mz, scale_factor=scale_factor, **kwargs
+    )
+
+    offsets = pa.array(offsets.astype(np.int32))
+    columns = dict(zip(batch.schema.names, batch.columns))
+    for name, values in (("mz", mz), ("intensity", intensity)):
+        # Keep the original values type (e.g. float32 intensities)
+        value_type = batch.schema.field(name).type.value_type
+        columns[name] = pa.ListArray.from_arrays(
+            offsets, pa.array(values).cast(value_type)
+        )
+    batch = pa.RecordBatch.from_pydict(columns)
+    if mismatched.any():
+        logger.warning(
+            f"Dropping {mismatched.sum()} spectra whose mz and intensity lists have different lengths"
+        )
+        batch = batch.filter(pa.array(~mismatched))
+    return batch
+
+
+def preprocess_file(
+    source: str | Path,
+    target: str | Path,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    **kwargs,
+) -> int:
+    """
+    Preprocess the spectra of a file batch by batch into an Arrow IPC file.
+
+    Returns:
+        int: The number of peaks kept.
+    """
+    table = read_data_table(source)
+    # An empty file still gives an (empty) preprocessed file
+    batches = table.to_batches(max_chunksize=batch_size) or [
+        pa.RecordBatch.from_pylist([], schema=table.schema)
+    ]
+    peaks_count = 0
+    writer = None
+    try:
+        for batch in batches:
+            batch = preprocess_record_batch(batch, **kwargs)
+            if writer is None:
+                writer = ipc.new_file(
+                    str(target),
+                    batch.schema,
+                    options=ipc.IpcWriteOptions(compression="zstd"),
+                )
+            writer.write_batch(batch)
+            peaks_count += len(batch.column("mz").values)
+    finally:
+        if writer is not None:
+            writer.close()
+    return peaks_count
+
+
+def preprocess_files(
+    file_paths: list,
+    source_dir: str | Path = BASE_RAW_DATA_DIR,
+    target_dir: str | Path = BASE_PROCESSED_DATA_DIR,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    **kwargs,
+) -> list[Path]:
+    """
+    Preprocess files keeping their tree (relative to `source_dir`) under `target_dir`.
+
+    Returns:
+        list: The preprocessed files.
+    """
+    targets = []
+    for file_path in tqdm(file_paths, desc="Preprocessing spectra", unit="file"):
+        target = Path(target_dir) / Path(file_path).relative_to(source_dir)
+        get_or_create_folder(target.parent)
+        peaks_count = preprocess_file(file_path, target, batch_size, **kwargs)
+        targets.append(target)
+        logger.info(
+            f"Preprocessed {file_path} into {target} keeping {peaks_count} peaks"
+        )
+    return targets
+
+
+if __name__ == "__main__":
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+
+    raw_files = collect_files(BASE_RAW_DATA_DIR)
+    logger.info(
+        f"Found {len(raw_files)} IPC files to preprocess in {BASE_RAW_DATA_DIR}"
+    )
+    preprocess_files(raw_files)
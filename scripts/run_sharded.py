@@ -0,0 +1,448 @@
+"""
+Script to run a stage (ptms identification, statistics, duplicates counting or peak
+density) over the corpus with any number of worker processes, on one node or on
+several nodes sharing a filesystem (see `common.sharding`). Each worker writes the
+partial result of every file it processes, and the reduce command merges them into
+the reports.
+
+Usage:
+    python -m scripts.run_sharded submit --queue-dir QUEUE --stage identify_ptms
+    python -m scripts.run_sharded work --queue-dir QUEUE  # On every node, as many times as wanted
+    python -m scripts.run_sharded reduce --queue-dir QUEUE
+    python -m scripts.run_sharded run --queue-dir QUEUE --stage statistics --workers 4  # All at once, locally
+"""
+
+import json
+import argparse
+import logging
+import logging.config  # noqa
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import multiprocessing
+from pathlib import Path
+from functools import partial
+from collections import Counter
+
+from common.utils import (
+    collect_files,
+    get_or_create_folder,
+    read_data_file,
+    read_data_schema,
+    read_data_table,
+)
+from common.spectra import flatten_list_column
+from common.cache import get_file_fingerprint
+from common.sharding import WorkQueue, run_worker
+from common.constants import BASE_RAW_DATA_DIR, BASE_REPORTS_CSV_DIR
+from common.logger import get_logger_config
+from scripts.identify_ptms import DEFAULT_PTM_CLASSES, identify_ptms
+from scripts.plot_peak_density import PeakDensityGrid, accumulate_peak_density
+
+logger = logging.getLogger(__name__)
+
+STATISTICS_NUMERIC_COLUMNS = [
+    "precursor_mz",
+    "precursor_charge",
+    "rt",
+    "delta_mass",
+    "precursor_intensity",
+    "collision_energy",
+]
+STATISTICS_CATEGORICAL_COLUMNS = [
+    "peptide",
+    "modified_peptide",
+    "protein",
+    "precursor_charge",
+]
+
+DEFAULT_DEDUP_COMBINATIONS = [
+    ["peptide", "modified_peptide", "precursor_charge"],
+    ["peptide", "modified_peptide", "precursor_mz", "precursor_charge"],
+    [
+        "peptide",
+        "modified_peptide",
+        "precursor_mz",
+        "precursor_charge",
+        "mz",
+        "intensity",
+    ],
+]
+
+
+# PTMs identification
+
+
+def map_identify_ptms(file_path: str, ptm_examples_limit: int = 5, seed: int = 0):
+    return identify_ptms(
+        [file_path],
+        ptm_examples_limit=ptm_examples_limit,
+        return_df=False,
+        seed=seed,
+        ptm_classes=DEFAULT_PTM_CLASSES,
+        prefetch_depth=1,
+    )
+
+
+def reduce_identify_ptms(partial_results: list, **_) -> dict[str, pd.DataFrame]:
+    merged = {}
+    for results in partial_results:
+        for ptm_class, result in results.items():
+            if ptm_class in merged:
+                merged[ptm_class].merge(result)
+            else:
+                merged[ptm_class] = result
+
+    reports = {}
+    for ptm_class, result in merged.items():
+        reports[f"identified_{ptm_class}_ptms_examples"] = result.to_examples_df()
+        reports[f"identified_{ptm_class}_ptms_occurrences"] = result.to_occurrences_df()
+    return reports
+
+
+# Statistics
+
+
+def map_statistics(file_path: str, **_) -> dict:
+    """
+    Mergeable statistics of a file: (count, mean, M2, min, max) of the numeric columns
+    (M2 being the sum of the squared deviations to the mean) and value counts of the
+    categorical ones.
+    """
+    schema_columns = set(read_data_schema(file_path).names)
+    df = read_data_file(
+        file_path,
+        columns=[
+            column
+            for column in dict.fromkeys(
+                STATISTICS_NUMERIC_COLUMNS + STATISTICS_CATEGORICAL_COLUMNS
+            )
+            if column in schema_columns
+        ],
+    )
+    numeric = {}
+    for column in STATISTICS_NUMERIC_COLUMNS:
+        if column not in df:
+            continue
+        values = df[column].dropna().to_numpy(dtype=np.float64)
+        if len(values):
+            mean = values.mean()
+            numeric[column] = (
+                len(values),
+                mean,
+                ((values - mean) ** 2).sum(),
+                values.min(),
+                values.max(),
+            )
+    categorical = {
+        column: Counter(df[column].dropna().value_counts().to_dict())
+        for column in STATISTICS_CATEGORICAL_COLUMNS
+        if column in df
+    }
+    return {"rows_count": len(df), "numeric": numeric, "categorical": categorical}
+
+
+def merge_moments(left: tuple, right: tuple) -> tuple:
+    """
+    Merge two (count, mean, M2, min, max) with the Chan et al. parallel algorithm.
+    """
+    count_a, mean_a, m2_a, min_a, max_a = left
+    count_b, mean_b, m2_b, min_b, max_b = right
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    return (
+        count,
+        mean_a + delta * count_b / count,
+        m2_a + m2_b + delta**2 * count_a * count_b / count,
+        min(min_a, min_b),
+        max(max_a, max_b),
+    )
+
+
+def reduce_statistics(
+    partial_results: list, top_n: int = 100, **_
+) -> dict[str, pd.DataFrame]:
+    rows_count, numeric, categorical = 0, {}, {}
+    for result in partial_results:
+        rows_count += result["rows_count"]
+        for column, moments in result["numeric"].items():
+            numeric[column] = (
+                merge_moments(numeric[column], moments)
+                if column in numeric
+                else moments
+            )
+        for column, counter in result["categorical"].items():
+            categorical.setdefault(column, Counter()).update(counter)
+
+    statistics_df = pd.DataFrame(
+        {
+            column: {
+                "count": count,
+                "mean": mean,
+                "std": np.sqrt(m2 / (count - 1)) if count > 1 else np.nan,
+                "min": minimum,
+                "max": maximum,
+            }
+            for column, (count, mean, m2, minimum, maximum) in numeric.items()
+        }
+    )
+    value_counts_df = pd.DataFrame(
+        [
+            (column, value, count)
+            for column, counter in categorical.items()
+            for value, count in counter.most_common(top_n)
+        ],
+        columns=["column", "value", "count"],
+    )
+    unique_counts_df = pd.DataFrame(
+        [(column, len(counter)) for column, counter in categorical.items()],
+        columns=["column", "unique_count"],
+    )
+    logger.info(f"Computed the statistics of {rows_count} rows")
+    return {
+        "columns_statistics": statistics_df.reset_index(names="statistic"),
+        "value_counts": value_counts_df,
+        "unique_counts": unique_counts_df,
+    }
+
+
+# Duplicates
+
+
+def hash_rows(table: pa.Table, columns: list[str]) -> np.ndarray:
+    """
+    64-bit hash of each row of the table over `columns`. The list columns (e.g. mz)
+    are hashed from their values and positions, without any python loop over the rows.
+    """
+    list_columns = [
+        c
+        for c in columns
+        if pa.types.is_list(table.schema.field(c).type)
+        or pa.types.is_large_list(table.schema.field(c).type)
+    ]
+    scalar_columns = [c for c in columns if c not in list_columns]
+
+    hashes = (
+        pd.util.hash_pandas_object(
+            table.select(scalar_columns).to_pandas(), index=False
+        ).to_numpy()
+        if scalar_columns
+        else np.zeros(table.num_rows, dtype=np.uint64)
+    )
+    with np.errstate(over="ignore"):
+        for column in list_columns:
+            values, offsets = flatten_list_column(table[column])
+            lengths = np.diff(offsets)
+            positions = np.arange(len(values)) - np.repeat(offsets[:-1], lengths)
+            peak_hashes = pd.util.hash_array(values) ^ pd.util.hash_array(positions)
+
+            # Sum (modulo 2**64) of the peak hashes of each row
+            column_hashes = np.zeros(table.num_rows, dtype=np.uint64)
+            non_empty = lengths > 0
+            if non_empty.any():
+                column_hashes[non_empty] = np.add.reduceat(
+                    peak_hashes, offsets[:-1][non_empty]
+                )
+            column_hashes ^= pd.util.hash_array(lengths)
+            hashes = hashes * np.uint64(1099511628211) + column_hashes
+    return hashes
+
+
+def map_dedup(
+    file_path: str, combinations: list[list[str]] = DEFAULT_DEDUP_COMBINATIONS, **_
+) -> dict[str, np.ndarray]:
+    columns = sorted({column for combination in combinations for column in combination})
+    table = read_data_table(file_path, columns=columns)
+    return {
+        ", ".join(combination): hash_rows(table, combination)
+        for combination in combinations
+    }
+
+
+def reduce_dedup(partial_results: list, **_) -> dict[str, pd.DataFrame]:
+    rows = []
+    for combination in partial_results[0] if partial_results else ():
+        hashes = np.concatenate([result[combination] for result in partial_results])
+        unique_count = len(np.unique(hashes))
+        rows.append(
+            {
+                "columns": combination,
+                "rows_count": len(hashes),
+                "unique_count": unique_count,
+                "duplicate_count": len(hashes) - unique_count,
+            }
+        )
+    return {
+        "duplicates_counts": pd.DataFrame(
+            rows, columns=["columns", "rows_count", "unique_count", "duplicate_count"]
+        )
+    }
+
+
+# Peak density
+
+
+def map_peak_density(
+    file_path: str, group_by: str | None = None, **kwargs
+) -> PeakDensityGrid:
+    return accumulate_peak_density(
+        [file_path], group_by=group_by, prefetch_depth=1, **kwargs
+    )
+
+
+def reduce_peak_density(
+    partial_results: list, group_by: str | None = None, **kwargs
+) -> dict[str, pd.DataFrame]:
+    grid = PeakDensityGrid(**kwargs)
+    for result in partial_results:
+        grid.merge(result)
+    return {"peak_density": grid.to_df()}
+
+
+# Stage name -> (map function, reduce function)
+STAGES = {
+    "identify_ptms": (map_identify_ptms, reduce_identify_ptms),
+    "statistics": (map_statistics, reduce_statistics),
+    "dedup": (map_dedup, reduce_dedup),
+    "peak_density": (map_peak_density, reduce_peak_density),
+}
+
+
+def submit(
+    queue_dir,
+    stage: str,
+    data_dir=BASE_RAW_DATA_DIR,
+    options: dict | None = None,
+    **kwargs,
+) -> WorkQueue:
+    assert stage in STAGES, f"Unknown stage {stage}, expected one of {list(STAGES)}"
+    queue = WorkQueue(queue_dir, **kwargs)
+    file_paths = [str(Path(p).resolve()) for p in collect_files(data_dir)]
+    queue.submit(file_paths, stage, options, get_fingerprint=get_file_fingerprint)
+    logger.info(f"Submitted {len(file_paths)} {stage} tasks to {queue_dir}")
+    return queue
+
+
+def work(queue_dir, poll_seconds: float = 5, **kwargs) -> int:
+    queue = WorkQueue(queue_dir, **kwargs)
+    metadata = queue.get_metadata()
+    map_func, _ = STAGES[metadata["stage"]]
+    return run_worker(
+        queue, partial(map_func, **metadata["options"]), poll_seconds=poll_seconds
+    )
+
+
+def reduce(queue_dir, output_dir=None, **kwargs) -> dict[str, pd.DataFrame]:
+    queue = WorkQueue(queue_dir, **kwargs)
+    metadata = queue.get_metadata()
+    status = queue.get_status()
+    if status["pending"] or status["failed"]:
+        logger.warning(f"Reducing an incomplete queue: {status}")
+
+    _, reduce_func = STAGES[metadata["stage"]]
+    reports = reduce_func(list(queue.get_results().values()), **metadata["options"])
+
+    if output_dir is not None:
+        get_or_create_folder(output_dir)
+        for name, report_df in reports.items():
+            report_df.to_csv(Path(output_dir) / f"{name}.csv", index=False)
+        logger.info(
+            f"Saved the {metadata['stage']} reports {list(reports)} into {output_dir}"
+        )
+    return reports
+
+
+def run_locally(
+    queue_dir,
+    stage: str,
+    workers: int = 2,
+    data_dir=BASE_RAW_DATA_DIR,
+    options=None,
+    output_dir=None,
+    poll_seconds: float = 5,
+    **kwargs,
+):
+    """
+    Submit, work with `workers` processes (standing in for nodes) and reduce.
+    """
+    submit(queue_dir, stage, data_dir, options, **kwargs)
+    processes = [
+        multiprocessing.Process(
+            target=work,
+            args=(queue_dir, poll_seconds),
+            kwargs=kwargs,
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return reduce(queue_dir, output_dir, **kwargs)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command in ("submit", "work", "reduce", "run"):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument("--queue-dir", required=True, type=Path)
+        subparser.add_argument("--lease-seconds", type=float, default=600)
+        subparser.add_argument("--max-attempts", type=int, default=3)
+        if command in ("submit", "run"):
+            subparser.add_argument("--stage", required=True, choices=list(STAGES))
+            subparser.add_argument("--data-dir", type=Path, default=BASE_RAW_DATA_DIR)
+            subparser.add_argument(
+                "--options", type=json.loads, default={}, help="Stage options as JSON"
+            )
+        if command in ("reduce", "run"):
+            subparser.add_argument(
+                "--output-dir",
+                type=Path,
+                default=None,
+                help="Default to reports/csv_misc/sharded/<stage>",
+            )
+        if command in ("work", "run"):
+            subparser.add_argument("--poll-seconds", type=float, default=5)
+        if command == "run":
+            subparser.add_argument("--workers", type=int, default=2)
+    return parser
+
+
+def main(args=None):
+    args = get_parser().parse_args(args)
+    queue_kwargs = {
+        "lease_seconds": args.lease_seconds,
+        "max_attempts": args.max_attempts,
+    }
+
+    if args.command == "submit":
+        submit(args.queue_dir, args.stage, args.data_dir, args.options, **queue_kwargs)
+    elif args.command == "work":
+        work(args.queue_dir, args.poll_seconds, **queue_kwargs)
+    else:
+        stage = (
+            args.stage
+            if args.command == "run"
+            else WorkQueue(args.queue_dir).get_metadata()["stage"]
+        )
+        output_dir = args.output_dir or BASE_REPORTS_CSV_DIR / "sharded" / stage
+        if args.command == "reduce":
+            reduce(args.queue_dir, output_dir, **queue_kwargs)
+        else:
+            run_locally(
+                args.queue_dir,
+                stage,
+                args.workers,
+                args.data_dir,
+                args.options,
+                output_dir,
+                args.poll_seconds,
+                **queue_kwargs,
+            )
+
+
+if __name__ == "__main__":
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+    main()
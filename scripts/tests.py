@@ -1,17 +1,40 @@
 import os
-import csv
+import time
+import sys
 import shutil
-import random
+import subprocess
 import tempfile
 import unittest
+from unittest import mock
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from unittest.mock import patch, MagicMock
-from ordered_set import OrderedSet
-from scripts.identify_ptms import identify_ptms
-
-# TODO: Fix this unittests later
+from common.utils import collect_files, load_ipc_files, read_data_table
+from common.constants import BASE_PTMS_INDEX_DIR
+from common.ptms_index import PTMIndex
+from common.sharding import WorkQueue, run_worker
+from scripts.identify_ptms import identify_ptms, PTMSitesEnum
+from scripts.find_near_duplicate_spectra import find_near_duplicate_spectra
+from scripts.match_cross_project_spectra import (
+    PAIRS_ORDER,
+    match_cross_project_spectra,
+)
+from scripts.preprocess_spectra import preprocess_files
+from scripts.aggregate_peptides import (
+    aggregate_peptides,
+    count_shared_peptides,
+    write_peptides_table,
+)
+from scripts.plot_peak_density import PeakDensityGrid, accumulate_peak_density
+from scripts.validate_data_files import validate_files
+from scripts.run_sharded import (
+    map_peak_density,
+    reduce_peak_density,
+    run_locally,
+    submit,
+)
+from scripts.transcode_data_files import transcode_files, summarize_transcoding_report
+from scripts.cli import get_parser
 
 
 class TestIdentifyPTMs(unittest.TestCase):
@@ -20,229 +43,989 @@ class TestIdentifyPTMs(unittest.TestCase):
         Set up the test environment before each test.
         """
 
-        # Create a temporary directory
+        # Create a temporary directory with two project folders
         self.temp_dir = Path(tempfile.mkdtemp())
-        self.files = []
-        # Create two project folders
         self.project1_dir = self.temp_dir / "PROJECT1"
         self.project2_dir = self.temp_dir / "PROJECT2"
         os.makedirs(self.project1_dir, exist_ok=True)
         os.makedirs(self.project2_dir, exist_ok=True)
 
-        # Create some CSV files paths to be used as ipc file
-        for f in ("file1.csv", "file2.csv", "file3.csv", "file4.csv"):
-            path = self.project1_dir / f
-            self.files.append(path)
-            self._fs_write_synthetic_data(n_samples=200, file_path=path)
-
     def tearDown(self):
-        # Restore the original logging configuration
         shutil.rmtree(self.temp_dir)
 
-    @staticmethod
-    def _get_peptide_from_modified_peptide(modified_peptide):
-
-        assert modified_peptide is not None, modified_peptide
-
-        glycan_masses = (
-            "1152",
-            "215",
-            "143",
-            "130",
-            "1809",
-            "1518",
-            "1493",
-            "1006",
-            "2013",
-            "147",
-        )
-        peptide = modified_peptide
-        # This is a naive implementation
-        for glycan_mass in glycan_masses:
-            peptide = peptide.replace(f"N[{glycan_mass}]", "N")
-
-        return peptide
-
-    @staticmethod
-    def _get_synthetic_data_header():
-
-        return [
-            "index",
-            "peptide",
-            "modified_peptide",
-            "precursor_mz",
-            "precursor_charge",
-            "mz",
-            "intensity",
-            "rt",
-            "delta_mass",
+    def _fs_write_ipc_file(self, project_dir: Path, file_name: str, modified_peptides):
+        """
+        Write an IPC (feather) file having the given modified peptides.
+        """
+        path = project_dir / file_name
+        pd.DataFrame(
+            {
+                "index": range(len(modified_peptides)),
+                "modified_peptide": modified_peptides,
+            }
+        ).to_feather(path)
+        return path
+
+    def test_identify_ptms_no_ptms(self):
+        """
+        Test identify_ptms when there are no PTMs in the data.
+        """
+        path = self._fs_write_ipc_file(
+            self.project1_dir, "file1.ipc", ["PEPTIDE", None, "ANOTHER"]
+        )
+
+        result = identify_ptms([path], ptm_examples_limit=2, return_df=False)
+
+        self.assertEqual(len(result), 0)
+        self.assertEqual(result.unmodified_peptides_count, 2)
+        self.assertTrue(result.to_examples_df().empty)
+
+    def test_identify_ptms_example_limit(self):
+        """
+        Test that identify_ptms respects the ptm_examples_limit parameter.
+        """
+        path = self._fs_write_ipc_file(
+            self.project1_dir,
+            "file1.ipc",
+            ["PEPTN[123]IDE", "ANOTHN[123]ER", "YETANOTHN[123]ER", "LASTN[123]ONE"],
+        )
+
+        result = identify_ptms([path], ptm_examples_limit=2)
+
+        self.assertEqual(len(result), 2)  # Ensure the limit is respected
+        self.assertEqual(set(result.glycan_mass), {"123"})
+        self.assertEqual(set(result.project_name), {"PROJECT1"})
+        self.assertEqual(result.modified_peptide.nunique(), 2)
+
+    def test_identify_ptms_duplicate_examples(self):
+        """
+        Test that identify_ptms skips duplicate peptide sequences.
+        """
+        path = self._fs_write_ipc_file(
+            self.project1_dir,
+            "file1.ipc",
+            ["PEPTN[123]IDE", "PEPTN[123]IDE", "ANOTHN[123]ER"],
+        )
+
+        result = identify_ptms([path], ptm_examples_limit=3)
+
+        # Only 2 examples, as the duplicate is skipped and the first one is kept
+        self.assertEqual(len(result), 2)
+        self.assertEqual(
+            sorted(zip(result.modified_peptide, result.ipc_index)),
+            [("ANOTHN[123]ER", 2), ("PEPTN[123]IDE", 0)],
+        )
+
+    def test_identify_ptms_occurrences_per_project(self):
+        """
+        Test that identify_ptms counts every ptm occurrence per project.
+        """
+        paths = [
+            self._fs_write_ipc_file(
+                self.project1_dir,
+                "file1.ipc",
+                ["PEPTN[123]IDE", "PEPTN[123]IDE", "AN[215]OTHN[123]ER"],
+            ),
+            self._fs_write_ipc_file(
+                self.project2_dir, "file1.ipc", ["PEPTN[215]IDE", "PEPTIDE"]
+            ),
         ]
 
-    def _generate_synthetic_data(self, n_samples):
+        result = identify_ptms(paths, ptm_examples_limit=1, return_df=False)
+
+        self.assertEqual(result.occurrences[("N", "123")], {"PROJECT1": 3})
+        self.assertEqual(
+            result.occurrences[("N", "215")], {"PROJECT1": 1, "PROJECT2": 1}
+        )
+        self.assertEqual(result.most_common()[0], (("N", "123"), 3))
+        self.assertEqual(result.modified_peptides_count, 4)
+        self.assertEqual(result.unmodified_peptides_count, 1)
+        self.assertEqual(result.to_occurrences_df().occurrences.tolist(), [3, 1, 1])
+
+    def test_identify_ptms_sampling_is_deterministic_and_mergeable(self):
+        """
+        Test that the sampled examples neither depend on the files order nor on
+        the way the files are split between workers.
         """
-        Generate synthetic data for the CSV files using realistic peptide sequences and PTMs.
+        paths = [
+            self._fs_write_ipc_file(
+                project_dir,
+                f"file{i}.ipc",
+                [f"PEPT{i}{j}N[123]IDE" for j in range(20)],
+            )
+            for i, project_dir in enumerate(
+                (self.project1_dir, self.project1_dir, self.project2_dir)
+            )
+        ]
+
+        result = identify_ptms(paths, return_df=False)
+        reversed_result = identify_ptms(paths[::-1], return_df=False)
+        merged_result = identify_ptms(paths[:1], return_df=False).merge(
+            identify_ptms(paths[1:], return_df=False)
+        )
 
-        Args:
-            n_samples (int): Number of rows to generate.
+        expected = result.to_examples_df()
+        self.assertEqual(len(expected), 5)
+        pd.testing.assert_frame_equal(reversed_result.to_examples_df(), expected)
+        pd.testing.assert_frame_equal(merged_result.to_examples_df(), expected)
+        self.assertEqual(merged_result.occurrences, result.occurrences)
 
-        Returns:
-            pd.DataFrame: DataFrame with the required fields.
+        other_seed_result = identify_ptms(paths, seed=1)
+        self.assertNotEqual(
+            set(other_seed_result.modified_peptide), set(expected.modified_peptide)
+        )
 
+    def test_identify_ptms_keeps_the_smallest_example(self):
         """
+        Test that the example kept for a peptide seen in several files is the
+        smallest one, whatever the files order or the merging order.
+        """
+        paths = [
+            self._fs_write_ipc_file(project_dir, "file1.ipc", ["PEPTN[123]IDE"])
+            for project_dir in (self.project2_dir, self.project1_dir)
+        ]
+
+        for result in (
+            identify_ptms(paths, return_df=False),
+            identify_ptms(paths[::-1], return_df=False),
+            identify_ptms(paths[:1], return_df=False).merge(
+                identify_ptms(paths[1:], return_df=False)
+            ),
+        ):
+            self.assertEqual(
+                result.to_examples_df().project_name.tolist(), ["PROJECT1"]
+            )
 
-        glycosylated_peptide_samples = (
-            "GLVSGGVYNSHVGCLYTIPPECEHVN[1152]GSRRPCTEGDTR",
-            "GLVSGGVYNSHVGCLYTIPPECEHVN[215]GSR",
-            "KGLVSGGVYNSHVGCLYTIPPECEHVN[215]GSR",
-            "HNN[143]DTQHWEVSDSNESFVADR",
-            "HNN[130]DTQHWEVSDSNESFVADR",
-            "KGLVSGGVYNSHVGCLYTIPPECEHVN[1809]GSRRPCTEGDTR",
-            "KGLVSGGVYNSHVGCLYTIPPECEHVN[1518]GSRRPCTEGDTR",
-            "LCVVALDFEQEMATAASSSSLEK",  # No PTM
-            "VSINTVN[1493]LTAGQPMEVTVFR",
-            "GLVSGGVYNSHVGCLYTIPPECEHVN[1809]GSRRPCTEGDTR",
-            "GLVSGGVYNSHVGCLYTIPPECEHVN[1006]GSRRPCTEGDTR",
-            "GLVSGGVYNSHVGCLYTIPPECEHVN[2013]GSR",
-            "VSINTVN[147]LTAGQPMEVTVFR",
+    def test_identify_ptms_multiple_classes(self):
+        """
+        Test that identify_ptms routes each ptm to every matching class in one pass.
+        """
+        path = self._fs_write_ipc_file(
+            self.project1_dir,
+            "file1.ipc",
+            ["PEPN[123]T[203]IDE", "S[203]EQ", "M[16]ETHIONINE", "PEPTIDE"],
+        )
+
+        results = identify_ptms(
+            [path],
+            return_df=False,
+            ptm_classes={
+                "n_glycosylation": PTMSitesEnum.N_GLYCOSYLATION,
+                "o_glycosylation": PTMSitesEnum.O_GLYCOSYLATION,
+                "any": PTMSitesEnum.ANY,
+                "oxidation": "M",
+            },
+        )
+
+        self.assertEqual(set(results["n_glycosylation"].occurrences), {("N", "123")})
+        self.assertEqual(
+            set(results["o_glycosylation"].occurrences), {("T", "203"), ("S", "203")}
         )
+        self.assertEqual(len(results["any"]), 4)
+        self.assertEqual(set(results["oxidation"].occurrences), {("M", "16")})
+        self.assertEqual(results["o_glycosylation"].modified_peptides_count, 2)
+        self.assertEqual(results["o_glycosylation"].unmodified_peptides_count, 2)
+        self.assertEqual(results["any"].unmodified_peptides_count, 1)
 
-        precursor_mz_mean, precursor_mz_std = 1107.484847, 219.590290
-        precursor_charge_mean, precursor_charge_std = 3.456838, 1.048360
-        rt_mean, rt_std = 12813.013395, 4852.915073
-        delta_mass_mean, delta_mass_std = 0.324101, 0.654346
+        with self.assertRaises(ValueError):
+            identify_ptms([path], ptm_classes={"invalid": "N[]"})
 
-        peptides = []
-        modified_peptides = []
+    def test_identify_ptms_index(self):
+        """
+        Test that the index gives every row carrying a ptm, beyond the examples limit.
+        """
+        paths = [
+            self._fs_write_ipc_file(
+                self.project1_dir,
+                "file1.ipc",
+                ["PEPTN[123]IDE", "PEPTN[123]IDE", "AN[215]OTHN[123]ER", None],
+            ),
+            self._fs_write_ipc_file(
+                self.project2_dir, "file1.ipc", ["PEPTIDE", "PEPTN[123]IDE"]
+            ),
+        ]
+        index_dir = self.temp_dir / "index"
+
+        identify_ptms(paths, ptm_examples_limit=1, index_dir=index_dir)
+        index = PTMIndex(index_dir)
+
+        self.assertEqual(
+            list(zip(index.ptms_df().glycan_mass, index.ptms_df().rows_count)),
+            [("123", 4), ("215", 1)],
+        )
+        locations_df = index.get_locations("N", 123)
+        self.assertEqual(
+            list(zip(locations_df.file_path, locations_df.row_index)),
+            [
+                (str(paths[0]), 0),
+                (str(paths[0]), 1),
+                (str(paths[0]), 2),
+                (str(paths[1]), 1),
+            ],
+        )
+        rows_df = index.get_rows("N", "123", limit=3, columns=["modified_peptide"])
+        self.assertEqual(
+            rows_df.modified_peptide.tolist(),
+            ["PEPTN[123]IDE", "PEPTN[123]IDE", "AN[215]OTHN[123]ER"],
+        )
+        self.assertNotIn(("S", "203"), index)
+        with self.assertRaises(KeyError):
+            index.get_locations("S", 203)
 
-        for i in range(n_samples):
-            sample = random.choice(glycosylated_peptide_samples)
-            modified_peptides.append(sample)
-            peptides.append(self._get_peptide_from_modified_peptide(sample))
 
-        # TODO: np.identify bellow should be removed and np.clip should be used instead
-        return [
+class TestTranscodeDataFiles(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.source_dir = self.temp_dir / "raw"
+        (self.source_dir / "PROJECT1").mkdir(parents=True)
+        self.df = pd.DataFrame(
             {
-                "index": i,
-                "peptide": peptides[i % len(peptides)],
-                "modified_peptide": modified_peptides[i % len(modified_peptides)],
-                "precursor_mz": np.random.normal(precursor_mz_mean, precursor_mz_std),
-                "precursor_charge": np.round(
-                    np.random.normal(precursor_charge_mean, precursor_charge_std)
-                ),
-                "mz": np.random.uniform(100, 2000),
-                "intensity": np.random.uniform(1e3, 1e6),
-                "rt": np.random.normal(rt_mean, rt_std),
-                "delta_mass": np.random.normal(delta_mass_mean, delta_mass_std),
+                "index": range(100),
+                "modified_peptide": ["PEPTN[123]IDE"] * 100,
+                "mz": [np.linspace(100, 2000, 50)] * 100,
             }
-            for i in range(n_samples)
+        )
+        self.file_path = self.source_dir / "PROJECT1" / "file1.ipc"
+        self.df.to_feather(self.file_path, compression="uncompressed")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_transcode_files(self):
+        """
+        Test that the transcoded files hold the same data and are reported.
+        """
+        reports = []
+        for file_format, compression in (
+            ("ipc", "zstd"),
+            ("parquet", "lz4"),
+            ("ipc", None),
+        ):
+            target_dir = self.temp_dir / f"{file_format}_{compression}"
+            reports.append(
+                transcode_files(
+                    [self.file_path],
+                    self.source_dir,
+                    target_dir,
+                    file_format=file_format,
+                    compression=compression,
+                    batch_size=32,
+                )
+            )
+            transcoded_files = collect_files(target_dir, ext=("ipc", "parquet"))
+            self.assertEqual(len(transcoded_files), 1)
+            self.assertIn("PROJECT1", transcoded_files[0])
+            result = load_ipc_files(transcoded_files)
+            self.assertEqual(result["index"].tolist(), self.df["index"].tolist())
+            self.assertTrue(np.allclose(np.stack(result.mz), np.stack(self.df.mz)))
+
+        report_df = pd.concat(reports, ignore_index=True)
+        self.assertEqual(len(report_df), 3)
+        self.assertTrue((report_df.compression_ratio[:2] > 1).all())
+        summary_df = summarize_transcoding_report(report_df)
+        self.assertEqual(len(summary_df), 3)
+        self.assertTrue(summary_df.compression.isna().any())
+
+
+class TestFindNearDuplicateSpectra(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        (self.temp_dir / "PROJECT1").mkdir()
+        self.file_path = self.temp_dir / "PROJECT1" / "file1.ipc"
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_find_near_duplicate_spectra(self):
+        """
+        Test that only similar spectra of the same peptide and charge are clustered.
+        """
+        rng = np.random.default_rng(0)
+        mz = np.sort(rng.uniform(100, 2000, 80)).round(1) + 0.05
+        intensity = rng.uniform(1e3, 1e6, 80)
+        other_mz = np.sort(rng.uniform(100, 2000, 80))
+
+        spectra = [
+            ("PEPTN[123]IDE", 2, mz, intensity),
+            # Slightly different peaks
+            ("PEPTN[123]IDE", 2, mz + 0.01, intensity * rng.uniform(0.95, 1.05, 80)),
+            ("PEPTN[123]IDE", 2, mz[:-2], intensity[:-2]),
+            # Peaks that can not be paired, without shifting the next spectra
+            ("PEPTN[123]IDE", 2, mz, intensity[:-1]),
+            # Different spectrum
+            ("PEPTN[123]IDE", 2, other_mz, intensity),
+            # Same spectrum but another charge or peptide
+            ("PEPTN[123]IDE", 3, mz, intensity),
+            ("ANOTHER", 2, mz, intensity),
+            # Unidentified spectra are not clustered together
+            (None, 2, mz, intensity),
+            (None, 2, mz, intensity),
         ]
+        pd.DataFrame(
+            spectra, columns=["modified_peptide", "precursor_charge", "mz", "intensity"]
+        ).to_feather(self.file_path)
 
-    def _fs_write_synthetic_data(
-        self,
-        n_samples,
-        file_path: str,
-    ):
-        data = self._generate_synthetic_data(n_samples)
-        with open(file_path, mode="w", newline="") as file:
-            writer = csv.DictWriter(file, fieldnames=self._get_synthetic_data_header())
+        result = find_near_duplicate_spectra([self.file_path])
 
-            # Write header
-            writer.writeheader()
+        self.assertEqual(result.ipc_index.tolist(), [0, 1, 2])
+        self.assertEqual(result.cluster_id.nunique(), 1)
+        self.assertEqual(result.cluster_size.tolist(), [3, 3, 3])
+        self.assertEqual(result.is_representative.tolist(), [True, False, False])
+        self.assertTrue(find_near_duplicate_spectra([]).empty)
 
-            # Write rows
-            writer.writerows(data)
 
-    @patch("identify_ptms.logging")
-    def test_identify_ptms_no_ptms(self, mock_read_feather):
+class TestMatchCrossProjectSpectra(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.files = []
+        for project_name, rows in (
+            (
+                "PROJECT1",
+                [
+                    ("PEPTN[123]IDE", 2, 1000.0, 10.0),
+                    ("PEPTN[123]IDE", 2, 1000.02, 50.0),
+                    ("PEPTN[123]IDE", 3, 1000.0, 10.0),
+                    ("ANOTHER", 2, 500.0, 10.0),
+                    (None, 2, 500.0, 10.0),
+                    # A non-integral charge is not truncated to 2
+                    ("ANOTHER", 2.5, 500.0, 10.0),
+                ],
+            ),
+            (
+                "PROJECT2",
+                [
+                    ("PEPTN[123]IDE", 2, 1000.005, 12.0),  # 5 ppm away
+                    ("PEPTN[123]IDE", 2, 1000.5, 10.0),  # 500 ppm away
+                    ("ANOTHER", 3, 500.0, 10.0),  # Another charge
+                    ("ANOTHER", 2, 499.999, 10.0),
+                ],
+            ),
+        ):
+            (self.temp_dir / project_name).mkdir()
+            path = self.temp_dir / project_name / "file1.ipc"
+            pd.DataFrame(
+                rows,
+                columns=["modified_peptide", "precursor_charge", "precursor_mz", "rt"],
+            ).to_feather(path)
+            self.files.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def match(self, **kwargs) -> tuple[pd.DataFrame, pd.DataFrame]:
+        pairs_path = self.temp_dir / "cross_project_matches.csv"
+        overlaps_df = match_cross_project_spectra(self.files, pairs_path, **kwargs)
+        return pd.read_csv(pairs_path), overlaps_df
+
+    def test_match_cross_project_spectra(self):
         """
-        Test identify_ptms when there are no PTMs in the data.
+        Test that spectra match on the same peptide and charge within the tolerances.
         """
-        # Create a DataFrame with no PTMs
-        df_no_ptms = pd.DataFrame(
-            {"modified_peptide": ["PEPTIDE", None, "ANOTHER"], "index": [0, 1, 2]},
-            index=[0, 1, 2],
+        pairs_df, overlaps_df = self.match(ppm_tolerance=10)
+
+        self.assertEqual(
+            sorted(zip(pairs_df.left_ipc_index, pairs_df.right_ipc_index)),
+            [(0, 0), (3, 3)],
         )
+        self.assertTrue((pairs_df.ppm_error.abs() <= 10).all())
+        self.assertEqual(overlaps_df.matches_count.tolist(), [2])
+        self.assertEqual(overlaps_df.left_spectra_count.tolist(), [4])
+
+        pairs_df, _ = self.match(ppm_tolerance=30)
+        self.assertEqual(len(pairs_df), 3)
+
+        pairs_df, _ = self.match(ppm_tolerance=30, rt_tolerance=5)
+        self.assertEqual(
+            sorted(zip(pairs_df.left_ipc_index, pairs_df.right_ipc_index)),
+            [(0, 0), (3, 3)],
+        )
+
+    def test_partitions_count(self):
+        """
+        Test that the matches do not depend on the partitioning of the keys.
+        """
+        expected_pairs_df, expected_overlaps_df = self.match(
+            ppm_tolerance=30, partitions_count=1
+        )
+        for partitions_count in (2, 3, 64):
+            pairs_df, overlaps_df = self.match(
+                ppm_tolerance=30, partitions_count=partitions_count
+            )
+            # The pairs are only sorted within each partition
+            pd.testing.assert_frame_equal(
+                pairs_df.sort_values(PAIRS_ORDER, ignore_index=True),
+                expected_pairs_df.sort_values(PAIRS_ORDER, ignore_index=True),
+            )
+            pd.testing.assert_frame_equal(overlaps_df, expected_overlaps_df)
+        self.assertEqual(expected_overlaps_df.left_matched_spectra_count.tolist(), [3])
 
-        mock_read_feather.return_value = df_no_ptms
 
-        # Call the function
-        result = identify_ptms(self.files, ptm_examples_limit=2)
+class TestAggregatePeptides(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.files = []
+        rng = np.random.default_rng(0)
+        peptides = [("PEPTNIDE", "PEPTN[2350]IDE"), ("ANOTHER", "ANOTHER")]
+        for project_name in ("PROJECT1", "PROJECT2"):
+            (self.temp_dir / project_name).mkdir()
+            for file_name in ("file1.ipc", "file2.ipc"):
+                choices = rng.integers(0, len(peptides), 50)
+                df = pd.DataFrame(
+                    {
+                        "peptide": [peptides[i][0] for i in choices],
+                        "modified_peptide": [peptides[i][1] for i in choices],
+                        "precursor_charge": rng.integers(2, 5, 50),
+                        "delta_mass": rng.normal(size=50),
+                    }
+                )
+                if project_name == "PROJECT2":
+                    # A peptide only seen in the second project
+                    df.loc[0, ["peptide", "modified_peptide"]] = "ONLY", "ONLY"
+                df.loc[1, "delta_mass"] = np.nan
+                path = self.temp_dir / project_name / file_name
+                df.to_feather(path)
+                self.files.append(path)
 
-        # Expected output: empty dictionary since no PTMs were found
-        expected = {}
-        self.assertEqual(result, expected)
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
 
-    @patch("identify_ptms.logging")
-    def test_identify_ptms_example_limit(self, mock_read_feather):
+    def test_aggregate_peptides(self):
         """
-        Test that identify_ptms respects the ptm_examples_limit parameter.
+        Test that the peptide table matches the aggregation of all the spectra.
         """
-        # Create a DataFrame with multiple instances of the same glycan mass
-        df_limit_test = pd.DataFrame(
+        table = aggregate_peptides(self.files).to_table()
+        peptides_df = table.to_pandas().set_index("modified_peptide")
+
+        df = load_ipc_files(self.files)
+        grouped = df.groupby("modified_peptide")
+        self.assertEqual(
+            peptides_df["spectra_count"].to_dict(), grouped.size().to_dict()
+        )
+        for column, statistic in (
+            ("delta_mass_mean", "mean"),
+            ("delta_mass_std", "std"),
+            ("delta_mass_min", "min"),
+        ):
+            expected = grouped["delta_mass"].agg(statistic)
+            np.testing.assert_allclose(
+                peptides_df[column].astype(float), expected[peptides_df.index]
+            )
+        self.assertEqual(list(peptides_df.loc["ONLY", "projects"]), ["PROJECT2"])
+        self.assertEqual(
+            list(peptides_df.loc["ANOTHER", "charges"]),
+            sorted(df[df.peptide == "ANOTHER"].precursor_charge.unique()),
+        )
+        self.assertEqual(
+            list(peptides_df.loc["PEPTN[2350]IDE", "glycan_masses"]), [2350]
+        )
+        self.assertEqual(count_shared_peptides(table).shared_count.tolist(), [2])
+
+        # Merging the aggregates of the projects gives the same table
+        first = aggregate_peptides(self.files[:2])
+        second = aggregate_peptides(self.files[2:])
+        self.assertTrue(first.merge(second).to_table().equals(table))
+
+        path = write_peptides_table(table, self.temp_dir / "peptides.arrow")
+        self.assertTrue(read_data_table(path).equals(table))
+
+
+class TestPreprocessSpectra(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.source_dir = self.temp_dir / "raw"
+        (self.source_dir / "PROJECT1").mkdir(parents=True)
+        self.file_path = self.source_dir / "PROJECT1" / "file1.ipc"
+        pd.DataFrame(
             {
-                "modified_peptide": [
-                    "PEPTIDE[N123]",  # Glycan mass 123
-                    "ANOTHER[N123]",  # Same glycan mass
-                    "YETANOTHER[N123]",  # Same glycan mass (should be ignored due to limit)
+                "modified_peptide": ["PEPTN[123]IDE", "ANOTHER", "EMPTY", "MISMATCHED"],
+                # A missing precursor m/z does not remove any peak
+                "precursor_mz": [500.0, None, 600.0, 600.0],
+                "scale_factor": [1.0, 2.0, 1.0, 1.0],
+                "mz": [
+                    [40.0, 100.0, 200.0, 499.0, 501.5, 700.0, 3000.0],
+                    [150.0, 250.0, 350.0],
+                    [],
+                    [100.0, 200.0],
                 ],
-                "index": [0, 1, 2],
-            },
-            index=[0, 1, 2],
+                "intensity": [
+                    [9.0, 1.0, 4.0, 9.0, 9.0, 2.0, 9.0],
+                    [1.0, 2.0, 4.0],
+                    [],
+                    [1.0],
+                ],
+            }
+        ).to_feather(self.file_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_preprocess_files(self):
+        """
+        Test that the spectra are filtered, truncated and normalized per spectrum,
+        and that the spectra whose mz and intensity lengths differ are dropped.
+        """
+        (target,) = preprocess_files(
+            [self.file_path],
+            self.source_dir,
+            self.temp_dir / "processed",
+            batch_size=2,
+            top_k=2,
         )
 
-        mock_read_feather.return_value = df_limit_test
+        self.assertEqual(target, self.temp_dir / "processed" / "PROJECT1" / "file1.ipc")
+        result = pd.read_feather(target)
+        self.assertEqual(
+            result.modified_peptide.tolist(), ["PEPTN[123]IDE", "ANOTHER", "EMPTY"]
+        )
+        # Out of range, near the precursor and least intense peaks are removed
+        self.assertEqual(
+            [list(mz) for mz in result.mz], [[200.0, 700.0], [250.0, 350.0], []]
+        )
+        self.assertEqual(
+            [list(intensity) for intensity in result.intensity],
+            [[1.0, 0.5], [1.0, 2.0], []],
+        )
 
-        # Call the function with a limit of 2 examples per PTM
-        result = identify_ptms(self.files, ptm_examples_limit=2)
 
-        # Expected output: only 2 examples for glycan mass 123
-        expected = {
-            "123": OrderedSet(
-                [
-                    ("123", "project1", "file1.feather", 0, 0),
-                    ("123", "project1", "file1.feather", 1, 1),
-                ]
-            )
-        }
+class TestPlotPeakDensity(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.files = []
+        for project_name, charges in (("PROJECT1", [2, 3]), ("PROJECT2", [2, 2])):
+            (self.temp_dir / project_name).mkdir()
+            path = self.temp_dir / project_name / "file1.ipc"
+            pd.DataFrame(
+                {
+                    "precursor_charge": charges,
+                    # The last peak of each spectrum is out of the m/z range
+                    "mz": [[100.0, 150.0, 3000.0], [100.0, 3000.0]],
+                    "intensity": [[1e3, 1e5, 1e4], [1e3, 1e4]],
+                }
+            ).to_feather(path)
+            self.files.append(path)
 
-        self.assertEqual(result, expected)
-        self.assertEqual(len(result["123"]), 2)  # Ensure the limit is respected
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
 
-    @patch("identify_ptms.logging")
-    def test_identify_ptms_duplicate_examples(self, mock_read_feather):
+    def test_accumulate_peak_density(self):
         """
-        Test that identify_ptms skips duplicate peptide sequences.
+        Test that the peaks are counted in their bins, per group.
+        """
+        grid = accumulate_peak_density(self.files, bins=(25, 10))
+
+        counts = grid.get_counts()
+        self.assertEqual(counts.sum(), 6)
+        self.assertEqual(grid.dropped_peaks_count, 4)
+        # m/z 100 in the bin [100, 200[ and log10(1e3) in the bin [3, 4[
+        self.assertEqual(counts[1, 3], 4)
+        self.assertEqual(counts[1, 5], 2)
+
+        by_charge = accumulate_peak_density(
+            self.files, group_by="precursor_charge", bins=(25, 10)
+        )
+        self.assertEqual(set(by_charge.counts), {2, 3})
+        self.assertEqual(by_charge.get_counts(3).sum(), 1)
+        np.testing.assert_array_equal(by_charge.get_counts(), counts)
+
+        by_project = accumulate_peak_density(self.files, group_by="project")
+        self.assertEqual(by_project.get_counts("PROJECT2").sum(), 3)
+
+    def test_mismatched_peaks_are_skipped(self):
         """
-        # Create a DataFrame with duplicate modified peptides
-        df_duplicates = pd.DataFrame(
+        Test that a spectrum whose mz and intensity lengths differ is skipped without
+        shifting the intensities of the next spectrum.
+        """
+        path = self.temp_dir / "PROJECT1" / "file2.ipc"
+        pd.DataFrame(
+            {"mz": [[100.0, 150.0], [300.0]], "intensity": [[1e3], [1e5, 1e4]]}
+        ).to_feather(path)
+        pd.DataFrame(
+            {"mz": [[100.0, 150.0], [300.0]], "intensity": [[1e3], [1e5]]}
+        ).to_feather(self.files[0])
+
+        counts = accumulate_peak_density(
+            [path, self.files[0]], bins=(25, 10)
+        ).get_counts()
+        self.assertEqual(counts.sum(), 1)
+        # m/z 300 in the bin [300, 400[ and log10(1e5) in the bin [5, 6[
+        self.assertEqual(counts[3, 5], 1)
+
+    def test_merge_peak_density(self):
+        """
+        Test that the grids of the files (e.g. made by workers) merge into the grid
+        of all the files.
+        """
+        grid = accumulate_peak_density(self.files, group_by="project")
+        reports = reduce_peak_density(
+            [map_peak_density(str(path), group_by="project") for path in self.files],
+            group_by="project",
+        )
+        pd.testing.assert_frame_equal(reports["peak_density"], grid.to_df())
+        self.assertEqual(reports["peak_density"]["count"].sum(), 6)
+
+        with self.assertRaises(AssertionError):
+            grid.merge(PeakDensityGrid(bins=(10, 10)))
+
+
+class TestValidateDataFiles(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.raw_dir = self.temp_dir / "raw"
+        self.quarantine_dir = self.temp_dir / "quarantine"
+        (self.raw_dir / "PROJECT1").mkdir(parents=True)
+        self.files = [
+            self.raw_dir / "PROJECT1" / "file1.ipc",
+            self.raw_dir / "PROJECT1" / "file2.ipc",
+        ]
+        df = pd.DataFrame(
             {
-                "modified_peptide": [
-                    "PEPTIDE[N123]",  # First occurrence
-                    "PEPTIDE[N123]",  # Duplicate (should be skipped)
-                    "ANOTHER[N123]",  # Different peptide, same glycan mass
-                ],
-                "index": [0, 1, 2],
-            },
-            index=[0, 1, 2],
+                "precursor_charge": [2, 3, 0, 2],
+                "mz": [[100.0, 200.0], [200.0, 100.0], [100.0], [100.0]],
+                "intensity": [[1.0, 1.0], [1.0, 1.0], [1.0], []],
+                "modified_peptide": ["PEPTN[123]IDE", "PEPTIDE", None, "AK"],
+            }
+        )
+        df.to_feather(self.files[0])
+        df.iloc[:1].to_feather(self.files[1])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_validate_files(self):
+        """
+        Test that the failing rows are quarantined with their failed checks.
+        """
+        report_df = validate_files(
+            self.files, self.raw_dir, self.quarantine_dir, batch_size=2
+        )
+
+        self.assertEqual(report_df.rows_count.tolist(), [4, 1])
+        self.assertEqual(report_df.quarantined_count.tolist(), [3, 0])
+        self.assertEqual(report_df.invalid_charge.tolist(), [1, 0])
+        self.assertIn("missing column protein", report_df.schema_problems[0])
+
+        quarantined_df = load_ipc_files(collect_files(self.quarantine_dir))
+        self.assertEqual(quarantined_df.source_row_index.tolist(), [1, 2, 3])
+        self.assertEqual(
+            [list(checks) for checks in quarantined_df.failed_checks],
+            [
+                ["unsorted_mz"],
+                ["invalid_charge", "missing_modified_peptide"],
+                ["empty_peaks", "peaks_length_mismatch"],
+            ],
+        )
+        # Only the files having failing rows are quarantined
+        self.assertFalse((self.quarantine_dir / "PROJECT1" / "file2.ipc").exists())
+
+
+class TestRunSharded(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.data_dir = self.temp_dir / "raw"
+        self.queue_dir = self.temp_dir / "queue"
+        self.files = []
+        rng = np.random.default_rng(0)
+        for project_name in ("PROJECT1", "PROJECT2"):
+            (self.data_dir / project_name).mkdir(parents=True)
+            for i in range(3):
+                path = self.data_dir / project_name / f"file{i}.ipc"
+                modified_peptides = rng.choice(
+                    ["PEPTN[123]IDE", "AN[215]OTHER", "S[203]EQ", "PLAIN"], 20
+                ).tolist()
+                pd.DataFrame(
+                    {
+                        "index": range(20),
+                        "peptide": [p.split("[")[0] for p in modified_peptides],
+                        "modified_peptide": modified_peptides,
+                        "precursor_charge": rng.integers(2, 4, 20),
+                        "precursor_mz": rng.choice([500.0, 600.0], 20),
+                        "rt": rng.normal(100, 10, 20),
+                        "mz": [[100.0, 200.0]] * 10 + [[100.0]] * 10,
+                        "intensity": [[1.0, 2.0]] * 20,
+                    }
+                ).to_feather(path)
+                self.files.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_run_sharded_identify_ptms(self):
+        """
+        Test that several worker processes give the same result as a single process.
+        """
+        reports = run_locally(
+            self.queue_dir,
+            "identify_ptms",
+            workers=3,
+            data_dir=self.data_dir,
+            poll_seconds=0.1,
+        )
+
+        expected = identify_ptms(
+            self.files,
+            return_df=False,
+            ptm_classes={"n_glycosylation": PTMSitesEnum.N_GLYCOSYLATION},
+        )["n_glycosylation"]
+        pd.testing.assert_frame_equal(
+            reports["identified_n_glycosylation_ptms_examples"],
+            expected.to_examples_df(),
+        )
+        pd.testing.assert_frame_equal(
+            reports["identified_n_glycosylation_ptms_occurrences"],
+            expected.to_occurrences_df(),
         )
+        self.assertEqual(WorkQueue(self.queue_dir).get_status()["done"], 6)
+
+    def test_run_sharded_statistics_and_dedup(self):
+        """
+        Test the mergeable statistics and duplicates counts.
+        """
+        df = load_ipc_files(self.files)
 
-        mock_read_feather.return_value = df_duplicates
+        reports = run_locally(
+            self.queue_dir / "statistics",
+            "statistics",
+            workers=2,
+            data_dir=self.data_dir,
+            poll_seconds=0.1,
+        )
+        statistics_df = reports["columns_statistics"].set_index("statistic")
+        described_df = df[["precursor_mz", "rt"]].describe()
+        for column in ("precursor_mz", "rt"):
+            for statistic in ("count", "mean", "std", "min", "max"):
+                self.assertAlmostEqual(
+                    statistics_df.loc[statistic, column],
+                    described_df.loc[statistic, column],
+                )
 
-        # Call the function with a limit of 3 examples per PTM
-        result = identify_ptms(self.files, ptm_examples_limit=3)
+        reports = run_locally(
+            self.queue_dir / "dedup",
+            "dedup",
+            workers=2,
+            data_dir=self.data_dir,
+            poll_seconds=0.1,
+        )
+        duplicate_counts = reports["duplicates_counts"].duplicate_count.tolist()
+        df["mz"] = df["mz"].apply(tuple)
+        df["intensity"] = df["intensity"].apply(tuple)
+        self.assertEqual(
+            duplicate_counts,
+            [
+                df[["peptide", "modified_peptide", "precursor_charge"]]
+                .duplicated()
+                .sum(),
+                df[["peptide", "modified_peptide", "precursor_mz", "precursor_charge"]]
+                .duplicated()
+                .sum(),
+                df[
+                    [
+                        "peptide",
+                        "modified_peptide",
+                        "precursor_mz",
+                        "precursor_charge",
+                        "mz",
+                        "intensity",
+                    ]
+                ]
+                .duplicated()
+                .sum(),
+            ],
+        )
+
+    def test_queue_directory_holds_one_submission(self):
+        """
+        Test that a queue directory can be resumed but not reused by another stage
+        or after its input files changed.
+        """
+        run_locally(
+            self.queue_dir,
+            "statistics",
+            workers=1,
+            data_dir=self.data_dir,
+            poll_seconds=0.1,
+        )
+        with self.assertRaises(ValueError):
+            submit(self.queue_dir, "identify_ptms", data_dir=self.data_dir)
+        with self.assertRaises(ValueError):
+            submit(self.queue_dir, "statistics", self.data_dir, options={"top_n": 10})
+
+        # Resubmitting the same stage does not process the done tasks again
+        queue = submit(self.queue_dir, "statistics", data_dir=self.data_dir)
+        self.assertEqual(queue.get_status()["pending"], 0)
+
+        pd.read_feather(self.files[0]).head(5).to_feather(self.files[0])
+        with self.assertRaises(ValueError):
+            submit(self.queue_dir, "statistics", data_dir=self.data_dir)
+
+    def test_expired_leases_are_retried(self):
+        """
+        Test that the task of a dead worker is processed once its lease expired.
+        """
+        queue = WorkQueue(self.queue_dir, lease_seconds=60, max_attempts=2)
+        queue.submit(["a", "b"], "test")
+        dead_task_id = queue.claim("dead-worker")
+        # A leased task can not be claimed by another worker
+        other_task_id = queue.claim("worker")
+        self.assertNotEqual(other_task_id, dead_task_id)
+        self.assertIsNone(queue.claim("worker"))
+        queue.release(other_task_id, "worker")
+
+        # Expire the lease of the dead worker
+        lease_path = queue._get_lease_path(dead_task_id)
+        os.utime(lease_path, (time.time() - 120, time.time() - 120))
+
+        processed_count = run_worker(queue, str.upper, worker_id="worker")
+        self.assertEqual(processed_count, 2)
+        self.assertEqual(set(queue.get_results().values()), {"A", "B"})
+        self.assertEqual(queue.get_attempts_count(dead_task_id), 1)
+
+    def test_recreated_lease_is_not_taken_over(self):
+        """
+        Test that a lease recreated between the expiry check and its removal is kept,
+        without recording a failed attempt.
+        """
+        queue = WorkQueue(self.queue_dir, lease_seconds=60)
+        queue.submit(["a"], "test")
+        task_id = queue.claim("dead-worker")
+        lease_path = queue._get_lease_path(task_id)
+        os.utime(lease_path, (time.time() - 120, time.time() - 120))
 
-        # Expected output: only 2 examples, as the duplicate is skipped
-        expected = {
-            "123": OrderedSet(
+        rename = os.rename
+
+        def take_over_then_rename(source, destination):
+            # Another worker takes the expired lease over in the meantime
+            lease_path.unlink()
+            queue._record_attempt(task_id, "lease expired")
+            self.assertTrue(queue._create_lease(task_id, "other-worker"))
+            rename(source, destination)
+
+        with mock.patch("common.sharding.os.rename", take_over_then_rename):
+            self.assertFalse(queue._take_over_expired_lease(task_id))
+        self.assertTrue(queue._holds_lease(task_id, "other-worker"))
+        self.assertEqual(queue.get_attempts_count(task_id), 1)
+
+    def test_failing_tasks_are_given_up(self):
+        """
+        Test that a task raising is retried then given up, without stopping the
+        worker nor losing the other tasks.
+        """
+        queue = WorkQueue(self.queue_dir, max_attempts=2)
+        queue.submit(["ok", "corrupt"], "test")
+
+        def task_func(payload):
+            if payload == "corrupt":
+                raise ValueError(payload)
+            return payload.upper()
+
+        processed_count = run_worker(queue, task_func, worker_id="worker")
+        self.assertEqual(processed_count, 1)
+        self.assertEqual(list(queue.get_results().values()), ["OK"])
+        self.assertEqual(
+            queue.get_status(), {"tasks": 2, "done": 1, "failed": 1, "pending": 0}
+        )
+        self.assertEqual(
+            queue.get_attempts_count(queue.get_task_id("corrupt", "test")), 2
+        )
+        self.assertEqual(list((self.queue_dir / "leases").iterdir()), [])
+
+    def test_leases_are_owned(self):
+        """
+        Test that a worker can not renew nor release the lease of another worker.
+        """
+        queue = WorkQueue(self.queue_dir)
+        queue.submit(["a"], "test")
+        task_id = queue.claim("worker")
+        self.assertFalse(queue.renew(task_id, "slow-worker"))
+        queue.release(task_id, "slow-worker")
+        self.assertTrue(queue._get_lease_path(task_id).exists())
+        self.assertTrue(queue.renew(task_id, "worker"))
+        queue.release(task_id, "worker")
+        self.assertFalse(queue._get_lease_path(task_id).exists())
+
+
+class TestCLI(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.data_dir = self.temp_dir / "raw"
+        self.output_dir = self.temp_dir / "reports"
+        for project_name in ("PROJECT1", "PROJECT2"):
+            (self.data_dir / project_name).mkdir(parents=True)
+            pd.DataFrame(
+                {
+                    "index": range(4),
+                    "peptide": ["PEPTNIDE", "PEPTNIDE", "SEQ", "PLAIN"],
+                    "modified_peptide": [
+                        "PEPTN[123]IDE",
+                        "PEPTN[123]IDE",
+                        "S[203]EQ",
+                        "PLAIN",
+                    ],
+                    "precursor_charge": [2, 2, 3, 2],
+                    "precursor_mz": [500.0, 500.0, 600.0, 700.0],
+                    "rt": [10.0, 10.0, 20.0, 30.0],
+                    "mz": [[100.0, 200.0]] * 4,
+                    "intensity": [[1.0, 2.0]] * 4,
+                }
+            ).to_feather(self.data_dir / project_name / "file.ipc")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_help_is_lazy(self):
+        """
+        Test that building the parser does not import the heavy modules, and that
+        importing a script neither configures the logging nor scans the data.
+        """
+        code = (
+            "import sys, logging; from scripts.cli import get_parser; get_parser();"
+            "print(sorted({'pandas', 'pyarrow', 'matplotlib', 'seaborn'} & set(sys.modules)));"
+            "import scripts.identify_ptms as m; print(logging.getLogger().handlers, hasattr(m, 'ipc_files'))"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout.splitlines()
+        self.assertEqual(output, ["[]", "[] False"])
+        subprocess.run(
+            [sys.executable, "-m", "scripts.cli", "--help"],
+            capture_output=True,
+            check=True,
+        )
+
+    def test_commands(self):
+        """
+        Test that every command writes its reports into the output directory.
+        """
+        expected_files = {
+            "identify": "identified_n_glycosylation_ptms_occurrences*.csv",
+            "stats": "columns_statistics.csv",
+            "dedup": "duplicates_counts.csv",
+            "overlap": "cross_project_overlaps.csv",
+        }
+        for command, expected_file in expected_files.items():
+            output_dir = self.output_dir / command
+            args = get_parser().parse_args(
                 [
-                    ("123", "project1", "file1.feather", 0, 0),
-                    ("123", "project1", "file1.feather", 2, 2),
+                    command,
+                    "--data-dir",
+                    str(self.data_dir),
+                    "--output-dir",
+                    str(output_dir),
                 ]
             )
-        }
+            args.func(args)
+            self.assertTrue(list(output_dir.glob(expected_file)), command)
+            if command == "identify":
+                # The index is optional, so it is not built by default
+                self.assertIsNone(args.index_dir)
+                self.assertEqual(
+                    get_parser().parse_args(["identify", "--index-dir"]).index_dir,
+                    BASE_PTMS_INDEX_DIR,
+                )
 
-        self.assertEqual(result, expected)
-        self.assertEqual(len(result["123"]), 2)  # Ensure the duplicate was skipped
+        overlaps_df = pd.read_csv(
+            self.output_dir / "overlap" / "cross_project_overlaps.csv"
+        )
+        self.assertEqual(overlaps_df.matches_count.tolist(), [6])
 
 
 if __name__ == "__main__":
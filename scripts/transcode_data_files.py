@@ -0,0 +1,215 @@
+"""
+Script to transcode the raw IPC files into compressed columnar files (Arrow IPC
+with zstd/lz4 compression or Parquet) and to report the size and read throughput
+tradeoffs of each configuration. The loaders of `common.utils` detect the format
+of the files by themselves, so the transcoded directories can be used in place
+of the raw ones.
+"""
+
+import os
+import time
+import logging
+import logging.config  # noqa
+import pandas as pd
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from pathlib import Path
+from tqdm import tqdm
+
+from common.utils import (
+    collect_files,
+    get_or_create_folder,
+    get_timestamp,
+    read_data_file,
+    read_data_table,
+)
+from common.constants import (
+    BASE_RAW_DATA_DIR,
+    BASE_REPORTS_CSV_DIR,
+    BASE_TRANSCODED_DATA_DIR,
+)
+from common.logger import get_logger_config
+
+logger = logging.getLogger(__name__)
+
+# (file format, compression) configurations benchmarked by default
+DEFAULT_TRANSCODING_CONFIGS = (
+    ("ipc", "lz4"),
+    ("ipc", "zstd"),
+    ("parquet", "zstd"),
+    ("parquet", "lz4"),
+)
+
+# Rows per record batch (ipc) or per row group (parquet). Spectra rows are
+# big (mz and intensity lists), so small groups keep the decompression cheap.
+DEFAULT_BATCH_SIZE = 16_384
+
+
+def transcode_file(
+    source: str | Path,
+    target: str | Path,
+    file_format: str = "ipc",
+    compression: str | None = "zstd",
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> None:
+    """
+    Transcode a data file into a (compressed) Arrow IPC or Parquet file.
+
+    Args:
+        source (str | Path): The file to transcode, in any format supported by `read_data_table`.
+        target (str | Path): The transcoded file path.
+        file_format (str): Either "ipc" or "parquet". Default to "ipc".
+        compression (str, optional): The compression codec, "zstd", "lz4" or None. Default to "zstd".
+        batch_size (int): The number of rows per record batch or row group.
+    """
+    table = read_data_table(source)
+
+    if file_format == "ipc":
+        options = ipc.IpcWriteOptions(compression=compression)
+        with ipc.new_file(str(target), table.schema, options=options) as writer:
+            for batch in table.to_batches(max_chunksize=batch_size):
+                writer.write_batch(batch)
+    elif file_format == "parquet":
+        pq.write_table(
+            table, target, compression=compression or "none", row_group_size=batch_size
+        )
+    else:
+        raise ValueError(f"Unknown file format {file_format}, expected ipc or parquet")
+
+
+def drop_from_page_cache(file_path: str | Path) -> bool:
+    """
+    Ask the OS to drop a file from its page cache, so that its next read is cold.
+
+    Returns:
+        bool: False if the OS does not support it (the next read may be warm).
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    file_descriptor = os.open(file_path, os.O_RDONLY)
+    try:
+        # Only the clean pages can be dropped, the written ones are flushed first
+        os.fsync(file_descriptor)
+        os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(file_descriptor)
+    return True
+
+
+def measure_read(file_path: str | Path) -> tuple[float, bool]:
+    """
+    Returns the time (in seconds) taken to load a file into a DataFrame, the file
+    being first dropped from the OS page cache, and whether the read was cold.
+    """
+    cold = drop_from_page_cache(file_path)
+    start = time.perf_counter()
+    read_data_file(file_path)
+    return time.perf_counter() - start, cold
+
+
+def transcode_files(
+    file_paths: list[str],
+    source_dir: str | Path,
+    target_dir: str | Path,
+    file_format: str = "ipc",
+    compression: str | None = "zstd",
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> pd.DataFrame:
+    """
+    Transcode files keeping their tree (relative to `source_dir`) under `target_dir`.
+
+    The reads are timed in a separate pass once every file is written, each file
+    being dropped from the page cache before its read (see `drop_from_page_cache`),
+    so that the timings are those of cold reads where the OS supports it.
+
+    Returns:
+        pd.DataFrame: The size and read throughput of each file before and after
+        transcoding, and whether its reads were cold.
+    """
+    extension = "ipc" if file_format == "ipc" else "parquet"
+    targets = {}
+
+    for file_path in tqdm(
+        file_paths, desc=f"Transcoding to {file_format}/{compression}", unit="file"
+    ):
+        relative_path = Path(file_path).relative_to(source_dir)
+        target = Path(target_dir) / relative_path.with_suffix(f".{extension}")
+        get_or_create_folder(target.parent)
+        transcode_file(file_path, target, file_format, compression, batch_size)
+        targets[file_path] = target
+
+    report = []
+    for file_path, target in tqdm(
+        targets.items(), desc="Measuring cold reads", unit="file"
+    ):
+        relative_path = Path(file_path).relative_to(source_dir)
+        source_bytes = os.path.getsize(file_path)
+        target_bytes = os.path.getsize(target)
+        source_read_seconds, source_cold = measure_read(file_path)
+        target_read_seconds, target_cold = measure_read(target)
+        report.append(
+            {
+                "file": relative_path.as_posix(),
+                "file_format": file_format,
+                "compression": compression,
+                "batch_size": batch_size,
+                "source_bytes": source_bytes,
+                "target_bytes": target_bytes,
+                "compression_ratio": source_bytes / target_bytes,
+                "source_read_seconds": source_read_seconds,
+                "target_read_seconds": target_read_seconds,
+                # Throughput in terms of raw (uncompressed) data
+                "source_read_mb_per_second": source_bytes / source_read_seconds / 1e6,
+                "target_read_mb_per_second": source_bytes / target_read_seconds / 1e6,
+                "cold_reads": source_cold and target_cold,
+            }
+        )
+        logger.info(
+            f"Transcoded {relative_path} from {source_bytes} to {target_bytes} bytes ({file_format}/{compression})"
+        )
+
+    return pd.DataFrame(report)
+
+
+def summarize_transcoding_report(report_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregate a transcoding report per (file_format, compression) configuration.
+    """
+    # The uncompressed configurations have a None compression
+    summary_df = report_df.groupby(["file_format", "compression"], dropna=False).agg(
+        source_bytes=("source_bytes", "sum"),
+        target_bytes=("target_bytes", "sum"),
+        source_read_seconds=("source_read_seconds", "sum"),
+        target_read_seconds=("target_read_seconds", "sum"),
+    )
+    summary_df["compression_ratio"] = summary_df.source_bytes / summary_df.target_bytes
+    summary_df["read_speedup"] = (
+        summary_df.source_read_seconds / summary_df.target_read_seconds
+    )
+    return summary_df.reset_index()
+
+
+if __name__ == "__main__":
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+
+    raw_files = collect_files(BASE_RAW_DATA_DIR)
+    logger.info(f"Found {len(raw_files)} IPC files to transcode in {BASE_RAW_DATA_DIR}")
+
+    reports = [
+        transcode_files(
+            raw_files,
+            BASE_RAW_DATA_DIR,
+            BASE_TRANSCODED_DATA_DIR / f"{file_format}_{compression}",
+            file_format=file_format,
+            compression=compression,
+        )
+        for file_format, compression in DEFAULT_TRANSCODING_CONFIGS
+    ]
+
+    timestamp = get_timestamp()
+    csv_dir = get_or_create_folder(BASE_REPORTS_CSV_DIR / "transcoding")
+    report_df = pd.concat(reports, ignore_index=True)
+    report_df.to_csv(csv_dir / f"transcoding_report{timestamp}.csv", index=False)
+    summary_df = summarize_transcoding_report(report_df)
+    summary_df.to_csv(csv_dir / f"transcoding_summary{timestamp}.csv", index=False)
+    logger.info(f"Transcoding summary:\n{summary_df.to_string(index=False)}")
@@ -0,0 +1,166 @@
+"""
+Script to validate the raw data files before their analysis. Each file is checked
+record batch by record batch (see `common.validation`), and its failing rows are
+written with the names of their failed checks into a quarantine file, keeping the
+tree of the raw data directory under the quarantine directory. A report gives the
+schema problems and the failed checks counts of each file.
+"""
+
+import logging
+import logging.config  # noqa
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+from pathlib import Path
+from collections import Counter
+from tqdm import tqdm
+
+from common.utils import (
+    collect_files,
+    get_or_create_folder,
+    iter_data_batches,
+    read_data_schema,
+)
+from common.validation import (
+    DEFAULT_CHARGE_RANGE,
+    DOCUMENTED_COLUMNS,
+    validate_record_batch,
+    validate_schema,
+)
+from common.constants import (
+    BASE_QUARANTINE_DATA_DIR,
+    BASE_RAW_DATA_DIR,
+    BASE_REPORTS_CSV_DIR,
+)
+from common.logger import get_logger_config
+
+logger = logging.getLogger(__name__)
+
+# Rows per record batch, the rows of a batch are validated at once
+DEFAULT_BATCH_SIZE = 65_536
+
+
+def validate_file(
+    source: str | Path,
+    quarantine_path: str | Path,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    expected_columns: dict = DOCUMENTED_COLUMNS,
+    charge_range: tuple[int, int] = DEFAULT_CHARGE_RANGE,
+) -> dict:
+    """
+    Validate a file, writing its failing rows into `quarantine_path` (an Arrow IPC
+    file with the columns of the source, the `source_row_index` of the rows and
+    their `failed_checks`). No quarantine file is written if every row is valid.
+
+    Returns:
+        dict: The rows_count, quarantined_count, schema_problems and the counts of
+        each failed check.
+    """
+    schema_problems = validate_schema(read_data_schema(source), expected_columns)
+    if schema_problems:
+        logger.warning(f"Schema problems in {source}: {schema_problems}")
+
+    failed_checks_counts = Counter()
+    quarantined_count = 0
+    writer = None
+    start = 0
+    try:
+        for batch in iter_data_batches(source, batch_size):
+            failed_checks = validate_record_batch(batch, expected_columns, charge_range)
+            failing = pc.greater(pc.list_value_length(failed_checks), 0)
+            failing_count = pc.sum(failing).as_py() or 0
+            if failing_count:
+                failed_checks_counts.update(
+                    {
+                        item["values"]: item["counts"]
+                        for item in pc.value_counts(failed_checks.flatten()).to_pylist()
+                    }
+                )
+                quarantined = pa.RecordBatch.from_arrays(
+                    [
+                        *batch.columns,
+                        pa.array(np.arange(start, start + batch.num_rows)),
+                        failed_checks,
+                    ],
+                    names=[*batch.schema.names, "source_row_index", "failed_checks"],
+                ).filter(failing)
+                if writer is None:
+                    get_or_create_folder(Path(quarantine_path).parent)
+                    writer = ipc.new_file(
+                        str(quarantine_path),
+                        quarantined.schema,
+                        options=ipc.IpcWriteOptions(compression="zstd"),
+                    )
+                writer.write_batch(quarantined)
+                quarantined_count += failing_count
+            start += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return {
+        "rows_count": start,
+        "quarantined_count": quarantined_count,
+        "schema_problems": "; ".join(schema_problems),
+        **failed_checks_counts,
+    }
+
+
+def validate_files(
+    file_paths: list,
+    source_dir: str | Path = BASE_RAW_DATA_DIR,
+    quarantine_dir: str | Path = BASE_QUARANTINE_DATA_DIR,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    Validate files keeping their tree (relative to `source_dir`) under
+    `quarantine_dir` for the quarantine files.
+
+    Returns:
+        pd.DataFrame: The report, one row per file with its path, rows_count,
+        quarantined_count, schema_problems and the counts of each failed check.
+    """
+    rows = []
+    for file_path in tqdm(file_paths, desc="Validating data files", unit="file"):
+        quarantine_path = Path(quarantine_dir) / Path(file_path).relative_to(source_dir)
+        result = validate_file(file_path, quarantine_path, batch_size, **kwargs)
+        rows.append({"file_path": str(file_path), **result})
+        if result["quarantined_count"]:
+            logger.warning(
+                f"Quarantined {result['quarantined_count']}/{result['rows_count']} rows of {file_path} into {quarantine_path}"
+            )
+
+    report_df = pd.DataFrame(
+        rows,
+        columns=list(
+            dict.fromkeys(
+                [
+                    "file_path",
+                    "rows_count",
+                    "quarantined_count",
+                    "schema_problems",
+                    *(column for row in rows for column in row),
+                ]
+            )
+        ),
+    )
+    # The checks that did not fail in a file
+    check_columns = report_df.columns[4:]
+    report_df[check_columns] = report_df[check_columns].fillna(0).astype(np.int64)
+    return report_df
+
+
+if __name__ == "__main__":
+    logging.config.dictConfig(get_logger_config(subdir="scripts"))
+
+    raw_files = collect_files(BASE_RAW_DATA_DIR)
+    logger.info(f"Found {len(raw_files)} IPC files to validate in {BASE_RAW_DATA_DIR}")
+    report_df = validate_files(raw_files)
+    report_path = Path(get_or_create_folder(BASE_REPORTS_CSV_DIR)) / "validation.csv"
+    report_df.to_csv(report_path, index=False)
+    logger.info(
+        f"Quarantined {report_df.quarantined_count.sum()}/{report_df.rows_count.sum()} rows, see {report_path}"
+    )